@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import logging
 import random
 
@@ -7,27 +8,119 @@ from kafka.common import (KafkaError,
                           ConnectionError,
                           NodeNotReadyError,
                           KafkaTimeoutError,
+                          TopicAuthorizationFailedError,
                           UnrecognizedBrokerVersion)
-from kafka.cluster import ClusterMetadata
-from kafka.protocol.metadata import MetadataRequest
+from kafka.protocol.commit import OffsetCommitRequest_v0, OffsetFetchRequest_v0
+from kafka.protocol.fetch import FetchRequest
+from kafka.protocol.group import (JoinGroupRequest,
+                                  HeartbeatRequest,
+                                  LeaveGroupRequest,
+                                  SyncGroupRequest)
+from kafka.protocol.metadata import MetadataRequest, MetadataResponse
 from kafka.protocol.produce import ProduceRequest
 
+from aiokafka.cluster import ClusterMetadata
 from aiokafka.conn import create_conn
+from aiokafka.metadata_cache import MetadataCache
 from aiokafka import ensure_future, __version__
 
 
-__all__ = ['AIOKafkaClient']
+__all__ = ['AIOKafkaClient', 'ConnectionGroup']
 
 
 log = logging.getLogger('aiokafka')
 
 
+class ConnectionGroup:
+    """Traffic classes with separate connections to each broker
+
+    Kafka processes requests of a connection one by one, so e.g. a heartbeat
+    would wait behind a long-polling FetchRequest to the same broker.
+    """
+    DEFAULT = 0
+    COORDINATION = 1
+    FETCH = 2
+    PRODUCE = 3
+
+    # API_KEY -> group, all other requests are sent in DEFAULT group
+    # (all versions of a request share the same API_KEY)
+    REQUESTS = {
+        ProduceRequest.API_KEY: PRODUCE,
+        FetchRequest.API_KEY: FETCH,
+        OffsetCommitRequest_v0.API_KEY: COORDINATION,
+        OffsetFetchRequest_v0.API_KEY: COORDINATION,
+        JoinGroupRequest.API_KEY: COORDINATION,
+        HeartbeatRequest.API_KEY: COORDINATION,
+        LeaveGroupRequest.API_KEY: COORDINATION,
+        SyncGroupRequest.API_KEY: COORDINATION,
+    }
+
+    @classmethod
+    def for_request(cls, request):
+        return cls.REQUESTS.get(request.API_KEY, cls.DEFAULT)
+
+
+class NodeStats:
+    """Health and load statistics of a broker, used to choose the least
+    loaded node for requests which may be sent to any broker"""
+
+    # Weight of the newest sample in exponentially weighted moving average
+    # of response latency
+    LATENCY_EWMA_ALPHA = 0.3
+
+    # Reconnect backoff is randomized by up to this fraction of it
+    RECONNECT_JITTER = 0.2
+
+    __slots__ = ('latency', 'failures', 'last_failure',
+                 'connect_failures', 'reconnect_at')
+
+    def __init__(self):
+        self.latency = None
+        self.failures = 0
+        self.last_failure = None
+        self.connect_failures = 0
+        self.reconnect_at = 0
+
+    def record_response(self, latency=None):
+        """Record successful response, `latency` is None for requests whose
+        response time doesn't reflect load of the broker"""
+        if latency is None:
+            pass
+        elif self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.LATENCY_EWMA_ALPHA * (latency - self.latency)
+        self.failures = 0
+
+    def record_failure(self, now):
+        self.failures += 1
+        self.last_failure = now
+
+    def record_connect(self):
+        self.connect_failures = 0
+        self.reconnect_at = 0
+
+    def record_connect_failure(self, now, backoff, backoff_max):
+        """Schedule next connection attempt after exponential backoff"""
+        self.record_failure(now)
+        backoff = min(backoff * 2 ** self.connect_failures, backoff_max)
+        jitter = random.uniform(-self.RECONNECT_JITTER, self.RECONNECT_JITTER)
+        self.reconnect_at = now + backoff * (1 + jitter)
+        self.connect_failures += 1
+
+
 class AIOKafkaClient:
     """This class implements interface for interact with Kafka cluster"""
 
     def __init__(self, *, loop, bootstrap_servers='localhost',
                  client_id='aiokafka-'+__version__, metadata_max_age_ms=300000,
-                 request_timeout_ms=40000):
+                 request_timeout_ms=40000,
+                 max_in_flight_requests_per_connection=5,
+                 use_frame_protocol=False, connections_per_broker=1,
+                 bootstrap_stagger_ms=250, metadata_cache_dir=None,
+                 retry_backoff_ms=100, metadata_debounce_ms=10,
+                 connections_max_idle_ms=540000, reconnect_backoff_ms=50,
+                 reconnect_backoff_max_ms=1000):
         """Initialize an asynchronous kafka client
 
         Keyword Arguments:
@@ -48,20 +141,87 @@ class AIOKafkaClient:
                 which we force a refresh of metadata even if we haven't seen
                 any partition leadership changes to proactively discover any
                 new brokers or partitions. Default: 300000
+            max_in_flight_requests_per_connection (int): Requests are
+                pipelined to kafka brokers up to this number of maximum
+                requests per broker connection. Requests above this limit are
+                queued until responses for in-flight ones arrive. Default: 5.
+            use_frame_protocol (bool): read responses with a protocol that
+                splits them into frames in place and decodes them from
+                memoryviews, instead of copying every frame out of a
+                StreamReader. Default: False.
+            connections_per_broker (int): maximum number of connections
+                opened to a broker for produce requests. Every request is
+                sent through the connection with fewest outstanding requests,
+                a new one is opened if all of them are busy. Default: 1.
+            bootstrap_stagger_ms (int): delay in milliseconds before
+                starting bootstrap via the next server from
+                `bootstrap_servers`, while previous attempts are still in
+                progress. The first server to return metadata wins.
+                Default: 250.
+            metadata_cache_dir (str): directory to store snapshot of cluster
+                metadata and broker version in. If set, startup uses the
+                snapshot for the same bootstrap servers at once and
+                revalidates it in the background. Default: None.
+            retry_backoff_ms (int): minimum time in milliseconds between
+                two metadata refreshes. It is doubled after every failed
+                refresh (up to 32 times). Default: 100.
+            metadata_debounce_ms (int): time in milliseconds to wait after
+                a refresh is requested, so that requests for other topics
+                arriving meanwhile are served by the same metadata request.
+                Default: 10.
+            connections_max_idle_ms (int): close connections without
+                requests in flight after this number of milliseconds of
+                inactivity. None disables closing. Default: 540000.
+            reconnect_backoff_ms (int): time in milliseconds to wait before
+                connecting to a broker after a failed attempt. It is doubled
+                after every consecutive failure and randomized by 20% to
+                avoid reconnect storms. Default: 50.
+            reconnect_backoff_max_ms (int): maximum reconnect backoff in
+                milliseconds. Default: 1000.
         """
+        assert connections_per_broker > 0
         self._bootstrap_servers = bootstrap_servers
         self._client_id = client_id
         self._metadata_max_age_ms = metadata_max_age_ms
         self._request_timeout_ms = request_timeout_ms
+        self._max_in_flight_requests_per_connection = \
+            max_in_flight_requests_per_connection
+        self._use_frame_protocol = use_frame_protocol
+        self._connections_per_broker = connections_per_broker
+        self._bootstrap_stagger = bootstrap_stagger_ms / 1000
+        self._metadata_cache = None
+        if metadata_cache_dir is not None:
+            self._metadata_cache = MetadataCache(
+                metadata_cache_dir, self.hosts)
+        self._cached_api_version = None
+        self._revalidate_task = None
 
         self.cluster = ClusterMetadata(metadata_max_age_ms=metadata_max_age_ms)
         self._topics = set()  # empty set will fetch all topic metadata
-        self._conns = {}
+        self._topic_owners = {}  # user of client -> topics it needs
+        self._users = set()  # owners that acquired client successfully
+        self._acquire_lock = asyncio.Lock(loop=loop)
+        self._conns = {}  # (node_id, group, index in pool) -> connection
         self._loop = loop
         self._sync_task = None
 
         self._md_update_fut = asyncio.Future(loop=self._loop)
         self._md_update_waiter = asyncio.Future(loop=self._loop)
+        # Topics to refresh with next metadata request, all topics tracked
+        # by client are refreshed if `_md_full_update` is set
+        self._md_stale_topics = set()
+        self._md_full_update = False
+        self._md_retry_backoff = retry_backoff_ms / 1000
+        self._md_debounce = metadata_debounce_ms / 1000
+        self._md_failures = 0
+        self._md_next_update = 0
+        self._node_stats = collections.defaultdict(NodeStats)
+        self._connections_max_idle = None
+        if connections_max_idle_ms is not None:
+            self._connections_max_idle = connections_max_idle_ms / 1000
+        self._reconnect_backoff = reconnect_backoff_ms / 1000
+        self._reconnect_backoff_max = reconnect_backoff_max_ms / 1000
+        self._idle_task = None
         self._get_conn_lock = asyncio.Lock(loop=loop)
 
     def __repr__(self):
@@ -71,8 +231,47 @@ class AIOKafkaClient:
     def hosts(self):
         return collect_hosts(self._bootstrap_servers)
 
+    @property
+    def connections_per_broker(self):
+        return self._connections_per_broker
+
+    @asyncio.coroutine
+    def acquire(self, owner=None):
+        """Register a user of client (producer or consumer), the client is
+        bootstrapped by the first one
+
+        This allows to share a single client (i.e. cluster metadata and
+        connections) between producers and consumers in one process.
+        `owner` is registered only if bootstrap succeeds.
+        """
+        with (yield from self._acquire_lock):
+            if self._sync_task is None:
+                yield from self.bootstrap()
+            self._users.add(owner)
+
+    @asyncio.coroutine
+    def release(self, owner=None):
+        """Unregister a user of client, stop tracking topics needed by it
+        and close the client if it was the last one
+
+        Client is not closed on release by an owner which didn't acquire it
+        (e.g. consumer which failed to start), as it may be used by others.
+        """
+        if owner in self._topic_owners:
+            del self._topic_owners[owner]
+            self._update_topics()
+        with (yield from self._acquire_lock):
+            if owner not in self._users:
+                return
+            self._users.remove(owner)
+            if not self._users:
+                yield from self.close()
+
     @asyncio.coroutine
     def close(self):
+        if self._revalidate_task is not None:
+            self._revalidate_task.cancel()
+            yield from asyncio.wait([self._revalidate_task], loop=self._loop)
         if self._sync_task:
             self._sync_task.cancel()
             try:
@@ -80,66 +279,211 @@ class AIOKafkaClient:
             except asyncio.CancelledError:
                 pass
             self._sync_task = None
+        if self._idle_task is not None:
+            self._idle_task.cancel()
+            yield from asyncio.wait([self._idle_task], loop=self._loop)
+            self._idle_task = None
         for conn in self._conns.values():
             conn.close()
 
     @asyncio.coroutine
-    def bootstrap(self):
-        """Try to to bootstrap initial cluster metadata"""
-        metadata_request = MetadataRequest([])
-        for host, port in self.hosts:
-            log.debug("Attempting to bootstrap via node at %s:%s", host, port)
+    def _bootstrap_via(self, host, port):
+        """Connect to bootstrap server and request cluster metadata
 
-            try:
-                bootstrap_conn = yield from create_conn(
-                    host, port, loop=self._loop, client_id=self._client_id,
-                    request_timeout_ms=self._request_timeout_ms)
-            except (OSError, asyncio.TimeoutError) as err:
-                log.error('Unable connect to "%s:%s": %s', host, port, err)
-                continue
+        Returns:
+            (connection, MetadataResponse) or None on failure
+        """
+        log.debug("Attempting to bootstrap via node at %s:%s", host, port)
+        try:
+            conn = yield from create_conn(
+                host, port, loop=self._loop, client_id=self._client_id,
+                request_timeout_ms=self._request_timeout_ms,
+                max_in_flight_requests_per_connection=(
+                    self._max_in_flight_requests_per_connection),
+                use_frame_protocol=self._use_frame_protocol)
+        except (OSError, asyncio.TimeoutError) as err:
+            log.error('Unable connect to "%s:%s": %s', host, port, err)
+            return None
 
-            try:
-                metadata = yield from bootstrap_conn.send(metadata_request)
-            except KafkaError as err:
-                log.warning('Unable to request metadata from "%s:%s": %s',
-                            host, port, err)
-                bootstrap_conn.close()
-                continue
+        try:
+            metadata = yield from conn.send(MetadataRequest([]))
+        except (KafkaError, asyncio.TimeoutError) as err:
+            log.warning('Unable to request metadata from "%s:%s": %s',
+                        host, port, err)
+            conn.close()
+            return None
+        except asyncio.CancelledError:
+            conn.close()
+            raise
+        return conn, metadata
 
-            self.cluster.update_metadata(metadata)
+    @asyncio.coroutine
+    def bootstrap(self):
+        """Try to to bootstrap initial cluster metadata
 
-            # A cluster with no topics can return no broker metadata
-            # in that case, we should keep the bootstrap connection
-            if not len(self.cluster.brokers()):
-                self._conns['bootstrap'] = bootstrap_conn
-            else:
-                bootstrap_conn.close()
+        Bootstrap servers are tried concurrently: an attempt is started
+        every `bootstrap_stagger_ms` (or as soon as previous attempt fails)
+        and the first received metadata wins, other attempts are cancelled.
 
-            log.debug('Received cluster metadata: %s', self.cluster)
-            break
+        If `metadata_cache_dir` is set and contains metadata for bootstrap
+        servers, it's used at once and revalidated in the background.
+        """
+        cached = None
+        if self._metadata_cache is not None and \
+                self._revalidate_task is None:
+            cached = self._metadata_cache.load()
+        if cached is not None:
+            metadata, self._cached_api_version = cached
+            self.cluster.update_metadata(metadata)
+            log.debug('Loaded cluster metadata from %s: %s',
+                      self._metadata_cache.path, self.cluster)
+            self._revalidate_task = ensure_future(
+                self._revalidate_cache(), loop=self._loop)
         else:
-            raise ConnectionError(
-                'Unable to bootstrap from {}'.format(self.hosts))
+            yield from self._bootstrap()
+            if self._metadata_cache is not None:
+                self._metadata_cache.save(
+                    self.cluster, self._cached_api_version)
 
         if self._sync_task is None:
             # starting metadata synchronizer task
             self._sync_task = ensure_future(
                 self._md_synchronizer(), loop=self._loop)
+        if self._idle_task is None and \
+                self._connections_max_idle is not None:
+            self._idle_task = ensure_future(
+                self._close_idle_connections(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _close_idle_connections(self):
+        """routine (async task) closing connections without requests in
+        flight for `connections_max_idle_ms`"""
+        while True:
+            now = self._loop.time()
+            next_check = now + self._connections_max_idle
+            for conn_id, conn in list(self._conns.items()):
+                if conn.pending_requests:
+                    continue
+                expires = conn.last_activity + self._connections_max_idle
+                if expires <= now:
+                    log.debug('Closing idle connection to node %s: %s',
+                              conn_id[0], conn)
+                    conn.close()
+                    del self._conns[conn_id]
+                else:
+                    next_check = min(next_check, expires)
+            yield from asyncio.sleep(next_check - now, loop=self._loop)
+
+    @asyncio.coroutine
+    def _revalidate_cache(self):
+        """Bootstrap and check broker version in the background, to
+        refresh cached metadata"""
+        try:
+            yield from self._bootstrap()
+            cached_version = self._cached_api_version
+            if cached_version is not None:
+                self._cached_api_version = yield from self._check_version(None)
+                if self._cached_api_version != cached_version:
+                    log.warning('Broker version changed from cached %s to %s',
+                                cached_version, self._cached_api_version)
+            self._metadata_cache.save(self.cluster, self._cached_api_version)
+        except asyncio.CancelledError:
+            pass
+        except Exception:  # noqa
+            log.error('Unable to revalidate cached metadata', exc_info=True)
+        finally:
+            self._revalidate_task = None
+
+    @asyncio.coroutine
+    def _bootstrap(self):
+        hosts = collections.deque(self.hosts)
+        attempts = set()
+        result = None
+        try:
+            while result is None and (hosts or attempts):
+                if hosts:
+                    host, port = hosts.popleft()
+                    attempts.add(ensure_future(
+                        self._bootstrap_via(host, port), loop=self._loop))
+                done, attempts = yield from asyncio.wait(
+                    attempts,
+                    timeout=self._bootstrap_stagger if hosts else None,
+                    return_when=asyncio.FIRST_COMPLETED, loop=self._loop)
+                for task in done:
+                    if result is None:
+                        result = task.result()
+                    elif task.result() is not None:
+                        task.result()[0].close()
+        finally:
+            # Cancel attempts, which lost the race
+            for task in attempts:
+                task.cancel()
+            if attempts:
+                yield from asyncio.wait(attempts, loop=self._loop)
+
+        if result is None:
+            raise ConnectionError(
+                'Unable to bootstrap from {}'.format(self.hosts))
+        bootstrap_conn, metadata = result
+
+        self.cluster.update_metadata(metadata)
+
+        # A cluster with no topics can return no broker metadata
+        # in that case, we should keep the bootstrap connection
+        if not len(self.cluster.brokers()):
+            self._conns[('bootstrap', ConnectionGroup.DEFAULT, 0)] = \
+                bootstrap_conn
+        else:
+            bootstrap_conn.close()
+
+        log.debug('Received cluster metadata: %s', self.cluster)
 
     @asyncio.coroutine
     def _md_synchronizer(self):
         """routine (async task) for synchronize cluster metadata every
-        `metadata_max_age_ms` milliseconds"""
+        `metadata_max_age_ms` milliseconds or on demand
+
+        Requests for update are debounced and rate limited, so a burst of
+        them (e.g. errors for every partition of a failed broker) results
+        in a single metadata request for stale topics only.
+        """
         while True:
             yield from asyncio.wait(
                 [self._md_update_waiter],
                 timeout=self._metadata_max_age_ms / 1000,
                 loop=self._loop)
+            if not self._md_update_waiter.done():
+                # metadata is too old, refresh all topics
+                self._md_full_update = True
 
+            delay = max(self._md_debounce,
+                        self._md_next_update - self._loop.time())
+            yield from asyncio.sleep(delay, loop=self._loop)
+
+            # Requests for update arriving from now on are served by next
+            # metadata request
             self._md_update_waiter = asyncio.Future(loop=self._loop)
-            ret = yield from self._metadata_update(self.cluster, self._topics)
-            self._md_update_fut.set_result(ret)
-            self._md_update_fut = asyncio.Future(loop=self._loop)
+            fut, self._md_update_fut = \
+                self._md_update_fut, asyncio.Future(loop=self._loop)
+            full_update, self._md_full_update = self._md_full_update, False
+            stale_topics, self._md_stale_topics = \
+                self._md_stale_topics, set()
+            if full_update:
+                ret = yield from self._metadata_update(
+                    self.cluster, self._topics)
+            else:
+                ret = yield from self._metadata_update(
+                    self.cluster, self._topics, stale_topics)
+            if ret:
+                self._md_failures = 0
+            else:
+                self._md_failures = min(self._md_failures + 1, 5)
+                # topics are not refreshed, keep them for the next request
+                self._md_full_update |= full_update
+                self._md_stale_topics |= stale_topics
+            self._md_next_update = self._loop.time() + \
+                self._md_retry_backoff * 2 ** self._md_failures
+            fut.set_result(ret)
 
     def get_random_node(self):
         """choice random node from known cluster brokers
@@ -152,14 +496,100 @@ class AIOKafkaClient:
             return None
         return random.choice(nodeids)
 
+    def _node_load(self, node_id, prior_latency=0):
+        """Sort key of node, the less the better
+
+        Latency of nodes without measured one is assumed to be
+        `prior_latency`.
+        """
+        stats = self._node_stats.get(node_id)
+        if stats is None:
+            # never used, nothing bad is known about it
+            return (False, prior_latency)
+        # Node is unhealthy for a backoff period after a failure, the period
+        # is doubled with every consecutive failure
+        unhealthy = stats.failures > 0 and (
+            self._loop.time() - stats.last_failure <
+            self._md_retry_backoff * 2 ** min(stats.failures, 5))
+        outstanding = 0
+        for (conn_node_id, _, _), conn in self._conns.items():
+            if conn_node_id == node_id:
+                outstanding += conn.pending_requests
+        latency = stats.latency
+        if latency is None:
+            latency = prior_latency
+        # expected time to get a response
+        return (unhealthy, (outstanding + 1) * latency)
+
+    def _nodes_by_load(self):
+        """Return known brokers, least loaded healthy first"""
+        nodeids = [b.nodeId for b in self.cluster.brokers()]
+        # spread requests among equally loaded nodes
+        random.shuffle(nodeids)
+        # nodes without statistics are expected to be as fast as an average
+        # known node, so they don't always win over healthy known nodes
+        latencies = []
+        for node_id in nodeids:
+            stats = self._node_stats.get(node_id)
+            if stats is not None and stats.latency is not None:
+                latencies.append(stats.latency)
+        prior = sum(latencies) / len(latencies) if latencies else 0
+        nodeids.sort(key=lambda node_id: self._node_load(node_id, prior))
+        return nodeids
+
+    def least_loaded_node(self):
+        """Choose the broker with fewest outstanding requests and lowest
+        response latency, which did not fail recently, like Java client's
+        `leastLoadedNode`
+
+        Returns:
+            nodeId - identifier of broker or None if no brokers are known
+        """
+        nodeids = self._nodes_by_load()
+        if not nodeids:
+            return None
+        return nodeids[0]
+
+    @asyncio.coroutine
+    def _send_tracked(self, node_id, conn, request, expect_response=True,
+                      group=ConnectionGroup.DEFAULT):
+        """Send request through `conn` and update statistics of node
+
+        Response latency is recorded for DEFAULT group only: long-polling
+        fetches and group requests blocked for rebalance would make
+        partition leaders and coordinators look slow.
+        """
+        stats = self._node_stats[node_id]
+        start = self._loop.time()
+        try:
+            result = yield from conn.send(
+                request, expect_response=expect_response)
+        except (KafkaError, asyncio.TimeoutError):
+            stats.record_failure(self._loop.time())
+            raise
+        if expect_response:
+            latency = None
+            if group == ConnectionGroup.DEFAULT:
+                latency = self._loop.time() - start
+            stats.record_response(latency)
+        return result
+
     @asyncio.coroutine
-    def _metadata_update(self, cluster_metadata, topics):
+    def _metadata_update(self, cluster_metadata, topics, stale_topics=None):
+        """Request metadata for `topics` (all topics if empty) and update
+        `cluster_metadata` with it
+
+        If `stale_topics` is given, only these topics are requested and
+        current metadata of other topics is preserved.
+        """
         assert isinstance(cluster_metadata, ClusterMetadata)
-        metadata_request = MetadataRequest(list(topics))
-        nodeids = [b.nodeId for b in self.cluster.brokers()]
-        if 'bootstrap' in self._conns:
+        if stale_topics:
+            metadata_request = MetadataRequest(list(stale_topics))
+        else:
+            metadata_request = MetadataRequest(list(topics))
+        nodeids = self._nodes_by_load()
+        if ('bootstrap', ConnectionGroup.DEFAULT, 0) in self._conns:
             nodeids.append('bootstrap')
-        random.shuffle(nodeids)
         for node_id in nodeids:
             conn = yield from self._get_conn(node_id)
 
@@ -169,13 +599,16 @@ class AIOKafkaClient:
                       metadata_request, node_id)
 
             try:
-                metadata = yield from conn.send(metadata_request)
-            except KafkaError as err:
+                metadata = yield from self._send_tracked(
+                    node_id, conn, metadata_request)
+            except (KafkaError, asyncio.TimeoutError) as err:
                 log.error(
                     'Unable to request metadata from node with id %s: %s',
                     node_id, err)
                 continue
 
+            if stale_topics:
+                metadata = self._merge_metadata(cluster_metadata, metadata)
             cluster_metadata.update_metadata(metadata)
             break
         else:
@@ -184,12 +617,41 @@ class AIOKafkaClient:
             return False
         return True
 
-    def force_metadata_update(self):
+    @staticmethod
+    def _merge_metadata(cluster_metadata, metadata):
+        """Return MetadataResponse with topics from `metadata` and the rest
+        of topics (including unauthorized ones) known by `cluster_metadata`
+        """
+        updated = {topic for _, topic, _ in metadata.topics}
+        topics = list(metadata.topics)
+        for topic, partitions in cluster_metadata._partitions.items():
+            if topic in updated:
+                continue
+            topics.append((0, topic, [
+                (p.error, p.partition, p.leader, p.replicas, p.isr)
+                for p in partitions.values()]))
+        for topic in cluster_metadata.unauthorized_topics - updated:
+            topics.append((
+                TopicAuthorizationFailedError.errno, topic, []))
+        return MetadataResponse(metadata.brokers, topics)
+
+    def force_metadata_update(self, topics=None):
         """Update cluster metadata
 
+        Requests are coalesced: all callers waiting for update share the
+        same metadata request to Kafka.
+
+        Arguments:
+            topics (iterable of str): update only metadata of these topics,
+                all tracked topics are updated if not set. Default: None.
+
         Returns:
             True/False - metadata updated or not
         """
+        if topics is None:
+            self._md_full_update = True
+        else:
+            self._md_stale_topics.update(topics)
         # Wake up the `_md_synchronizer` task
         if not self._md_update_waiter.done():
             self._md_update_waiter.set_result(None)
@@ -206,71 +668,143 @@ class AIOKafkaClient:
                 'Unable to get cluster metadata over all known brokers')
         return cluster_md
 
-    def add_topic(self, topic):
+    def _update_topics(self):
+        """Track union of topics needed by all users of client
+
+        Returns:
+            True if some topics are tracked now, that were not before
+        """
+        topics = set()
+        for owner_topics in self._topic_owners.values():
+            if owner_topics is None:
+                # some user needs all topics
+                topics = set()
+                break
+            topics |= owner_topics
+        # empty set of topics means all topics
+        added = bool(topics.difference(self._topics) or
+                     (self._topics and not topics))
+        self._topics = topics
+        return added
+
+    def add_topic(self, topic, *, owner=None):
         """Add a topic to the list of topics tracked via metadata.
 
         Arguments:
             topic (str): topic to track
+
+        Keyword Arguments:
+            owner: user of client (e.g. producer) that needs the topic.
+                Default: None.
         """
-        if topic in self._topics:
+        owner_topics = self._topic_owners.setdefault(owner, set())
+        if owner_topics is None or topic in owner_topics:
             return
-        self._topics.add(topic)
+        owner_topics.add(topic)
+        self._update_topics()
 
-    def set_topics(self, topics):
+    def set_topics(self, topics, *, owner=None):
         """Set specific topics to track for metadata.
 
+        Client tracks union of topics set by all of its users, or all
+        topics if some user needs all topics or the union is empty.
+
         Arguments:
-            topics (list of str): topics to track
+            topics (list of str or None): topics to track, None means all
+                topics (e.g. for pattern subscription)
+
+        Keyword Arguments:
+            owner: user of client (e.g. consumer) that needs the topics.
+                Default: None.
         """
-        if set(topics).difference(self._topics):
-            self._topics = set(topics)
+        self._topic_owners[owner] = None if topics is None else set(topics)
+        if self._update_topics():
             # update metadata in async manner
             self.force_metadata_update()
 
     @asyncio.coroutine
-    def _get_conn(self, node_id):
+    def _get_conn(self, node_id, group=ConnectionGroup.DEFAULT, index=0):
         "Get or create a connection to a broker using host and port"
-        if node_id in self._conns:
-            conn = self._conns[node_id]
+        conn_id = (node_id, group, index)
+        if conn_id in self._conns:
+            conn = self._conns[conn_id]
             if not conn.connected():
-                del self._conns[node_id]
+                del self._conns[conn_id]
             else:
                 return conn
 
+        stats = self._node_stats[node_id]
+        if stats.reconnect_at > self._loop.time():
+            log.debug('Node %s is in reconnect backoff', node_id)
+            return None
+
         try:
             broker = self.cluster.broker_metadata(node_id)
             assert broker, 'Broker id %s not in current metadata' % node_id
-            log.debug("Initiating connection to node %s at %s:%s",
-                      node_id, broker.host, broker.port)
+            log.debug("Initiating connection to node %s at %s:%s (group %s)",
+                      node_id, broker.host, broker.port, group)
 
             with (yield from self._get_conn_lock):
-                if node_id in self._conns:
-                    return self._conns[node_id]
-                self._conns[node_id] = yield from create_conn(
+                if conn_id in self._conns:
+                    return self._conns[conn_id]
+                self._conns[conn_id] = yield from create_conn(
                     broker.host, broker.port, loop=self._loop,
                     client_id=self._client_id,
-                    request_timeout_ms=self._request_timeout_ms)
+                    request_timeout_ms=self._request_timeout_ms,
+                    max_in_flight_requests_per_connection=(
+                        self._max_in_flight_requests_per_connection),
+                    use_frame_protocol=self._use_frame_protocol)
         except (OSError, asyncio.TimeoutError) as err:
             log.error('Unable connect to node with id %s: %s', node_id, err)
+            stats.record_connect_failure(
+                self._loop.time(), self._reconnect_backoff,
+                self._reconnect_backoff_max)
             return None
         else:
-            return self._conns[node_id]
+            stats.record_connect()
+            return self._conns[conn_id]
 
     @asyncio.coroutine
-    def ready(self, node_id):
-        conn = yield from self._get_conn(node_id)
+    def _get_pooled_conn(self, node_id, group):
+        """Get connection with fewest outstanding requests from the pool
+        of `connections_per_broker` connections, opening a new one if all
+        connections are busy"""
+        best = None
+        free_index = None
+        for index in range(self._connections_per_broker):
+            conn = self._conns.get((node_id, group, index))
+            if conn is None or not conn.connected():
+                if free_index is None:
+                    free_index = index
+            elif best is None or \
+                    conn.pending_requests < best.pending_requests:
+                best = conn
+        if free_index is not None and (
+                best is None or best.pending_requests):
+            conn = yield from self._get_conn(node_id, group, free_index)
+            if conn is not None:
+                return conn
+        return best
+
+    @asyncio.coroutine
+    def ready(self, node_id, *, group=ConnectionGroup.DEFAULT):
+        conn = yield from self._get_conn(node_id, group)
         if conn is None:
             return False
         return True
 
     @asyncio.coroutine
-    def send(self, node_id, request):
+    def send(self, node_id, request, *, group=None):
         """Send a request to a specific node.
 
         Arguments:
             node_id (int): destination node
             request (Struct): request object (not-encoded)
 
+        Keyword Arguments:
+            group (int): ConnectionGroup of connection to send request
+                through. Default: chosen by request type.
+
         Raises:
             kafka.common.KafkaTimeoutError
             kafka.common.NodeNotReadyError
@@ -280,7 +814,13 @@ class AIOKafkaClient:
         Returns:
             Future: resolves to Response struct
         """
-        if not (yield from self.ready(node_id)):
+        if group is None:
+            group = ConnectionGroup.for_request(request)
+        if group == ConnectionGroup.PRODUCE:
+            conn = yield from self._get_pooled_conn(node_id, group)
+        else:
+            conn = yield from self._get_conn(node_id, group)
+        if conn is None:
             raise NodeNotReadyError(
                 "Attempt to send a request to node"
                 " which is not ready (node id {}).".format(node_id))
@@ -290,10 +830,9 @@ class AIOKafkaClient:
         if isinstance(request, ProduceRequest) and request.required_acks == 0:
             expect_response = False
 
-        future = self._conns[node_id].send(
-            request, expect_response=expect_response)
         try:
-            result = yield from future
+            result = yield from self._send_tracked(
+                node_id, conn, request, expect_response, group)
         except asyncio.TimeoutError:
             raise KafkaTimeoutError()
         else:
@@ -302,17 +841,25 @@ class AIOKafkaClient:
     @asyncio.coroutine
     def check_version(self, node_id=None):
         """Attempt to guess the broker version"""
+        if node_id is None and self._cached_api_version is not None:
+            return self._cached_api_version
+        version = yield from self._check_version(node_id)
+        if self._metadata_cache is not None:
+            self._cached_api_version = version
+            self._metadata_cache.save(self.cluster, version)
+        return version
+
+    @asyncio.coroutine
+    def _check_version(self, node_id):
         if node_id is None:
-            if self._conns:
-                node_id = list(self._conns.keys())[0]
-            else:
-                assert self.cluster.brokers(), 'no brokers in metadata'
-                node_id = list(self.cluster.brokers())[0].nodeId
+            node_id = self.least_loaded_node()
+        if node_id is None:
+            # no brokers in metadata, use bootstrap connection
+            assert self._conns, 'no brokers in metadata'
+            node_id, _, _ = list(self._conns.keys())[0]
 
         from kafka.protocol.admin import ListGroupsRequest
-        from kafka.protocol.commit import (
-            OffsetFetchRequest_v0, GroupCoordinatorRequest)
-        from kafka.protocol.metadata import MetadataRequest
+        from kafka.protocol.commit import GroupCoordinatorRequest
         test_cases = [
             ('0.9', ListGroupsRequest()),
             ('0.8.2', GroupCoordinatorRequest('kafka-python-default-group')),
@@ -0,0 +1,78 @@
+import collections
+
+from kafka.cluster import ClusterMetadata as BaseClusterMetadata
+
+__all__ = ['ClusterMetadata']
+
+
+TopicRoute = collections.namedtuple(
+    'TopicRoute', ['partitions', 'available', 'partitions_set',
+                   'available_set'])
+
+
+class ClusterMetadata(BaseClusterMetadata):
+    """Cluster metadata with precomputed per-topic routing table
+
+    kafka-python builds new sets of partitions on every
+    `partitions_for_topic()` and `available_partitions_for_topic()` call.
+    Here they are built once per metadata update, and `generation` is
+    incremented every time metadata changes, so callers may cache data
+    derived from metadata and check it cheaply.
+    """
+
+    def __init__(self, **configs):
+        super().__init__(**configs)
+        self._generation = 0
+        # `update_metadata` replaces `_partitions` dict, so routing table is
+        # rebuilt lazily when it is not built from the current one
+        self._routes_source = self._partitions
+        self._routes = {}
+
+    @property
+    def generation(self):
+        """Number of metadata updates seen by routing table"""
+        self._get_routes()
+        return self._generation
+
+    def _get_routes(self):
+        if self._routes_source is self._partitions:
+            return self._routes
+        routes = {}
+        for topic, partitions in self._partitions.items():
+            all_partitions = tuple(sorted(partitions))
+            available = tuple(
+                partition for partition in all_partitions
+                if partitions[partition].leader != -1)
+            routes[topic] = TopicRoute(
+                all_partitions, available,
+                frozenset(all_partitions), frozenset(available))
+        self._routes = routes
+        self._routes_source = self._partitions
+        self._generation += 1
+        return routes
+
+    def topic_route(self, topic):
+        """Return routing of topic
+
+        Returns:
+            TopicRoute: sorted tuples of all and available (with known
+                leader) partitions and frozensets of them, or None if topic
+                is unknown
+        """
+        return self._get_routes().get(topic)
+
+    def partitions_for_topic(self, topic):
+        """Return frozenset of all partitions for topic (whether available
+        or not) or None if topic is unknown"""
+        route = self._get_routes().get(topic)
+        if route is None:
+            return None
+        return route.partitions_set
+
+    def available_partitions_for_topic(self, topic):
+        """Return frozenset of partitions with known leaders or None if
+        topic is unknown"""
+        route = self._get_routes().get(topic)
+        if route is None:
+            return None
+        return route.available_set
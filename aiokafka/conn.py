@@ -1,50 +1,103 @@
 import asyncio
+import collections
+import io
 import struct
 import logging
 
 import kafka.common as Errors
-from kafka.protocol.api import RequestHeader
+from kafka.protocol.types import String
 from kafka.protocol.commit import GroupCoordinatorResponse
 
 from aiokafka import ensure_future
 
-__all__ = ['AIOKafkaConnection', 'create_conn']
+__all__ = ['AIOKafkaConnection', 'KafkaProtocol', 'create_conn']
 
 
 @asyncio.coroutine
 def create_conn(host, port, *, loop=None, client_id='aiokafka',
-                request_timeout_ms=40000, api_version=(0, 8, 2)):
+                request_timeout_ms=40000, api_version=(0, 8, 2),
+                max_in_flight_requests_per_connection=5,
+                use_frame_protocol=False):
     if loop is None:
         loop = asyncio.get_event_loop()
     conn = AIOKafkaConnection(
         host, port, loop=loop, client_id=client_id,
-        request_timeout_ms=request_timeout_ms, api_version=api_version)
+        request_timeout_ms=request_timeout_ms, api_version=api_version,
+        max_in_flight_requests_per_connection=(
+            max_in_flight_requests_per_connection),
+        use_frame_protocol=use_frame_protocol)
     yield from conn.connect()
     return conn
 
 
 class AIOKafkaConnection:
-    """Class for manage connection to Kafka node"""
+    """Class for manage connection to Kafka node
+
+    Kafka answers requests of a connection strictly in order, so sent
+    requests are kept in a FIFO queue and every response is matched against
+    the head of it. At most `max_in_flight_requests_per_connection`
+    requests (that expect a response) are written to the socket, the rest
+    are queued until responses arrive. Requests are queued as well while
+    the transport's write buffer is being drained.
+
+    All requests of a connection share the same timeout, so their deadlines
+    grow in send order too. They are kept in a FIFO queue checked by a
+    single timer callback, instead of a `wait_for()` task and timer for
+    each request.
+
+    With `use_frame_protocol` responses are read by :class:`KafkaProtocol`
+    instead of a StreamReader, which splits frames in place and passes them
+    to decoders as memoryviews.
+    """
 
     HEADER = struct.Struct('>i')
+    # Size prefix and RequestHeader fields, except constant client_id
+    REQUEST_HEADER = struct.Struct('>ihhi')
 
     log = logging.getLogger(__name__)
 
     def __init__(self, host, port, *, loop, client_id='aiokafka',
-                 request_timeout_ms=40000, api_version=(0, 8, 2)):
+                 request_timeout_ms=40000, api_version=(0, 8, 2),
+                 max_in_flight_requests_per_connection=5,
+                 use_frame_protocol=False):
+        assert max_in_flight_requests_per_connection > 0
         self._host = host
         self._port = port
         self._reader = self._writer = None
         self._loop = loop
-        self._requests = []
+        # (correlation_id, response_type, future) of requests, written to
+        # socket and waiting for response
+        self._requests = collections.deque()
+        # (encoded request buffers, item for `_requests` or None) of requests,
+        # waiting for room in the in-flight window
+        self._queued = collections.deque()
+        self._max_in_flight = max_in_flight_requests_per_connection
+        # (deadline, future) of requests waiting for response, in the order
+        # of deadlines (and responses)
+        self._timeouts = collections.deque()
+        self._timeout_handle = None
         self._read_task = None
+        self._drain_task = None
         self._correlation_id = 0
         self._request_timeout = request_timeout_ms / 1000
         self._api_version = api_version
         self._client_id = client_id
+        self._encoded_client_id = String('utf-8').encode(client_id)
+        self._use_frame_protocol = use_frame_protocol
+        self._last_activity = loop.time()
 
     @asyncio.coroutine
     def connect(self):
+        if self._use_frame_protocol:
+            future = self._loop.create_connection(
+                lambda: KafkaProtocol(self, loop=self._loop),
+                self.host, self.port)
+            transport, protocol = yield from asyncio.wait_for(
+                future, self._request_timeout, loop=self._loop)
+            self._reader = protocol
+            self._writer = asyncio.StreamWriter(
+                transport, protocol, None, self._loop)
+            return
         future = asyncio.open_connection(self.host, self.port, loop=self._loop)
         self._reader, self._writer = yield from asyncio.wait_for(
             future, self._request_timeout, loop=self._loop)
@@ -61,6 +114,16 @@ class AIOKafkaConnection:
     def port(self):
         return self._port
 
+    @property
+    def pending_requests(self):
+        """Number of requests sent or queued and not processed yet"""
+        return len(self._requests) + len(self._queued)
+
+    @property
+    def last_activity(self):
+        """Loop time of the last request sent or response received"""
+        return self._last_activity
+
     def send(self, request, expect_response=True):
         if self._writer is None:
             raise Errors.ConnectionError(
@@ -68,37 +131,134 @@ class AIOKafkaConnection:
                 .format(self._host, self._port))
 
         correlation_id = self._next_correlation_id()
-        header = RequestHeader(request,
-                               correlation_id=correlation_id,
-                               client_id=self._client_id)
-        message = header.encode() + request.encode()
-        size = self.HEADER.pack(len(message))
-        try:
-            self._writer.write(size + message)
-        except OSError as err:
-            self.close()
-            raise Errors.ConnectionError(
-                "Connection at {0}:{1} broken: {2}".format(
-                    self._host, self._port, err))
+        self._last_activity = self._loop.time()
+        body = request.encode()
+        # Request may be encoded into a list of buffers, so large produce
+        # requests are not copied for concatenation
+        if isinstance(body, bytes):
+            body = [body]
+        header_size = self.REQUEST_HEADER.size + len(self._encoded_client_id)
+        header = self.REQUEST_HEADER.pack(
+            header_size - self.HEADER.size + sum(map(len, body)),
+            request.API_KEY, request.API_VERSION,
+            correlation_id) + self._encoded_client_id
+        data = [header] + body
 
         fut = asyncio.Future(loop=self._loop)
+        item = None
+        if expect_response:
+            item = (correlation_id, request.RESPONSE_TYPE, fut)
+        if self._queued or self._drain_task is not None or (
+                expect_response and
+                len(self._requests) >= self._max_in_flight):
+            # views of caller's buffers may be reused before the queued
+            # request is written (e.g. if no response is expected)
+            data = [bytes(buf) if isinstance(buf, memoryview) else buf
+                    for buf in data]
+            self._queued.append((data, item))
+        else:
+            self._write(data, item)
+
         if not expect_response:
             fut.set_result(None)
             return fut
-        self._requests.append((correlation_id, request.RESPONSE_TYPE, fut))
-        return asyncio.wait_for(fut, self._request_timeout, loop=self._loop)
+        deadline = self._loop.time() + self._request_timeout
+        self._timeouts.append((deadline, fut))
+        if self._timeout_handle is None:
+            self._timeout_handle = self._loop.call_at(
+                deadline, self._expire_requests)
+        return fut
+
+    def _expire_requests(self):
+        """Fail all requests with passed deadline with TimeoutError"""
+        self._timeout_handle = None
+        now = self._loop.time()
+        timeouts = self._timeouts
+        while timeouts:
+            deadline, fut = timeouts[0]
+            if deadline > now and not fut.done():
+                self._timeout_handle = self._loop.call_at(
+                    deadline, self._expire_requests)
+                break
+            timeouts.popleft()
+            if not fut.done():
+                fut.set_exception(asyncio.TimeoutError())
+
+    def _write(self, data, item):
+        try:
+            self._writer.writelines(data)
+        except OSError as err:
+            conn_exc = Errors.ConnectionError(
+                "Connection at {0}:{1} broken: {2}".format(
+                    self._host, self._port, err))
+            self.close(reason=conn_exc)
+            raise conn_exc
+        if item is not None:
+            self._requests.append(item)
+        if self._writer.transport.get_write_buffer_size():
+            # Socket buffer is full, hold next requests in the queue till
+            # transport is drained
+            self._drain_task = ensure_future(self._drain(), loop=self._loop)
+
+    def _flush_queue(self):
+        """Write queued requests while there is room in the window"""
+        while self._queued and self._drain_task is None:
+            data, item = self._queued[0]
+            if item is not None:
+                if item[2].done():
+                    # Timed out while in the queue, no need to send it
+                    self._queued.popleft()
+                    continue
+                if len(self._requests) >= self._max_in_flight:
+                    break
+            self._queued.popleft()
+            try:
+                self._write(data, item)
+            except Errors.ConnectionError:
+                break
+
+    @asyncio.coroutine
+    def _drain(self):
+        try:
+            yield from self._writer.drain()
+        except OSError as exc:
+            self._drain_task = None
+            conn_exc = Errors.ConnectionError(
+                "Connection at {0}:{1} broken".format(self._host, self._port))
+            conn_exc.__cause__ = exc
+            self.close(reason=conn_exc)
+        else:
+            self._drain_task = None
+            self._flush_queue()
 
     def connected(self):
         return bool(self._reader is not None and not self._reader.at_eof())
 
-    def close(self):
+    def close(self, reason=None):
         if self._reader is not None:
             self._writer.close()
             self._writer = self._reader = None
-            self._read_task.cancel()
-            for _, _, fut in self._requests:
-                fut.cancel()
-            self._requests = []
+            if self._read_task is not None:
+                self._read_task.cancel()
+                self._read_task = None
+            if self._drain_task is not None:
+                self._drain_task.cancel()
+                self._drain_task = None
+            if self._timeout_handle is not None:
+                self._timeout_handle.cancel()
+                self._timeout_handle = None
+            self._timeouts.clear()
+            futures = [fut for _, _, fut in self._requests]
+            futures.extend(item[2] for _, item in self._queued if item)
+            for fut in futures:
+                if fut.done():
+                    continue
+                if reason is None:
+                    fut.cancel()
+                else:
+                    fut.set_exception(reason)
+            self._requests.clear()
+            self._queued.clear()
 
     @asyncio.coroutine
     def _read(self):
@@ -108,42 +268,146 @@ class AIOKafkaConnection:
                 size, = self.HEADER.unpack(resp)
 
                 resp = yield from self._reader.readexactly(size)
-
-                recv_correlation_id, = self.HEADER.unpack(resp[:4])
-
-                correlation_id, resp_type, fut = self._requests.pop(0)
-                if (self._api_version == (0, 8, 2) and
-                        resp_type is GroupCoordinatorResponse and
-                        correlation_id != 0 and recv_correlation_id == 0):
-                    self.log.warning(
-                        'Kafka 0.8.2 quirk -- GroupCoordinatorResponse'
-                        ' coorelation id does not match request. This'
-                        ' should go away once at least one topic has been'
-                        ' initialized on the broker')
-
-                elif correlation_id != recv_correlation_id:
-                    error = Errors.CorrelationIdError(
-                        'Correlation ids do not match: sent {}, recv {}'
-                        .format(correlation_id, recv_correlation_id))
-                    if not fut.done():
-                        fut.set_exception(error)
-                    self.close()
+                if not self._handle_frame(resp):
                     break
-
-                if not fut.done():
-                    response = resp_type.decode(resp[4:])
-                    self.log.debug('%s Response %d: %s',
-                                   self, correlation_id, response)
-                    fut.set_result(response)
         except (OSError, EOFError, ConnectionError) as exc:
-            conn_exc = Errors.ConnectionError(
-                "Connection at {0}:{1} broken".format(self._host, self._port))
-            conn_exc.__cause__ = exc
-            conn_exc.__context__ = exc
-            for _, _, fut in self._requests:
-                fut.set_exception(conn_exc)
+            self._connection_lost(exc)
+
+    def _handle_frame(self, resp):
+        """Process response frame (without size prefix)
+
+        `resp` is a bytes-like object, it is not referenced after return.
+        Returns False if connection was closed.
+        """
+        recv_correlation_id, = self.HEADER.unpack_from(resp)
+        self._last_activity = self._loop.time()
+
+        correlation_id, resp_type, fut = self._requests.popleft()
+        if self._timeouts and self._timeouts[0][1] is fut:
+            self._timeouts.popleft()
+        if (self._api_version == (0, 8, 2) and
+                resp_type is GroupCoordinatorResponse and
+                correlation_id != 0 and recv_correlation_id == 0):
+            self.log.warning(
+                'Kafka 0.8.2 quirk -- GroupCoordinatorResponse'
+                ' coorelation id does not match request. This'
+                ' should go away once at least one topic has been'
+                ' initialized on the broker')
+
+        elif correlation_id != recv_correlation_id:
+            error = Errors.CorrelationIdError(
+                'Correlation ids do not match: sent {}, recv {}'
+                .format(correlation_id, recv_correlation_id))
+            if not fut.done():
+                fut.set_exception(error)
             self.close()
+            return False
+
+        if not fut.done():
+            # BytesIO shares `bytes` and copies anything else just once, so
+            # the body is not sliced out of the frame beforehand
+            body = io.BytesIO(resp)
+            body.seek(4)
+            response = resp_type.decode(body)
+            self.log.debug('%s Response %d: %s',
+                           self, correlation_id, response)
+            fut.set_result(response)
+
+        # There is a free slot in the in-flight window now
+        self._flush_queue()
+        return self._reader is not None
+
+    def _connection_lost(self, exc):
+        conn_exc = Errors.ConnectionError(
+            "Connection at {0}:{1} broken".format(self._host, self._port))
+        conn_exc.__cause__ = exc
+        conn_exc.__context__ = exc
+        self.close(reason=conn_exc)
 
     def _next_correlation_id(self):
         self._correlation_id = (self._correlation_id + 1) % 2**31
         return self._correlation_id
+
+
+class KafkaProtocol(asyncio.streams.FlowControlMixin, asyncio.Protocol):
+    """Protocol splitting received data into Kafka response frames
+
+    Chunks received from the transport are parsed in place: every complete
+    frame is handed to the connection as a memoryview of the chunk (or of
+    the receive buffer), without slicing it into new bytes objects. Only an
+    incomplete frame at the end of a chunk is copied into the receive
+    buffer, which is reused for the connection lifetime and grown to the
+    size of the pending frame at once. Buffer grown for a frame larger than
+    `MAX_RETAINED_BUFFER_SIZE` is shrunk when the frame is consumed.
+    """
+
+    HEADER = AIOKafkaConnection.HEADER
+    MAX_RETAINED_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, conn, *, loop):
+        super().__init__(loop=loop)
+        self._conn = conn
+        self._buffer = bytearray()
+        self._filled = 0
+        self._eof = False
+
+    def at_eof(self):
+        return self._eof
+
+    def _is_current(self):
+        # Connection may be reconnected with a new protocol already
+        return self._conn._reader is self
+
+    def data_received(self, data):
+        if not self._is_current():
+            return
+        if self._filled:
+            end = self._filled + len(data)
+            self._buffer[self._filled:end] = data
+            consumed = self._split_frames(self._buffer, end)
+            rest = end - consumed
+            if consumed and rest:
+                self._buffer[:rest] = self._buffer[consumed:end]
+        else:
+            consumed = self._split_frames(data, len(data))
+            rest = len(data) - consumed
+            if rest:
+                with memoryview(data) as view:
+                    self._buffer[:rest] = view[consumed:]
+        self._filled = rest
+        needed = rest
+        if rest >= self.HEADER.size:
+            size, = self.HEADER.unpack_from(self._buffer)
+            needed = self.HEADER.size + size
+        if len(self._buffer) > max(needed, self.MAX_RETAINED_BUFFER_SIZE):
+            # Don't hold memory of an oversized frame consumed already
+            self._buffer = self._buffer[:rest]
+        missing = needed - len(self._buffer)
+        if missing > 0:
+            self._buffer.extend(bytes(missing))
+
+    def _split_frames(self, data, end):
+        pos = 0
+        with memoryview(data) as view:
+            while end - pos >= self.HEADER.size:
+                size, = self.HEADER.unpack_from(data, pos)
+                frame_end = pos + self.HEADER.size + size
+                if frame_end > end:
+                    break
+                with view[pos + self.HEADER.size:frame_end] as frame:
+                    alive = self._conn._handle_frame(frame)
+                pos = frame_end
+                if not alive:
+                    break
+        return pos
+
+    def eof_received(self):
+        self._eof = True
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self._eof = True
+        self._buffer = bytearray()
+        self._filled = 0
+        if self._is_current():
+            self._conn._connection_lost(exc or EOFError())
@@ -65,8 +65,9 @@ class AIOKafkaConsumer(object):
         retry_backoff_ms (int): Milliseconds to backoff when retrying on
             errors. Default: 100.
         reconnect_backoff_ms (int): The amount of time in milliseconds to
-            wait before attempting to reconnect to a given host.
-            Default: 50.
+            wait before attempting to reconnect to a given host. The
+            backoff is doubled after every consecutive failure (up to
+            `reconnect_backoff_max_ms`) and randomized by 20%. Default: 50.
         auto_offset_reset (str): A policy for resetting offsets on
             OffsetOutOfRange errors: 'earliest' will move to the oldest
             available message, 'latest' will move to the most recent. Any
@@ -105,10 +106,33 @@ class AIOKafkaConsumer(object):
             using Kafka's group managementment facilities. Default: 30000
         consumer_timeout_ms (int): number of millisecond to poll available
             fetched messages. Default: 100
+        max_in_flight_requests_per_connection (int): Requests are pipelined
+            to kafka brokers up to this number of maximum requests per
+            broker connection. Default: 5.
+        use_frame_protocol (bool): read responses with a protocol that splits
+            them into frames in place and decodes them from memoryviews,
+            instead of copying every frame out of a StreamReader.
+            Default: False.
+        metadata_cache_dir (str): directory to store snapshot of cluster
+            metadata and detected broker version in. If set, `start()` uses
+            the snapshot for the same bootstrap servers at once and
+            revalidates it in the background. Default: None.
+        connections_max_idle_ms (int): Close idle connections after the
+            number of milliseconds specified by this config. None disables
+            closing. Default: 540000.
+        reconnect_backoff_max_ms (int): The maximum amount of time in
+            milliseconds to wait when reconnecting to a broker.
+            Default: 1000.
         api_version (str): specify which kafka API version to use.
             AIOKafkaConsumer supports Kafka API versions >=0.9 only.
             If set to 'auto', will attempt to infer the broker version by
             probing various APIs. Default: auto
+        client (AIOKafkaClient): client to share cluster metadata and
+            connections with other producers and consumers. It is started
+            by the first of them and closed when the last one is stopped.
+            If set, options used only to create a client, like
+            `bootstrap_servers`, `client_id`, `metadata_max_age_ms` and
+            connection options, are ignored. Default: None.
 
 
     Note:
@@ -136,13 +160,29 @@ class AIOKafkaConsumer(object):
                  heartbeat_interval_ms=3000,
                  session_timeout_ms=30000,
                  consumer_timeout_ms=100,
-                 api_version='auto'):
+                 max_in_flight_requests_per_connection=5,
+                 use_frame_protocol=False,
+                 metadata_cache_dir=None,
+                 connections_max_idle_ms=540000,
+                 reconnect_backoff_max_ms=1000,
+                 api_version='auto',
+                 client=None):
         if api_version not in ('auto', '0.9'):
             raise ValueError("Unsupported Kafka API version")
-        self._client = AIOKafkaClient(
-            loop=loop, bootstrap_servers=bootstrap_servers,
-            client_id=client_id, metadata_max_age_ms=metadata_max_age_ms,
-            request_timeout_ms=request_timeout_ms)
+        if client is None:
+            client = AIOKafkaClient(
+                loop=loop, bootstrap_servers=bootstrap_servers,
+                client_id=client_id, metadata_max_age_ms=metadata_max_age_ms,
+                request_timeout_ms=request_timeout_ms,
+                max_in_flight_requests_per_connection=(
+                    max_in_flight_requests_per_connection),
+                use_frame_protocol=use_frame_protocol,
+                metadata_cache_dir=metadata_cache_dir,
+                retry_backoff_ms=retry_backoff_ms,
+                connections_max_idle_ms=connections_max_idle_ms,
+                reconnect_backoff_ms=reconnect_backoff_ms,
+                reconnect_backoff_max_ms=reconnect_backoff_max_ms)
+        self._client = client
 
         self._api_version = api_version
         self._group_id = group_id
@@ -166,12 +206,12 @@ class AIOKafkaConsumer(object):
         self._topics = topics
 
         if topics:
-            self._client.set_topics(topics)
+            self._client.set_topics(topics, owner=self._subscription)
             self._subscription.subscribe(topics=topics)
 
     @asyncio.coroutine
     def start(self):
-        yield from self._client.bootstrap()
+        yield from self._client.acquire(self._subscription)
 
         # Check Broker Version if not set explicitly
         if self._api_version == 'auto':
@@ -246,7 +286,8 @@ class AIOKafkaConsumer(object):
         """
         self._subscription.assign_from_user(partitions)
         self._on_change_subscription()
-        self._client.set_topics([tp.topic for tp in partitions])
+        self._client.set_topics([tp.topic for tp in partitions],
+                                owner=self._subscription)
 
     def assignment(self):
         """Get the TopicPartitions currently assigned to this consumer.
@@ -274,7 +315,7 @@ class AIOKafkaConsumer(object):
             yield from self._coordinator.close()
         if self._fetcher:
             yield from self._fetcher.close()
-        yield from self._client.close()
+        yield from self._client.release(self._subscription)
         log.debug("The KafkaConsumer has closed.")
 
     @asyncio.coroutine
@@ -496,10 +537,11 @@ class AIOKafkaConsumer(object):
 
         # regex will need all topic metadata
         if pattern is not None:
-            self._client.set_topics([])
+            self._client.set_topics(None, owner=self._subscription)
             log.debug("Subscribed to topic pattern: %s", pattern)
         else:
-            self._client.set_topics(self._subscription.group_subscription())
+            self._client.set_topics(self._subscription.group_subscription(),
+                                    owner=self._subscription)
             log.debug("Subscribed to topic(s): %s", topics)
 
     def subscription(self):
@@ -513,7 +555,7 @@ class AIOKafkaConsumer(object):
     def unsubscribe(self):
         """Unsubscribe from all topics and clear all assigned partitions."""
         self._subscription.unsubscribe()
-        self._client.set_topics([])
+        self._client.set_topics([], owner=self._subscription)
         log.debug(
             "Unsubscribed all topics or patterns and assigned partitions")
 
@@ -0,0 +1,709 @@
+"""In-process stand-in for a Kafka cluster.
+
+:class:`FakeKafkaCluster` starts one or more asyncio TCP servers that speak
+the subset of the Kafka 0.8/0.9 wire protocol used by aiokafka (Metadata,
+Produce, Fetch, Offset, GroupCoordinator, JoinGroup, SyncGroup, Heartbeat,
+LeaveGroup, OffsetCommit, OffsetFetch and ListGroups). Partitions are kept
+as in-memory logs, so producers and consumers can be exercised (and
+benchmarked) without a JVM or Docker.
+
+Example usage:
+
+.. code:: python
+
+    cluster = FakeKafkaCluster(loop=loop, num_nodes=3, num_partitions=4)
+    yield from cluster.start()
+    producer = AIOKafkaProducer(
+        loop=loop, bootstrap_servers=cluster.bootstrap_servers)
+    ...
+    yield from cluster.stop()
+"""
+import asyncio
+import bisect
+import collections
+import io
+import logging
+import struct
+import uuid
+import zlib
+
+import kafka.common as Errors
+from kafka.codec import gzip_encode, snappy_encode, lz4_encode
+from kafka.common import TopicPartition
+from kafka.protocol.admin import ListGroupsRequest, ListGroupsResponse
+from kafka.protocol.commit import (
+    GroupCoordinatorRequest, GroupCoordinatorResponse,
+    OffsetCommitRequest_v0, OffsetCommitRequest_v1, OffsetCommitRequest_v2,
+    OffsetCommitResponse,
+    OffsetFetchRequest_v0, OffsetFetchRequest_v1, OffsetFetchResponse)
+from kafka.protocol.fetch import FetchRequest, FetchResponse
+from kafka.protocol.group import (
+    HeartbeatRequest, HeartbeatResponse,
+    JoinGroupRequest, JoinGroupResponse,
+    LeaveGroupRequest, LeaveGroupResponse,
+    SyncGroupRequest, SyncGroupResponse)
+from kafka.protocol.message import Message, MessageSet
+from kafka.protocol.metadata import MetadataRequest, MetadataResponse
+from kafka.protocol.offset import (
+    OffsetRequest, OffsetResponse, OffsetResetStrategy)
+from kafka.protocol.produce import ProduceRequest, ProduceResponse
+from kafka.protocol.types import Int16, Int32, String
+
+from aiokafka import ensure_future
+
+__all__ = ['FakeKafkaCluster', 'FakeKafkaNode']
+
+log = logging.getLogger(__name__)
+
+
+REQUEST_TYPES = {
+    (req.API_KEY, req.API_VERSION): req for req in (
+        ProduceRequest, FetchRequest, OffsetRequest, MetadataRequest,
+        OffsetCommitRequest_v0, OffsetCommitRequest_v1,
+        OffsetCommitRequest_v2, OffsetFetchRequest_v0, OffsetFetchRequest_v1,
+        GroupCoordinatorRequest, JoinGroupRequest, HeartbeatRequest,
+        LeaveGroupRequest, SyncGroupRequest, ListGroupsRequest)
+}
+
+COMPRESSORS = {
+    Message.CODEC_GZIP: gzip_encode,
+    Message.CODEC_SNAPPY: snappy_encode,
+    Message.CODEC_LZ4: lz4_encode,
+}
+
+NO_ERROR = Errors.NoError.errno
+
+
+class PartitionLog:
+    """Append-only in-memory log of a single topic-partition
+
+    Every entry is an encoded MessageSet item (offset, size, message). A
+    compressed wrapper message is a single entry that covers all of its
+    inner offsets, as in a real broker log.
+    """
+
+    def __init__(self, tp, leader):
+        self.tp = tp
+        self.leader = leader
+        self.highwater = 0
+        self._last_offsets = []
+        self._entries = []
+
+    def append(self, messages):
+        """Append decoded MessageSet items, assigning absolute offsets
+
+        Returns:
+            int: offset of the first appended message
+        """
+        base_offset = self.highwater
+        for _, _, msg in messages:
+            if msg.is_compressed():
+                inner = msg.decompress()
+                inner = [(self.highwater + i, 0, m)
+                         for i, (_, _, m) in enumerate(inner)]
+                self.highwater += len(inner)
+                codec = msg.attributes & Message.CODEC_MASK
+                payload = COMPRESSORS[codec](
+                    MessageSet.encode(inner, size=False))
+                msg = Message(payload, attributes=codec)
+            else:
+                self.highwater += 1
+            last_offset = self.highwater - 1
+            self._last_offsets.append(last_offset)
+            self._entries.append(
+                MessageSet.encode([(last_offset, 0, msg)], size=False))
+        return base_offset
+
+    def read(self, offset, max_bytes):
+        """Return encoded MessageSet bytes starting at `offset`
+
+        As a real broker does, the last message is truncated if it does not
+        fit into `max_bytes`.
+        """
+        idx = bisect.bisect_left(self._last_offsets, offset)
+        chunks = []
+        size = 0
+        for entry in self._entries[idx:]:
+            if size + len(entry) > max_bytes:
+                chunks.append(entry[:max_bytes - size])
+                break
+            chunks.append(entry)
+            size += len(entry)
+        return b''.join(chunks)
+
+
+class _GroupMember:
+    def __init__(self, member_id, client_id, session_timeout, protocols):
+        self.member_id = member_id
+        self.client_id = client_id
+        self.session_timeout = session_timeout
+        self.protocols = protocols
+        self.assignment = b''
+        self.expire_handle = None
+
+    def metadata(self, protocol):
+        for name, metadata in self.protocols:
+            if name == protocol:
+                return metadata
+        return b''
+
+
+class FakeGroup:
+    """Simplified version of the broker-side consumer group state machine
+    (Empty -> PreparingRebalance -> AwaitingSync -> Stable)"""
+
+    def __init__(self, group_id, *, loop):
+        self.group_id = group_id
+        self.loop = loop
+        self.members = collections.OrderedDict()
+        self.generation = 0
+        self.protocol_type = ''
+        self.protocol = ''
+        self.leader_id = ''
+        self.state = 'Empty'
+        self.offsets = {}
+        self._join_waiters = {}
+        self._sync_waiters = {}
+        self._rebalance_handle = None
+
+    @asyncio.coroutine
+    def join(self, member_id, client_id, session_timeout,
+             protocol_type, protocols):
+        if member_id and member_id not in self.members:
+            return JoinGroupResponse(
+                Errors.UnknownMemberIdError.errno, -1, '', '', member_id, [])
+        if not member_id:
+            member_id = '{}-{}'.format(client_id, uuid.uuid4())
+            self.members[member_id] = _GroupMember(
+                member_id, client_id, session_timeout, protocols)
+        member = self.members[member_id]
+        member.protocols = protocols
+        member.session_timeout = session_timeout
+        self._cancel_expire(member)
+        self.protocol_type = protocol_type
+
+        self._prepare_rebalance()
+        fut = asyncio.Future(loop=self.loop)
+        self._join_waiters[member_id] = fut
+        if set(self._join_waiters) == set(self.members):
+            self._complete_join()
+        elif self._rebalance_handle is None:
+            timeout = max(m.session_timeout for m in self.members.values())
+            self._rebalance_handle = self.loop.call_later(
+                timeout / 1000, self._complete_join)
+        return (yield from fut)
+
+    @asyncio.coroutine
+    def sync(self, member_id, generation, group_assignment):
+        error = self._check_member(member_id, generation)
+        if error is not None:
+            return SyncGroupResponse(error, b'')
+        if self.state == 'PreparingRebalance':
+            return SyncGroupResponse(
+                Errors.RebalanceInProgressError.errno, b'')
+        member = self.members[member_id]
+        self._touch(member)
+        if self.state == 'Stable':
+            return SyncGroupResponse(NO_ERROR, member.assignment)
+
+        if member_id == self.leader_id:
+            assignments = dict(group_assignment)
+            for m in self.members.values():
+                m.assignment = assignments.get(m.member_id, b'')
+            self.state = 'Stable'
+            for waiter_id, fut in self._sync_waiters.items():
+                if not fut.done():
+                    fut.set_result(SyncGroupResponse(
+                        NO_ERROR, self.members[waiter_id].assignment))
+            self._sync_waiters.clear()
+            return SyncGroupResponse(NO_ERROR, member.assignment)
+
+        fut = asyncio.Future(loop=self.loop)
+        self._sync_waiters[member_id] = fut
+        return (yield from fut)
+
+    def heartbeat(self, member_id, generation):
+        error = self._check_member(member_id, generation)
+        if error is not None:
+            return error
+        self._touch(self.members[member_id])
+        if self.state != 'Stable':
+            return Errors.RebalanceInProgressError.errno
+        return NO_ERROR
+
+    def leave(self, member_id):
+        if member_id not in self.members:
+            return Errors.UnknownMemberIdError.errno
+        self._remove_member(member_id)
+        return NO_ERROR
+
+    def check_commit(self, member_id, generation):
+        if generation == -1 and not member_id:
+            # Simple (non group-managed) consumer
+            return NO_ERROR
+        error = self._check_member(member_id, generation)
+        if error is not None:
+            return error
+        if self.state == 'AwaitingSync':
+            # as Kafka does, commits are rejected until the leader's
+            # assignment is synced; commits of the previous generation are
+            # still accepted while the group is waiting for members to rejoin
+            # (PreparingRebalance)
+            return Errors.RebalanceInProgressError.errno
+        self._touch(self.members[member_id])
+        return NO_ERROR
+
+    def _check_member(self, member_id, generation):
+        if member_id not in self.members:
+            return Errors.UnknownMemberIdError.errno
+        if generation != self.generation:
+            return Errors.IllegalGenerationError.errno
+        return None
+
+    def _touch(self, member):
+        self._cancel_expire(member)
+        member.expire_handle = self.loop.call_later(
+            member.session_timeout / 1000,
+            self._remove_member, member.member_id)
+
+    def _cancel_expire(self, member):
+        if member.expire_handle is not None:
+            member.expire_handle.cancel()
+            member.expire_handle = None
+
+    def _remove_member(self, member_id):
+        member = self.members.pop(member_id, None)
+        if member is None:
+            return
+        log.debug("Member %s left group %s", member_id, self.group_id)
+        self._cancel_expire(member)
+        fut = self._sync_waiters.pop(member_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(SyncGroupResponse(
+                Errors.UnknownMemberIdError.errno, b''))
+        if not self.members:
+            self.state = 'Empty'
+            self.leader_id = ''
+            return
+        self._prepare_rebalance()
+        if self._join_waiters and \
+                set(self._join_waiters) == set(self.members):
+            self._complete_join()
+
+    def _prepare_rebalance(self):
+        if self.state == 'PreparingRebalance':
+            return
+        self.state = 'PreparingRebalance'
+        for fut in self._sync_waiters.values():
+            if not fut.done():
+                fut.set_result(SyncGroupResponse(
+                    Errors.RebalanceInProgressError.errno, b''))
+        self._sync_waiters.clear()
+
+    def _complete_join(self):
+        if self._rebalance_handle is not None:
+            self._rebalance_handle.cancel()
+            self._rebalance_handle = None
+        # members, that did not rejoin in time, are dropped from the group
+        for member_id in list(self.members):
+            if member_id not in self._join_waiters:
+                self._cancel_expire(self.members.pop(member_id))
+        if not self.members:
+            self.state = 'Empty'
+            return
+
+        self.generation += 1
+        if self.leader_id not in self.members:
+            self.leader_id = next(iter(self.members))
+        leader = self.members[self.leader_id]
+        for name, _ in leader.protocols:
+            if all(name in dict(m.protocols)
+                   for m in self.members.values()):
+                self.protocol = name
+                break
+        self.state = 'AwaitingSync'
+
+        members = [(m.member_id, m.metadata(self.protocol))
+                   for m in self.members.values()]
+        waiters, self._join_waiters = self._join_waiters, {}
+        for member_id, fut in waiters.items():
+            self._touch(self.members[member_id])
+            if fut.done():
+                continue
+            fut.set_result(JoinGroupResponse(
+                NO_ERROR, self.generation, self.protocol, self.leader_id,
+                member_id, members if member_id == self.leader_id else []))
+
+
+class FakeKafkaNode:
+    """Single fake broker, that serves requests for a FakeKafkaCluster"""
+
+    HEADER = struct.Struct('>i')
+
+    def __init__(self, cluster, node_id, host, port, *, loop):
+        self.cluster = cluster
+        self.node_id = node_id
+        self.host = host
+        self.port = port
+        self._loop = loop
+        self._server = None
+        self._handlers = set()
+
+    def __repr__(self):
+        return '<FakeKafkaNode id={0.node_id} host={0.host} port={0.port}>'\
+            .format(self)
+
+    @property
+    def running(self):
+        return self._server is not None
+
+    @asyncio.coroutine
+    def start(self):
+        self._server = yield from asyncio.start_server(
+            self._handle_connection, self.host, self.port, loop=self._loop)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+        log.debug("Started %s", self)
+
+    @asyncio.coroutine
+    def stop(self):
+        """Stop listening and drop all client connections"""
+        if self._server is None:
+            return
+        self._server.close()
+        yield from self._server.wait_closed()
+        self._server = None
+        for task in list(self._handlers):
+            task.cancel()
+        if self._handlers:
+            yield from asyncio.wait(self._handlers, loop=self._loop)
+        log.debug("Stopped %s", self)
+
+    def _handle_connection(self, reader, writer):
+        task = ensure_future(self._serve(reader, writer), loop=self._loop)
+        self._handlers.add(task)
+        task.add_done_callback(self._handlers.discard)
+
+    @asyncio.coroutine
+    def _serve(self, reader, writer):
+        # Like Kafka, process requests of one connection strictly in order
+        try:
+            while True:
+                size, = self.HEADER.unpack((yield from reader.readexactly(4)))
+                data = io.BytesIO((yield from reader.readexactly(size)))
+                api_key = Int16.decode(data)
+                api_version = Int16.decode(data)
+                correlation_id = Int32.decode(data)
+                client_id = String('utf-8').decode(data)
+                request_type = REQUEST_TYPES.get((api_key, api_version))
+                if request_type is None:
+                    # Kafka drops the connection on unknown API requests
+                    log.debug("Unsupported API key %s (version %s)",
+                              api_key, api_version)
+                    break
+                request = request_type.decode(data)
+                response = yield from self.cluster.handle_request(
+                    self, request, client_id)
+                if response is None:
+                    continue
+                resp = self.HEADER.pack(correlation_id) + response.encode()
+                writer.write(self.HEADER.pack(len(resp)) + resp)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            writer.close()
+
+
+class FakeKafkaCluster:
+    """Pure-asyncio stand-in for a Kafka cluster with in-memory partitions
+
+    Keyword Arguments:
+        loop: asyncio event loop
+        num_nodes (int): number of fake brokers (node ids start from 0).
+            Default: 1
+        host (str): interface to listen on and to advertise in metadata.
+            Default: '127.0.0.1'
+        ports (list of int): ports to listen on, one per node. Random free
+            ports are used if not set. Default: None
+        num_partitions (int): number of partitions of automatically created
+            topics. Default: 1
+        auto_create_topics (bool): create topics requested in Metadata
+            requests, as `auto.create.topics.enable` does. Default: True
+        message_max_bytes (int): largest message the fake broker accepts.
+            Default: 1000012
+    """
+
+    def __init__(self, *, loop, num_nodes=1, host='127.0.0.1', ports=None,
+                 num_partitions=1, auto_create_topics=True,
+                 message_max_bytes=1000012):
+        if ports is None:
+            ports = [0] * num_nodes
+        assert len(ports) == num_nodes, 'one port per node is required'
+        self._loop = loop
+        self._num_partitions = num_partitions
+        self._auto_create_topics = auto_create_topics
+        self._message_max_bytes = message_max_bytes
+        self.nodes = [FakeKafkaNode(self, node_id, host, port, loop=loop)
+                      for node_id, port in enumerate(ports)]
+        self._topics = collections.OrderedDict()
+        self._groups = {}
+        self._data_waiter = asyncio.Future(loop=loop)
+
+    @property
+    def bootstrap_servers(self):
+        return ['{}:{}'.format(node.host, node.port) for node in self.nodes]
+
+    @asyncio.coroutine
+    def start(self):
+        for node in self.nodes:
+            yield from node.start()
+
+    @asyncio.coroutine
+    def stop(self):
+        for node in self.nodes:
+            yield from node.stop()
+
+    def create_topic(self, topic, num_partitions=None):
+        """Create topic with partition leaders spread over all nodes"""
+        if topic in self._topics:
+            return
+        if num_partitions is None:
+            num_partitions = self._num_partitions
+        shift = len(self._topics)
+        self._topics[topic] = [
+            PartitionLog(TopicPartition(topic, partition),
+                         (shift + partition) % len(self.nodes))
+            for partition in range(num_partitions)]
+
+    def set_leader(self, topic, partition, node_id):
+        """Move partition leadership, e.g. to simulate a broker failover"""
+        self._topics[topic][partition].leader = node_id
+
+    def partition_log(self, topic, partition):
+        return self._topics[topic][partition]
+
+    def coordinator_for(self, group_id):
+        return self.nodes[zlib.crc32(group_id.encode()) % len(self.nodes)]
+
+    @asyncio.coroutine
+    def handle_request(self, node, request, client_id):
+        handler = getattr(self, '_handle_' + type(request).__name__)
+        resp = handler(node, request, client_id)
+        if isinstance(resp, asyncio.Future) or asyncio.iscoroutine(resp):
+            resp = yield from resp
+        return resp
+
+    def _get_log(self, node, topic, partition):
+        partitions = self._topics.get(topic)
+        if partitions is None or not 0 <= partition < len(partitions):
+            return None, Errors.UnknownTopicOrPartitionError.errno
+        partition_log = partitions[partition]
+        if partition_log.leader != node.node_id:
+            return None, Errors.NotLeaderForPartitionError.errno
+        return partition_log, NO_ERROR
+
+    def _get_group(self, node, group_id):
+        if self.coordinator_for(group_id) is not node:
+            return None, Errors.NotCoordinatorForGroupError.errno
+        group = self._groups.get(group_id)
+        if group is None:
+            group = self._groups[group_id] = FakeGroup(
+                group_id, loop=self._loop)
+        return group, NO_ERROR
+
+    def _notify_data(self):
+        if not self._data_waiter.done():
+            self._data_waiter.set_result(None)
+        self._data_waiter = asyncio.Future(loop=self._loop)
+
+    def _handle_MetadataRequest(self, node, request, client_id):
+        brokers = [(n.node_id, n.host, n.port)
+                   for n in self.nodes if n.running]
+        topics = []
+        for topic in (request.topics or list(self._topics)):
+            if topic not in self._topics:
+                if self._auto_create_topics:
+                    # like Kafka, report the first request as "in progress"
+                    self.create_topic(topic)
+                    error = Errors.LeaderNotAvailableError.errno
+                else:
+                    error = Errors.UnknownTopicOrPartitionError.errno
+                topics.append((error, topic, []))
+                continue
+            partitions = []
+            for p_log in self._topics[topic]:
+                if self.nodes[p_log.leader].running:
+                    leader = p_log.leader
+                    p_error = NO_ERROR
+                else:
+                    leader = -1
+                    p_error = Errors.LeaderNotAvailableError.errno
+                partitions.append((p_error, p_log.tp.partition, leader,
+                                   [p_log.leader], [p_log.leader]))
+            topics.append((NO_ERROR, topic, partitions))
+        return MetadataResponse(brokers, topics)
+
+    def _handle_ProduceRequest(self, node, request, client_id):
+        topics = []
+        appended = False
+        for topic, partitions in request.topics:
+            results = []
+            for partition, messages in partitions:
+                p_log, error = self._get_log(node, topic, partition)
+                offset = -1
+                messages = [item for item in messages
+                            if not isinstance(item[2], bytes)]
+                if p_log is not None:
+                    if any(size > self._message_max_bytes
+                           for _, size, _ in messages):
+                        error = Errors.MessageSizeTooLargeError.errno
+                    else:
+                        offset = p_log.append(messages)
+                        appended = True
+                results.append((partition, error, offset))
+            topics.append((topic, results))
+        if appended:
+            self._notify_data()
+        if request.required_acks == 0:
+            return None
+        return ProduceResponse(topics)
+
+    def _read_fetch(self, node, request):
+        topics = []
+        total = 0
+        for topic, partitions in request.topics:
+            results = []
+            for partition, offset, max_bytes in partitions:
+                p_log, error = self._get_log(node, topic, partition)
+                data = b''
+                highwater = -1
+                if p_log is not None:
+                    highwater = p_log.highwater
+                    if not 0 <= offset <= highwater:
+                        error = Errors.OffsetOutOfRangeError.errno
+                    else:
+                        data = p_log.read(offset, max_bytes)
+                        total += len(data)
+                results.append((partition, error, highwater, data))
+            topics.append((topic, results))
+        return topics, total
+
+    @asyncio.coroutine
+    def _handle_FetchRequest(self, node, request, client_id):
+        deadline = self._loop.time() + request.max_wait_time / 1000
+        while True:
+            topics, total = self._read_fetch(node, request)
+            timeout = deadline - self._loop.time()
+            if total >= request.min_bytes or timeout <= 0:
+                break
+            yield from asyncio.wait(
+                [self._data_waiter], timeout=timeout, loop=self._loop)
+
+        # MessageSet type encodes BytesIO payloads as already encoded data
+        return FetchResponse([
+            (topic, [(partition, error, highwater,
+                      io.BytesIO(Int32.encode(len(data)) + data))
+                     for partition, error, highwater, data in partitions])
+            for topic, partitions in topics])
+
+    def _handle_OffsetRequest(self, node, request, client_id):
+        topics = []
+        for topic, partitions in request.topics:
+            results = []
+            for partition, timestamp, max_offsets in partitions:
+                p_log, error = self._get_log(node, topic, partition)
+                offsets = []
+                if p_log is not None:
+                    if timestamp == OffsetResetStrategy.EARLIEST:
+                        offsets = [0]
+                    else:
+                        offsets = [p_log.highwater]
+                results.append((partition, error, offsets[:max_offsets]))
+            topics.append((topic, results))
+        return OffsetResponse(topics)
+
+    def _handle_GroupCoordinatorRequest(self, node, request, client_id):
+        coordinator = self.coordinator_for(request.consumer_group)
+        return GroupCoordinatorResponse(
+            NO_ERROR, coordinator.node_id, coordinator.host, coordinator.port)
+
+    def _handle_ListGroupsRequest(self, node, request, client_id):
+        groups = [(group.group_id, group.protocol_type)
+                  for group in self._groups.values()
+                  if self.coordinator_for(group.group_id) is node]
+        return ListGroupsResponse(NO_ERROR, groups)
+
+    @asyncio.coroutine
+    def _handle_JoinGroupRequest(self, node, request, client_id):
+        group, error = self._get_group(node, request.group)
+        if group is None:
+            return JoinGroupResponse(
+                error, -1, '', '', request.member_id, [])
+        return (yield from group.join(
+            request.member_id, client_id, request.session_timeout,
+            request.protocol_type, request.group_protocols))
+
+    @asyncio.coroutine
+    def _handle_SyncGroupRequest(self, node, request, client_id):
+        group, error = self._get_group(node, request.group)
+        if group is None:
+            return SyncGroupResponse(error, b'')
+        return (yield from group.sync(
+            request.member_id, request.generation_id,
+            request.group_assignment))
+
+    def _handle_HeartbeatRequest(self, node, request, client_id):
+        group, error = self._get_group(node, request.group)
+        if group is not None:
+            error = group.heartbeat(request.member_id, request.generation_id)
+        return HeartbeatResponse(error)
+
+    def _handle_LeaveGroupRequest(self, node, request, client_id):
+        group, error = self._get_group(node, request.group)
+        if group is not None:
+            error = group.leave(request.member_id)
+        return LeaveGroupResponse(error)
+
+    def _commit_offsets(self, node, request, check_member):
+        group, error = self._get_group(node, request.consumer_group)
+        if group is not None and check_member:
+            error = group.check_commit(
+                request.consumer_id, request.consumer_group_generation_id)
+        topics = []
+        for topic, partitions in request.topics:
+            results = []
+            for partition_data in partitions:
+                partition, offset = partition_data[:2]
+                if error == NO_ERROR:
+                    group.offsets[TopicPartition(topic, partition)] = \
+                        (offset, partition_data[-1])
+                results.append((partition, error))
+            topics.append((topic, results))
+        return OffsetCommitResponse(topics)
+
+    def _handle_OffsetCommitRequest_v0(self, node, request, client_id):
+        return self._commit_offsets(node, request, check_member=False)
+
+    def _handle_OffsetCommitRequest_v1(self, node, request, client_id):
+        return self._commit_offsets(node, request, check_member=True)
+
+    def _handle_OffsetCommitRequest_v2(self, node, request, client_id):
+        return self._commit_offsets(node, request, check_member=True)
+
+    def _handle_OffsetFetchRequest_v0(self, node, request, client_id):
+        group, error = self._get_group(node, request.consumer_group)
+        topics = []
+        for topic, partitions in request.topics:
+            results = []
+            for partition in partitions:
+                offset, metadata = -1, ''
+                if group is not None:
+                    offset, metadata = group.offsets.get(
+                        TopicPartition(topic, partition), (-1, ''))
+                results.append((partition, offset, metadata, error))
+            topics.append((topic, results))
+        return OffsetFetchResponse(topics)
+
+    _handle_OffsetFetchRequest_v1 = _handle_OffsetFetchRequest_v0
@@ -10,6 +10,7 @@ from kafka.protocol.message import PartialMessage
 from kafka.protocol.offset import OffsetRequest, OffsetResetStrategy
 
 from aiokafka import ensure_future
+from aiokafka.client import ConnectionGroup
 
 log = logging.getLogger(__name__)
 
@@ -216,7 +217,8 @@ class Fetcher:
                 # Create and send fetch requests
                 requests, timeout = self._create_fetch_requests()
                 for node_id, request in requests:
-                    node_ready = yield from self._client.ready(node_id)
+                    node_ready = yield from self._client.ready(
+                        node_id, group=ConnectionGroup.FETCH)
                     if not node_ready:
                         # We will request it on next routine
                         continue
@@ -272,8 +274,9 @@ class Fetcher:
         backoff_by_nodes = collections.defaultdict(list)
 
         fetchable_partitions = self._subscriptions.fetchable_partitions()
+        leader_for_partition = self._client.cluster.leader_for_partition
         for tp in fetchable_partitions:
-            node_id = self._client.cluster.leader_for_partition(tp)
+            node_id = leader_for_partition(tp)
             if tp in self._records:
                 record = self._records[tp]
                 # Calculate backoff for this node if data is only recently
@@ -393,7 +396,7 @@ class Fetcher:
 
                 elif error_type in (Errors.NotLeaderForPartitionError,
                                     Errors.UnknownTopicOrPartitionError):
-                    self._client.force_metadata_update()
+                    self._client.force_metadata_update([tp.topic])
                 elif error_type is Errors.OffsetOutOfRangeError:
                     fetch_offset = fetch_offsets[tp]
                     if self._subscriptions.has_default_offset_reset_policy():
@@ -512,7 +515,8 @@ class Fetcher:
                 if not error.retriable:
                     raise error
                 if error.invalid_metadata:
-                    yield from self._client.force_metadata_update()
+                    yield from self._client.force_metadata_update(
+                        [partition.topic])
             else:
                 return offset
 
@@ -15,6 +15,7 @@ from kafka.protocol.group import (
     LeaveGroupRequest, SyncGroupRequest)
 
 from aiokafka import ensure_future
+from aiokafka.client import ConnectionGroup
 
 log = logging.getLogger(__name__)
 
@@ -122,6 +123,8 @@ class GroupCoordinator(object):
         """Close the coordinator, leave the current group
         and reset local generation/memberId."""
         self._closing.set_result(None)
+        # client (and cluster metadata) may be shared with other consumers
+        self._cluster.remove_listener(self._handle_metadata_update)
         if self._auto_commit_task:
             yield from self._auto_commit_task
             self._auto_commit_task = None
@@ -178,7 +181,8 @@ class GroupCoordinator(object):
                     topics.append(topic)
 
             self._subscription.change_subscription(topics)
-            self._client.set_topics(self._subscription.group_subscription())
+            # all topics are still tracked to discover new matching ones
+            self._client.set_topics(None, owner=self._subscription)
 
         # check if there are any changes to the metadata which should trigger
         # a rebalance
@@ -238,7 +242,11 @@ class GroupCoordinator(object):
         # the group is interested in, which ensures that all metadata changes
         # will eventually be seen
         self._subscription.group_subscribe(all_subscribed_topics)
-        self._client.set_topics(self._subscription.group_subscription())
+        if self._subscription.subscribed_pattern:
+            self._client.set_topics(None, owner=self._subscription)
+        else:
+            self._client.set_topics(self._subscription.group_subscription(),
+                                    owner=self._subscription)
 
         log.debug("Performing %s assignment for subscriptions %s",
                   assignor.name, member_metadata)
@@ -534,7 +542,8 @@ class GroupCoordinator(object):
         if self.coordinator_id is None:
             return True
 
-        ready = yield from self._client.ready(self.coordinator_id)
+        ready = yield from self._client.ready(
+            self.coordinator_id, group=ConnectionGroup.COORDINATION)
         return not ready
 
     @asyncio.coroutine
@@ -543,7 +552,7 @@ class GroupCoordinator(object):
         (and we have an active connection -- java client uses unsent queue).
         """
         while (yield from self.coordinator_unknown()):
-            node_id = self._client.get_random_node()
+            node_id = self._client.least_loaded_node()
             if node_id is None or not (yield from self._client.ready(node_id)):
                 raise Errors.NoBrokersAvailable()
 
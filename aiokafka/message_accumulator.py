@@ -1,5 +1,7 @@
 import io
+import heapq
 import asyncio
+import itertools
 import collections
 
 from kafka.common import (KafkaError,
@@ -8,28 +10,189 @@ from kafka.common import (KafkaError,
                           LeaderNotAvailableError)
 from kafka.producer.buffer import MessageSetBuffer
 from kafka.protocol.message import Message
+from kafka.protocol.types import Int32, Int64
 
 RecordMetadata = collections.namedtuple(
     'RecordMetadata', ['topic', 'partition', 'topic_partition', 'offset'])
 
+BatchMetadata = collections.namedtuple(
+    'BatchMetadata', ['topic', 'partition', 'topic_partition', 'base_offset',
+                      'record_count'])
+
 
 class ProducerClosed(KafkaError):
     pass
 
 
+def compress_message_set(encoder, attributes, messages):
+    """Return message set of a single message wrapping compressed
+    `messages`, the same as `MessageSetBuffer.close()` builds.
+
+    It is a module level function, so it can be run in process pool.
+    """
+    encoded = Message(encoder(messages), attributes=attributes).encode()
+    return b''.join([
+        Int32.encode(len(encoded) + 12), Int64.encode(0),
+        Int32.encode(len(encoded)), encoded])
+
+
+class BatchBuffer:
+    """Writable stream on top of a preallocated bytearray
+
+    It is used by MessageSetBuffer instead of io.BytesIO, so memory of
+    drained batches can be reused by next batches.
+    """
+    __slots__ = ('_buf', '_pos', '_size')
+
+    def __init__(self, buf):
+        self._buf = buf
+        self._pos = 0
+        self._size = 0
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self._size
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def write(self, data):
+        end = self._pos + len(data)
+        # grows bytearray if data does not fit into it
+        self._buf[self._pos:end] = data
+        self._pos = end
+        if end > self._size:
+            self._size = end
+        return len(data)
+
+    def read(self, size=-1):
+        end = self._size
+        if size >= 0:
+            end = min(end, self._pos + size)
+        data = bytes(memoryview(self._buf)[self._pos:end])
+        self._pos = max(end, self._pos)
+        return data
+
+    def detach(self):
+        """Return underlying bytearray, the stream can't be used after"""
+        buf, self._buf = self._buf, None
+        return buf
+
+
+class BufferPool:
+    """Pool of batch buffers with a limit on total memory of them
+
+    Released buffers are kept in a free list and reused by next batches.
+    If the limit is reached `allocate()` waits until some buffer is
+    released.
+
+    Arguments:
+        memory (int or None): maximum memory of all buffers in bytes,
+            None means no limit
+        poolable_size (int): size of buffers
+        loop (asyncio.BaseEventLoop): asyncio event loop
+    """
+    def __init__(self, memory, poolable_size, loop):
+        self._poolable_size = poolable_size
+        self._loop = loop
+        self._free = collections.deque()
+        self._waiters = collections.deque()
+        # memory not allocated for any buffer yet
+        self._unallocated = memory
+
+    @property
+    def available_memory(self):
+        """Memory that can be allocated without waiting or None if it is
+        not limited"""
+        if self._unallocated is None:
+            return None
+        return self._unallocated + len(self._free) * self._poolable_size
+
+    @asyncio.coroutine
+    def allocate(self, timeout):
+        """Return bytearray of `poolable_size` bytes
+
+        Raises:
+            KafkaTimeoutError: if no buffer is released in `timeout` seconds
+        """
+        if self._free:
+            return self._free.popleft()
+        if self._unallocated is None:
+            return bytearray(self._poolable_size)
+        if self._unallocated >= self._poolable_size:
+            self._unallocated -= self._poolable_size
+            return bytearray(self._poolable_size)
+
+        waiter = asyncio.Future(loop=self._loop)
+        self._waiters.append(waiter)
+        try:
+            yield from asyncio.wait(
+                [waiter], timeout=timeout, loop=self._loop)
+        except asyncio.CancelledError:
+            if waiter.done():
+                # buffer was already given to this waiter, return it
+                self.deallocate(waiter.result())
+            else:
+                # so `deallocate()` skips this waiter
+                waiter.cancel()
+            raise
+        if not waiter.done():
+            waiter.cancel()
+            raise KafkaTimeoutError(
+                "Failed to allocate memory within the configured"
+                " max blocking time")
+        return waiter.result()
+
+    def deallocate(self, buf):
+        """Return buffer to the pool"""
+        # buffer could be grown by oversized message
+        if len(buf) > self._poolable_size:
+            del buf[self._poolable_size:]
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(buf)
+                return
+        self._free.append(buf)
+
+
 class MessageBatch:
     """This class incapsulate operations with batch of produce messages"""
-    def __init__(self, tp, records, ttl, loop):
+    def __init__(self, tp, records, ttl, loop, on_error=None, linger=0,
+                 compressor=None, pool=None):
         self._tp = tp
         self._records = records
+        # BufferPool the records buffer is returned to when batch is done
+        self._pool = pool
+        # Buffer of the records, the batch is sent from it after drain
+        self._buffer = None
         self._relative_offset = 0
+        # Number of messages without any future, delivery errors of them
+        # are reported to `on_error` callback
+        self._untracked = 0
+        self._on_error = on_error
         self._loop = loop
         self._ttl = ttl
         self._ctime = loop.time()
+        # Batch is ready for drain when it is full or linger time is passed
+        self._linger_deadline = self._ctime + linger
+        # Content of batch, set on drain
+        self._data = None
+        # (encoder, attributes) if batch is compressed after drain by
+        # `compress()` instead of `MessageSetBuffer.close()`
+        self._compressor = compressor
 
         # Waiters
         # Set when messages are delivered to Kafka based on ACK setting
         self._msg_futures = []
+        # Set when the whole batch is delivered, created on demand
+        self._batch_future = None
+        # Set when batch is processed (delivered or failed)
+        self._deliver_waiter = asyncio.Future(loop=loop)
         # Set when sender takes this batch
         self._drain_waiter = asyncio.Future(loop=loop)
 
@@ -49,8 +212,53 @@ class MessageBatch:
         self._relative_offset += 1
         return future
 
+    def append_without_future(self, key, value):
+        """Append message (key and value) to batch, the message is tracked
+        by `batch_future()` only
+
+        Returns:
+            False if batch is full, True otherwise
+        """
+        if not self._records.has_room_for(key, value):
+            return False
+        self._records.append(self._relative_offset, Message(value, key=key))
+        self._relative_offset += 1
+        return True
+
+    def append_untracked(self, key, value):
+        """Append message (key and value) to batch without any future
+
+        Returns:
+            False if batch is full, True otherwise
+        """
+        if not self.append_without_future(key, value):
+            return False
+        self._untracked += 1
+        return True
+
+    def batch_future(self):
+        """Return future that will be resolved with BatchMetadata when the
+        whole batch is delivered"""
+        if self._batch_future is None:
+            self._batch_future = asyncio.Future(loop=self._loop)
+        return self._batch_future
+
     def done(self, base_offset=None, exception=None):
         """Resolve all pending futures"""
+        self._release_buffer()
+        if exception is not None and self._untracked and \
+                self._on_error is not None:
+            self._on_error(exception, self._tp, self._untracked)
+        self._deliver_waiter.set_result(None)
+        if self._batch_future is not None:
+            if exception is not None:
+                self._batch_future.set_exception(exception)
+            elif base_offset is None:
+                self._batch_future.set_result(None)
+            else:
+                self._batch_future.set_result(BatchMetadata(
+                    self._tp.topic, self._tp.partition, self._tp,
+                    base_offset, self._relative_offset))
         for relative_offset, future in enumerate(self._msg_futures):
             if exception is not None:
                 future.set_exception(exception)
@@ -61,9 +269,20 @@ class MessageBatch:
                                      self._tp, base_offset+relative_offset)
                 future.set_result(res)
 
+    def _release_buffer(self):
+        if self._buffer is None:
+            return
+        if isinstance(self._data, memoryview):
+            # bytearray can't be resized by pool while it is exported
+            self._data.release()
+        self._data = None
+        buf, self._buffer = self._buffer, None
+        if self._pool is not None:
+            self._pool.deallocate(buf)
+
     def wait_deliver(self):
         """Wait until all message from this batch is processed"""
-        return asyncio.wait(self._msg_futures, loop=self._loop)
+        return self._deliver_waiter
 
     def wait_drain(self):
         """Wait until all message from this batch is processed"""
@@ -73,13 +292,54 @@ class MessageBatch:
         """Check that batch is expired or not"""
         return (self._loop.time() - self._ctime) > self._ttl
 
+    @property
+    def linger_deadline(self):
+        return self._linger_deadline
+
+    @property
+    def expire_at(self):
+        """Time (in terms of loop.time()) after which batch is expired"""
+        return self._ctime + self._ttl
+
     def drain_ready(self):
-        """Compress batch to be ready for send"""
+        """Compress batch to be ready for send
+
+        The batch is sent from its buffer without copying, the buffer is
+        returned to the pool when the batch is done.
+        """
         self._records.close()
+        buf = self._records.buffer()
+        # compressed data may be shorter than written before, so size of
+        # message set is taken from its header
+        size = Int32.decode(buf)
+        self._buffer = buf.detach()
+        self._data = memoryview(self._buffer)[:size + 4]
         self._drain_waiter.set_result(None)
 
+    @property
+    def needs_compression(self):
+        return self._compressor is not None
+
+    @asyncio.coroutine
+    def compress(self, executor):
+        """Compress drained batch in executor"""
+        encoder, attributes = self._compressor
+        # memoryview can't be pickled for process pool executor
+        data = yield from self._loop.run_in_executor(
+            executor, compress_message_set, encoder, attributes,
+            bytes(self._data[4:]))
+        if self._buffer is not None:
+            # only compressed data is sent, so the buffer is not needed
+            self._release_buffer()
+            self._data = data
+        self._compressor = None
+
     def data(self):
-        return self._records.buffer()
+        return io.BytesIO(self._data)
+
+    def data_bytes(self):
+        """Return encoded message set of drained batch"""
+        return self._data
 
 
 class MessageAccumulator:
@@ -88,93 +348,328 @@ class MessageAccumulator:
     Producer add messages to this accumulator and background send task
     gets batches per nodes for process it.
     """
-    def __init__(self, cluster, batch_size, compression_type, batch_ttl, loop):
+    def __init__(self, cluster, batch_size, compression_type, batch_ttl, loop,
+                 on_error=None, linger_time=0, buffer_memory=None,
+                 compression_executor=None, max_compressing_batches=4,
+                 on_batch_rollover=None):
         self._batches = {}
+        # called with topic-partition when its batch is full or drained
+        self._on_batch_rollover = on_batch_rollover
+        self._pool = BufferPool(buffer_memory, batch_size, loop)
+        self._compression_executor = compression_executor
+        self._compressor = None
+        if compression_executor is not None and \
+                compression_type is not None:
+            checker, encoder, attributes = \
+                MessageSetBuffer._COMPRESSORS[compression_type]
+            assert checker(), 'Compression Libraries Not Found'
+            self._compressor = (encoder, attributes)
+            # batches are compressed by sender after drain
+            compression_type = None
+        self._compressing = asyncio.Semaphore(
+            max_compressing_batches, loop=loop)
+        self._on_error = on_error
         self._cluster = cluster
         self._batch_size = batch_size
         self._compression_type = compression_type
         self._batch_ttl = batch_ttl
         self._loop = loop
+        self._linger_time = linger_time
+        # heap of (linger deadline, tp) of lingering batches, entries of
+        # drained batches are discarded lazily in `_pop_lingered()`
+        self._linger_heap = []
+        # Batches ready for drain (full, lingered or closing) are kept by
+        # partition leaders, so drain does not scan not ready batches:
+        # tp -> leader node id or None if leader is unknown
+        self._ready = {}
+        # node id -> {tp: batch}
+        self._ready_by_node = {}
+        # {tp: batch} of ready batches without known leader
+        self._unknown_leader = {}
+        # leaders of ready batches are looked up again when cluster metadata
+        # generation is changed (or always, if cluster has no generation)
+        self._ready_generation = None
+        # heap of (expire_at, seq, tp, batch) of batches without known
+        # leader, to fail them when they are expired
+        self._expiry_heap = []
+        self._expiry_seq = itertools.count()
         self._wait_data_future = asyncio.Future(loop=loop)
         self._closed = False
 
     @asyncio.coroutine
     def close(self):
         self._closed = True
+        # Lingering batches are drained without waiting on close
+        for tp, batch in list(self._batches.items()):
+            self._mark_ready(tp, batch)
         for batch in list(self._batches.values()):
             yield from batch.wait_deliver()
 
     @asyncio.coroutine
-    def add_message(self, tp, key, value, timeout):
+    def add_message(self, tp, key, value, timeout, no_future=False):
         """Add message to batch by topic-partition
         If batch is already full this method waits (`ttl` seconds maximum)
         until batch is drained by send task
+
+        If `no_future` is set, no future is created for the message and
+        None is returned, delivery errors are reported to `on_error`
+        callback of accumulator.
         """
         if self._closed:
             # this can happen when producer is closing but try to send some
             # messages in async task
             raise ProducerClosed()
 
+        batch = yield from self._get_batch(tp, timeout)
+        if no_future:
+            if batch.append_untracked(key, value):
+                return None
+        else:
+            future = batch.append(key, value)
+            if future is not None:
+                return future
+        # Batch is full, can't append data atm,
+        # waiting until batch per topic-partition is drained
+        timeout = yield from self._wait_drain(batch, timeout)
+        return (yield from self.add_message(
+            tp, key, value, timeout, no_future))
+
+    @asyncio.coroutine
+    def add_batch(self, tp, messages, timeout):
+        """Add messages (key and value pairs) to batches by topic-partition
+
+        Unlike `add_message` no future is created per message. If batch is
+        full this method waits (`ttl` seconds maximum) until it is drained
+        and continues with a new batch.
+
+        Returns:
+            list of futures, one per batch messages were added to, that will
+            be resolved with BatchMetadata when the batch is delivered
+
+        Raises:
+            KafkaTimeoutError, ProducerClosed: if the rest of messages can't
+            be added. Messages added before are sent anyway, the exception
+            has `futures` attribute with futures of their batches and
+            `accepted` attribute with the number of them.
+        """
+        futures = []
+        accepted = 0
+        try:
+            if self._closed:
+                raise ProducerClosed()
+            batch = yield from self._get_batch(tp, timeout)
+            for key, value in messages:
+                while not batch.append_without_future(key, value):
+                    futures.append(batch.batch_future())
+                    timeout = yield from self._wait_drain(batch, timeout)
+                    if self._closed:
+                        raise ProducerClosed()
+                    batch = yield from self._get_batch(tp, timeout)
+                accepted += 1
+        except (KafkaTimeoutError, ProducerClosed) as err:
+            # future of the batch with the last accepted message is
+            # collected already
+            err.futures = futures
+            err.accepted = accepted
+            raise
+        futures.append(batch.batch_future())
+        return futures
+
+    @asyncio.coroutine
+    def _get_batch(self, tp, timeout):
+        """Return current batch of topic-partition or create a new one
+        waiting (`timeout` seconds maximum) for a free buffer"""
         batch = self._batches.get(tp)
         if not batch:
+            buf = yield from self._pool.allocate(timeout)
+            batch = self._batches.get(tp)
+            if batch or self._closed:
+                # batch was created or producer was closed while waiting
+                self._pool.deallocate(buf)
+                if self._closed:
+                    raise ProducerClosed()
+                return batch
             message_set_buffer = MessageSetBuffer(
-                io.BytesIO(), self._batch_size, self._compression_type)
+                BatchBuffer(buf), self._batch_size, self._compression_type)
             batch = MessageBatch(
-                tp, message_set_buffer, self._batch_ttl, self._loop)
+                tp, message_set_buffer, self._batch_ttl, self._loop,
+                on_error=self._on_error, linger=self._linger_time,
+                compressor=self._compressor, pool=self._pool)
             self._batches[tp] = batch
 
-            if not self._wait_data_future.done():
-                # Wakeup sender task if it waits for data
-                self._wait_data_future.set_result(None)
+            if self._linger_time:
+                entry = (batch.linger_deadline, tp)
+                heapq.heappush(self._linger_heap, entry)
+                # Sender task already sleeps until an earlier deadline
+                # unless this batch is the first one to become ready
+                if self._linger_heap[0] is entry:
+                    self.wakeup_sender()
+            else:
+                self._mark_ready(tp, batch)
+        return batch
+
+    def wakeup_sender(self):
+        if not self._wait_data_future.done():
+            # Wakeup sender task if it waits for data
+            self._wait_data_future.set_result(None)
 
-        future = batch.append(key, value)
-        if future is None:
-            # Batch is full, can't append data atm,
-            # waiting until batch per topic-partition is drained
-            start = self._loop.time()
-            yield from asyncio.wait(
-                [batch.wait_drain()], timeout=timeout, loop=self._loop)
-            timeout -= self._loop.time() - start
-            if timeout <= 0:
-                raise KafkaTimeoutError()
-            return (yield from self.add_message(tp, key, value, timeout))
-        return future
+    @asyncio.coroutine
+    def _wait_drain(self, batch, timeout):
+        """Wait until full batch is drained by sender task
+
+        Returns:
+            the rest of timeout
+        """
+        # Batch is full, so it's ready for drain regardless of linger time
+        self._mark_ready(batch._tp, batch)
+        if self._on_batch_rollover is not None:
+            self._on_batch_rollover(batch._tp)
+        start = self._loop.time()
+        yield from asyncio.wait(
+            [batch.wait_drain()], timeout=timeout, loop=self._loop)
+        timeout -= self._loop.time() - start
+        if timeout <= 0:
+            raise KafkaTimeoutError()
+        return timeout
 
     def data_waiter(self):
         """return waiter future that will be resolved when accumulator contain
         some data for drain"""
         return self._wait_data_future
 
+    def next_linger_deadline(self):
+        """return time (in terms of loop.time()) when the next lingering
+        batch becomes ready for drain or None if there is no such batch"""
+        if self._closed:
+            return None
+        return self._pop_lingered(self._loop.time())
+
+    def _pop_lingered(self, now):
+        """Mark batches with passed linger deadline ready and return the
+        next deadline"""
+        heap = self._linger_heap
+        while heap:
+            deadline, tp = heap[0]
+            batch = self._batches.get(tp)
+            if batch is not None and batch.linger_deadline == deadline \
+                    and tp not in self._ready:
+                if deadline > now:
+                    return deadline
+                self._mark_ready(tp, batch)
+            # batch is drained, full or ready already
+            heapq.heappop(heap)
+        return None
+
+    def _mark_ready(self, tp, batch):
+        if tp not in self._ready:
+            self._add_ready(tp, batch)
+            self.wakeup_sender()
+
+    def _add_ready(self, tp, batch, unknown_leader=False):
+        leader = self._cluster.leader_for_partition(tp)
+        if leader is None or leader == -1:
+            self._ready[tp] = None
+            self._unknown_leader[tp] = batch
+            if not unknown_leader:
+                heapq.heappush(self._expiry_heap, (
+                    batch.expire_at, next(self._expiry_seq), tp, batch))
+        else:
+            self._ready[tp] = leader
+            self._ready_by_node.setdefault(leader, {})[tp] = batch
+
+    def _remove_ready(self, tp):
+        leader = self._ready.pop(tp)
+        if leader is None:
+            del self._unknown_leader[tp]
+        else:
+            node_batches = self._ready_by_node[leader]
+            del node_batches[tp]
+            if not node_batches:
+                del self._ready_by_node[leader]
+
+    def _update_ready_leaders(self):
+        generation = getattr(self._cluster, 'generation', None)
+        if generation is not None and generation == self._ready_generation:
+            return
+        self._ready_generation = generation
+        ready = [(tp, self._batches[tp], leader is None)
+                 for tp, leader in self._ready.items()]
+        self._ready.clear()
+        self._ready_by_node.clear()
+        self._unknown_leader.clear()
+        for tp, batch, unknown_leader in ready:
+            self._add_ready(tp, batch, unknown_leader)
+
+    @asyncio.coroutine
+    def compress_batches(self, batches):
+        """Compress drained batches in compression executor (no more than
+        `max_compressing_batches` at once).
+
+        Batches that failed to compress are resolved with the error and
+        removed from `batches` dict.
+        """
+        if self._compressor is None:
+            return
+        tps = [tp for tp, batch in batches.items() if batch.needs_compression]
+        results = yield from asyncio.gather(
+            *[self._compress(batches[tp]) for tp in tps],
+            loop=self._loop, return_exceptions=True)
+        for tp, res in zip(tps, results):
+            if isinstance(res, Exception):
+                batches.pop(tp).done(exception=res)
+
+    @asyncio.coroutine
+    def _compress(self, batch):
+        with (yield from self._compressing):
+            yield from batch.compress(self._compression_executor)
+
     def _pop_batch(self, tp):
         batch = self._batches.pop(tp)
         batch.drain_ready()
+        if self._on_batch_rollover is not None:
+            self._on_batch_rollover(tp)
         return batch
 
-    def drain_by_nodes(self, ignore_nodes):
-        """return batches by nodes"""
-        nodes = collections.defaultdict(dict)
-        unknown_leaders_exist = False
-        for tp in list(self._batches.keys()):
-            leader = self._cluster.leader_for_partition(tp)
-            if leader is None or leader == -1:
-                if self._batches[tp].expired():
-                    # batch is for partition is expired and still no leader,
-                    # so set exception for batch and pop it
-                    batch = self._pop_batch(tp)
-                    if leader is None:
-                        err = NotLeaderForPartitionError()
-                    else:
-                        err = LeaderNotAvailableError()
-                    batch.done(exception=err)
-                unknown_leaders_exist = True
-                continue
-            elif ignore_nodes and leader in ignore_nodes:
+    def unknown_leader_topics(self):
+        """return topics of ready batches without known partition leader"""
+        return {tp.topic for tp in self._unknown_leader}
+
+    def drain_by_nodes(self, ignore_nodes, muted_partitions=()):
+        """return batches by nodes, except batches for `ignore_nodes` and
+        `muted_partitions` (i.e. partitions with a batch in flight).
+        Batches that are not full are drained after linger time only."""
+        now = self._loop.time()
+        self._pop_lingered(now)
+        self._update_ready_leaders()
+
+        heap = self._expiry_heap
+        while heap and heap[0][0] < now:
+            _, _, tp, batch = heapq.heappop(heap)
+            if self._unknown_leader.get(tp) is not batch:
+                # batch is drained or got leader
                 continue
+            # batch is for partition is expired and still no leader,
+            # so set exception for batch and pop it
+            self._remove_ready(tp)
+            self._pop_batch(tp)
+            if self._cluster.leader_for_partition(tp) is None:
+                err = NotLeaderForPartitionError()
+            else:
+                err = LeaderNotAvailableError()
+            batch.done(exception=err)
 
-            batch = self._pop_batch(tp)
-            nodes[leader][tp] = batch
+        nodes = collections.defaultdict(dict)
+        for leader, node_batches in list(self._ready_by_node.items()):
+            if ignore_nodes and leader in ignore_nodes:
+                continue
+            for tp in list(node_batches):
+                if muted_partitions and tp in muted_partitions:
+                    continue
+                self._remove_ready(tp)
+                nodes[leader][tp] = self._pop_batch(tp)
+        unknown_leaders_exist = bool(self._unknown_leader)
 
-        # all batches are drained from accumulator
+        # all ready batches are drained from accumulator
         # so create "wait data" future again for waiting new data in send
         # task
         if not self._wait_data_future.done():
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from kafka.common import TopicPartition
+from kafka.protocol.metadata import MetadataResponse
+
+__all__ = ['MetadataCache']
+
+log = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """On-disk snapshot of cluster metadata and broker version
+
+    The snapshot is stored as JSON file in `cache_dir`, one file per set of
+    bootstrap servers, so clients of different clusters can share the
+    directory.
+
+    Arguments:
+        cache_dir (str): directory to keep cache files in
+        hosts (list): (host, port) pairs of bootstrap servers
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_dir, hosts):
+        self._servers = sorted('{}:{}'.format(host, port)
+                               for host, port in hosts)
+        key = hashlib.sha1(','.join(self._servers).encode()).hexdigest()
+        self._path = os.path.join(
+            cache_dir, 'aiokafka-metadata-{}.json'.format(key))
+
+    @property
+    def path(self):
+        return self._path
+
+    def load(self):
+        """Read snapshot from disk
+
+        Returns:
+            (MetadataResponse, api_version) or None if there is no valid
+            snapshot for bootstrap servers
+        """
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data['version'] != self.VERSION or \
+                    data['bootstrap_servers'] != self._servers:
+                return None
+            brokers = [tuple(broker) for broker in data['brokers']]
+            topics = [
+                (0, topic, [(0, partition, leader, [], [])
+                            for partition, leader in partitions])
+                for topic, partitions in data['topics']]
+            return MetadataResponse(brokers, topics), data['api_version']
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            log.warning('Unable to read metadata cache %s: %s',
+                        self._path, err)
+            return None
+
+    def save(self, cluster, api_version):
+        """Write snapshot of ClusterMetadata and broker version to disk"""
+        topics = []
+        for topic in sorted(cluster.topics()):
+            partitions = [
+                (partition, cluster.leader_for_partition(
+                    TopicPartition(topic, partition)))
+                for partition in sorted(cluster.partitions_for_topic(topic))]
+            topics.append((topic, partitions))
+        data = {
+            'version': self.VERSION,
+            'bootstrap_servers': self._servers,
+            'brokers': sorted(
+                (b.nodeId, b.host, b.port) for b in cluster.brokers()),
+            'topics': topics,
+            'api_version': api_version,
+        }
+        cache_dir = os.path.dirname(self._path)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            try:
+                with open(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                # Readers never see partially written file
+                os.replace(tmp_path, self._path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as err:
+            log.warning('Unable to write metadata cache %s: %s',
+                        self._path, err)
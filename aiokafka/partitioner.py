@@ -0,0 +1,60 @@
+import random
+
+from kafka.partitioner.default import DefaultPartitioner
+
+__all__ = ['StickyPartitioner']
+
+
+class StickyPartitioner:
+    """Partitioner that sends messages without key to one ("sticky")
+    partition of topic until batch for this partition is full or drained
+
+    Random partitioning of messages without key spreads them across all
+    partitions, so batches are filled slowly and many small produce
+    requests are sent. Sticky partition is switched to another random
+    partition when MessageAccumulator reports that the batch is rolled over.
+
+    Messages with key are partitioned by `partitioner`.
+
+    Keyword Arguments:
+        partitioner (callable): partitioner for messages with key, called as
+            partitioner(key_bytes, all_partitions, available_partitions).
+            Default: DefaultPartitioner().
+    """
+
+    def __init__(self, partitioner=DefaultPartitioner()):
+        self._partitioner = partitioner
+        # topic -> sticky partition
+        self._sticky = {}
+
+    def __call__(self, key, all_partitions, available_partitions):
+        return self._partitioner(key, all_partitions, available_partitions)
+
+    def partition(self, topic, key, all_partitions, available_partitions,
+                  *, partitions_set=None, available_set=None):
+        """Return partition for message of topic
+
+        Sticky partition is checked against `partitions_set` and
+        `available_set` (frozensets of all and available partitions, e.g.
+        from TopicRoute) if they are given, instead of scanning sequences.
+        """
+        if key is not None:
+            return self._partitioner(
+                key, all_partitions, available_partitions)
+        if available_partitions:
+            partitions, choices = available_set, available_partitions
+        else:
+            partitions, choices = partitions_set, all_partitions
+        if partitions is None:
+            partitions = choices
+        partition = self._sticky.get(topic)
+        if partition is None or partition not in partitions:
+            partition = random.choice(choices)
+            self._sticky[topic] = partition
+        return partition
+
+    def on_batch_rollover(self, tp):
+        """Called by MessageAccumulator when batch of topic-partition is full
+        or drained"""
+        if self._sticky.get(tp.topic) == tp.partition:
+            del self._sticky[tp.topic]
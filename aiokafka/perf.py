@@ -0,0 +1,254 @@
+"""Producer and consumer performance tests
+
+Modeled on Kafka's kafka-producer-perf-test and kafka-consumer-perf-test
+tools, so numbers can be compared with the ones of the Java client::
+
+    python -m aiokafka.perf producer --topic perf --num-records 100000 \\
+        --record-size 100 --bootstrap-servers localhost:9092
+    python -m aiokafka.perf consumer --topic perf --num-records 100000 \\
+        --bootstrap-servers localhost:9092
+
+Producer latency is measured from the `send()` call till delivery
+acknowledgement. Every produced record carries its send time (if
+`--record-size` is at least 8 bytes), so consumer latency is the end-to-end
+latency from the `send()` call till the record is returned by `getmany()`;
+it is meaningful only if the consumer runs concurrently with the producer.
+
+With `--fake-nodes N` both tests run against an in-process
+:class:`~aiokafka.fake_broker.FakeKafkaCluster` instead of real brokers
+(the consumer test produces its records first in this case).
+"""
+import argparse
+import asyncio
+import random
+import string
+import struct
+import sys
+import time
+
+from aiokafka.consumer import AIOKafkaConsumer
+from aiokafka.fake_broker import FakeKafkaCluster
+from aiokafka.producer import AIOKafkaProducer
+
+__all__ = ['PerfStats', 'producer_perf', 'consumer_perf', 'main']
+
+TIMESTAMP = struct.Struct('>d')
+MB = 1024 * 1024
+
+
+class PerfStats:
+    """Throughput and latency statistics of a performance test
+
+    At most `max_samples` latencies are kept (every n-th record is sampled)
+    so long runs do not grow memory without bound.
+    """
+
+    def __init__(self, num_records, max_samples=500000):
+        self._sampling = max(1, num_records // max_samples)
+        self._latencies = []
+        self.records = 0
+        self.bytes = 0
+        self.start = self.end = time.monotonic()
+
+    def record(self, size, latency=None):
+        if latency is not None and self.records % self._sampling == 0:
+            self._latencies.append(latency)
+        self.records += 1
+        self.bytes += size
+        self.end = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return max(self.end - self.start, 1e-9)
+
+    def percentile(self, p):
+        """Latency percentile in milliseconds (None if no samples)"""
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        idx = min(int(len(latencies) * p), len(latencies) - 1)
+        return latencies[idx] * 1000
+
+    def summary(self, action):
+        line = ('{} records {}, {:.1f} records/sec ({:.2f} MB/sec)'.format(
+            self.records, action, self.records / self.elapsed,
+            self.bytes / MB / self.elapsed))
+        if self._latencies:
+            line += (
+                ', {:.2f} ms avg latency, {:.2f} ms max latency,'
+                ' {:.2f} ms 50th, {:.2f} ms 99th, {:.2f} ms 99.9th.'.format(
+                    sum(self._latencies) / len(self._latencies) * 1000,
+                    max(self._latencies) * 1000,
+                    self.percentile(0.5), self.percentile(0.99),
+                    self.percentile(0.999)))
+        return line
+
+
+def _payload(record_size):
+    letters = string.ascii_uppercase.encode()
+    return bytes(random.choice(letters) for _ in range(record_size))
+
+
+@asyncio.coroutine
+def producer_perf(args, *, loop):
+    """Send `args.num_records` records and return PerfStats"""
+    producer = AIOKafkaProducer(
+        loop=loop, bootstrap_servers=args.bootstrap_servers,
+        acks=args.acks, compression_type=args.compression_type,
+        linger_ms=args.linger_ms, max_batch_size=args.max_batch_size,
+        use_frame_protocol=args.use_frame_protocol,
+        connections_per_broker=args.connections_per_broker)
+    yield from producer.start()
+    stats = PerfStats(args.num_records)
+    payload = _payload(args.record_size)
+    stamped = args.record_size >= TIMESTAMP.size
+    done = asyncio.Future(loop=loop)
+    pending = 0
+
+    def on_delivery(t0, fut):
+        nonlocal pending
+        pending -= 1
+        if not fut.cancelled() and fut.exception() is None:
+            stats.record(args.record_size, time.monotonic() - t0)
+        if not pending and not done.done():
+            done.set_result(None)
+
+    try:
+        for i in range(args.num_records):
+            if stamped:
+                value = TIMESTAMP.pack(time.time()) + \
+                    payload[TIMESTAMP.size:]
+            else:
+                value = payload
+            t0 = time.monotonic()
+            fut = yield from producer.send(args.topic, value)
+            pending += 1
+            fut.add_done_callback(lambda fut, t0=t0: on_delivery(t0, fut))
+            if args.throughput > 0:
+                # throttle to the requested records/sec
+                ahead = (i + 1) / args.throughput - (t0 - stats.start)
+                if ahead > 0:
+                    yield from asyncio.sleep(ahead, loop=loop)
+        if pending:
+            yield from done
+    finally:
+        yield from producer.stop()
+    return stats
+
+
+@asyncio.coroutine
+def consumer_perf(args, *, loop):
+    """Consume `args.num_records` records and return PerfStats"""
+    consumer = AIOKafkaConsumer(
+        args.topic, loop=loop, bootstrap_servers=args.bootstrap_servers,
+        group_id=args.group_id, auto_offset_reset='earliest',
+        fetch_max_wait_ms=args.fetch_max_wait_ms,
+        max_partition_fetch_bytes=args.max_partition_fetch_bytes,
+        use_frame_protocol=args.use_frame_protocol)
+    yield from consumer.start()
+    stats = PerfStats(args.num_records)
+    last_data = time.monotonic()
+    try:
+        while stats.records < args.num_records:
+            data = yield from consumer.getmany(timeout_ms=100)
+            now = time.monotonic()
+            if not data:
+                if now - last_data > args.timeout_ms / 1000:
+                    break
+                continue
+            last_data = now
+            wall_now = time.time()
+            for records in data.values():
+                for record in records:
+                    value = record.value or b''
+                    latency = None
+                    if len(value) >= TIMESTAMP.size:
+                        sent, = TIMESTAMP.unpack_from(value)
+                        latency = max(0, wall_now - sent)
+                    stats.record(len(value), latency)
+    finally:
+        yield from consumer.stop()
+    return stats
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m aiokafka.perf',
+        description='aiokafka producer and consumer performance tests')
+    parser.add_argument('mode', choices=['producer', 'consumer'])
+    parser.add_argument('--topic', default='aiokafka-perf')
+    parser.add_argument('--num-records', type=int, default=100000)
+    parser.add_argument(
+        '--bootstrap-servers', default='localhost:9092',
+        type=lambda s: s.split(','),
+        help='comma separated list of host[:port]')
+    parser.add_argument(
+        '--fake-nodes', type=int, default=0,
+        help='run against in-process fake cluster with N nodes')
+    parser.add_argument(
+        '--partitions', type=int, default=1,
+        help='number of partitions of the fake cluster topic')
+    parser.add_argument(
+        '--use-frame-protocol', action='store_true',
+        help='read responses with KafkaProtocol instead of StreamReader')
+
+    producer = parser.add_argument_group('producer')
+    producer.add_argument('--record-size', type=int, default=100)
+    producer.add_argument(
+        '--acks', default=1, type=lambda s: s if s == 'all' else int(s))
+    producer.add_argument(
+        '--compression-type', default=None,
+        choices=['gzip', 'snappy', 'lz4'])
+    producer.add_argument('--linger-ms', type=int, default=0)
+    producer.add_argument('--max-batch-size', type=int, default=16384)
+    producer.add_argument('--connections-per-broker', type=int, default=1)
+    producer.add_argument(
+        '--throughput', type=float, default=-1,
+        help='throttle to this many records/sec, -1 for no limit')
+
+    consumer = parser.add_argument_group('consumer')
+    consumer.add_argument('--group-id', default=None)
+    consumer.add_argument('--fetch-max-wait-ms', type=int, default=500)
+    consumer.add_argument(
+        '--max-partition-fetch-bytes', type=int, default=1024 * 1024)
+    consumer.add_argument(
+        '--timeout-ms', type=int, default=10000,
+        help='stop if no records are consumed for this long')
+    return parser.parse_args(argv)
+
+
+@asyncio.coroutine
+def _run(args, *, loop):
+    cluster = None
+    if args.fake_nodes:
+        cluster = FakeKafkaCluster(
+            loop=loop, num_nodes=args.fake_nodes,
+            num_partitions=args.partitions)
+        yield from cluster.start()
+        cluster.create_topic(args.topic)
+        args.bootstrap_servers = cluster.bootstrap_servers
+    try:
+        if args.mode == 'producer':
+            stats = yield from producer_perf(args, loop=loop)
+            print(stats.summary('sent'))
+        else:
+            if cluster is not None:
+                yield from producer_perf(args, loop=loop)
+            stats = yield from consumer_perf(args, loop=loop)
+            print(stats.summary('consumed'))
+    finally:
+        if cluster is not None:
+            yield from cluster.stop()
+
+
+def main(argv=None):
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_run(args, loop=loop))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,15 +9,91 @@ from kafka.common import (TopicPartition,
 from kafka.partitioner.default import DefaultPartitioner
 from kafka.protocol.message import Message, MessageSet
 from kafka.protocol.produce import ProduceRequest
+from kafka.protocol.types import Int16, Int32, String
 import kafka.common as Errors
 
 from aiokafka import ensure_future
 from aiokafka.client import AIOKafkaClient
-from aiokafka.message_accumulator import MessageAccumulator
+from aiokafka.message_accumulator import MessageAccumulator, ProducerClosed
+from aiokafka.partitioner import StickyPartitioner
 
 log = logging.getLogger(__name__)
 
 
+class EncodedProduceRequest(ProduceRequest):
+    """ProduceRequest of already encoded message sets
+
+    Topics are passed as [(topic, [(partition, message_set_bytes)])].
+    `encode()` returns list of buffers referencing message sets, so they are
+    not copied (nor decoded and encoded again) on every request, including
+    retries.
+    """
+    _TOPIC = String('utf-8')
+
+    def _encode_self(self):
+        buffers = [Int16.encode(self.required_acks) +
+                   Int32.encode(self.timeout) +
+                   Int32.encode(len(self.topics))]
+        for topic, partitions in self.topics:
+            buffers.append(
+                self._TOPIC.encode(topic) + Int32.encode(len(partitions)))
+            for partition, message_set in partitions:
+                buffers.append(Int32.encode(partition))
+                buffers.append(message_set)
+        return buffers
+
+    def __repr__(self):
+        return '{}(required_acks={}, timeout={}, topics={})'.format(
+            self.__class__.__name__, self.required_acks, self.timeout,
+            [(topic, [partition for partition, _ in partitions])
+             for topic, partitions in self.topics])
+
+
+class NodeSender:
+    """Long-lived workers sending produce requests to a single broker
+
+    Drained batches of the node are put into the queue of sender and sent by
+    one of `workers` coroutines, so no more than `workers` produce requests
+    are sent to the node at once and no task is created per request.
+
+    Arguments:
+        node_id (int): kafka broker identifier
+        send (coroutine function): called as send(node_id, batches)
+        workers (int): number of workers
+        loop (asyncio.BaseEventLoop): asyncio event loop
+    """
+
+    def __init__(self, node_id, send, workers, *, loop):
+        self._node_id = node_id
+        self._send = send
+        self._loop = loop
+        self._queue = asyncio.Queue(loop=loop)
+        self._workers = [
+            ensure_future(self._worker(), loop=loop) for _ in range(workers)]
+
+    def put(self, batches):
+        """Put batches ({TopicPartition: MessageBatch}) to send"""
+        self._queue.put_nowait(batches)
+
+    @asyncio.coroutine
+    def _worker(self):
+        while True:
+            batches = yield from self._queue.get()
+            try:
+                yield from self._send(self._node_id, batches)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # noqa
+                log.error("Unexpected error in sender of node %s",
+                          self._node_id, exc_info=True)
+
+    @asyncio.coroutine
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        yield from asyncio.wait(self._workers, loop=self._loop)
+
+
 class AIOKafkaProducer(object):
     """A Kafka client that publishes records to the Kafka cluster.
 
@@ -82,10 +158,23 @@ class AIOKafkaProducer(object):
             Compression is of full batches of data, so the efficacy of batching
             will also impact the compression ratio (more batching means better
             compression). Default: None.
+        compression_executor (concurrent.futures.Executor): Thread or process
+            pool to compress batches in, so compression does not block the
+            event loop. If None, batches are compressed in the event loop
+            thread. Default: None.
+        max_compressing_batches (int): Maximum number of batches submitted to
+            `compression_executor` at once. Default: 4.
         max_batch_size (int): Maximum size of buffered data per partition.
             After this amount `send` coroutine will block until batch is
             drained.
             Default: 16384
+        buffer_memory (int): The total bytes of memory the producer should
+            use to buffer records waiting to be sent to the server. Batch
+            buffers are allocated from this memory and reused after batches
+            are drained. If records are sent faster than they can be
+            delivered `send` coroutine will block until memory is available
+            or fail with KafkaTimeoutError after `request_timeout_ms`.
+            Default: 33554432 (32MB)
         linger_ms (int): The producer groups together any records that arrive
             in between request transmissions into a single batched request.
             Normally this occurs only under load when records arrive faster
@@ -101,12 +190,16 @@ class AIOKafkaProducer(object):
             load. Default: 0.
         partitioner (callable): Callable used to determine which partition
             each message is assigned to. Called (after key serialization):
-            partitioner(key_bytes, all_partitions, available_partitions).
-            The default partitioner implementation hashes each non-None key
-            using the same murmur2 algorithm as the java client so that
+            partitioner(key_bytes, all_partitions, available_partitions),
+            where partitions are sorted tuples of partition ids. The default
+            partitioner implementation hashes each non-None key using the
+            same murmur2 algorithm as the java client so that
             messages with the same key are assigned to the same partition.
             When a key is None, the message is delivered to a random partition
             (filtered to partitions with available leaders only, if possible).
+            Use :class:`aiokafka.partitioner.StickyPartitioner` to send
+            messages without key to one partition until its batch is full or
+            drained instead.
         max_request_size (int): The maximum size of a request. This is also
             effectively a cap on the maximum record size. Note that the server
             has its own cap on record size which may be different from this.
@@ -123,15 +216,55 @@ class AIOKafkaProducer(object):
             Default: 30000.
         retry_backoff_ms (int): Milliseconds to backoff when retrying on
             errors. Default: 100.
+        max_in_flight_requests_per_connection (int): Requests are pipelined
+            to kafka brokers up to this number of maximum requests per
+            broker connection. Default: 5.
+        use_frame_protocol (bool): read responses with a protocol that splits
+            them into frames in place and decodes them from memoryviews,
+            instead of copying every frame out of a StreamReader.
+            Default: False.
+        connections_per_broker (int): maximum number of connections (and
+            produce requests in flight) per broker. Every produce request is
+            sent through the connection with fewest outstanding requests.
+            Only one batch per partition is in flight at a time, so message
+            order is preserved. Default: 1.
+        metadata_cache_dir (str): directory to store snapshot of cluster
+            metadata and detected broker version in. If set, `start()` uses
+            the snapshot for the same bootstrap servers at once and
+            revalidates it in the background. Default: None.
+        connections_max_idle_ms (int): Close idle connections after the
+            number of milliseconds specified by this config. None disables
+            closing. Default: 540000.
+        reconnect_backoff_ms (int): The amount of time in milliseconds to
+            wait before attempting to reconnect to a given broker after a
+            failed attempt. The backoff is doubled after every consecutive
+            failure (up to `reconnect_backoff_max_ms`) and randomized by
+            20%. Default: 50.
+        reconnect_backoff_max_ms (int): The maximum amount of time in
+            milliseconds to wait when reconnecting to a broker.
+            Default: 1000.
         api_version (str): specify which kafka API version to use.
             If set to 'auto', will attempt to infer the broker version by
             probing various APIs. Default: auto
+        client (AIOKafkaClient): client to share cluster metadata and
+            connections with other producers and consumers. It is started
+            by the first of them and closed when the last one is stopped.
+            If set, options used only to create a client, like
+            `bootstrap_servers`, `client_id`, `metadata_max_age_ms` and
+            connection options, are ignored. Default: None.
+        on_error (callable): called as on_error(exception, topic_partition,
+            count) when `count` messages sent with `no_future=True` fail
+            to be delivered. Number of such messages is also counted in
+            `send_errors` attribute. Default: None.
 
     Note:
         Many configuration parameters are taken from Java Client:
         https://kafka.apache.org/documentation.html#producerconfigs
     """
     _PRODUCER_CLIENT_ID_SEQUENCE = 0
+    # Size of produce request without topics data, with room for request
+    # header and client id
+    _REQUEST_OVERHEAD = 512
 
     def __init__(self, *, loop, bootstrap_servers='localhost',
                  client_id=None,
@@ -139,9 +272,16 @@ class AIOKafkaProducer(object):
                  api_version='auto', acks=1,
                  key_serializer=None, value_serializer=None,
                  compression_type=None, max_batch_size=16384,
+                 buffer_memory=33554432, compression_executor=None,
+                 max_compressing_batches=4,
                  partitioner=DefaultPartitioner(), max_request_size=1048576,
                  linger_ms=0, send_backoff_ms=100,
-                 retry_backoff_ms=100):
+                 retry_backoff_ms=100,
+                 max_in_flight_requests_per_connection=5,
+                 use_frame_protocol=False, connections_per_broker=1,
+                 metadata_cache_dir=None, connections_max_idle_ms=540000,
+                 reconnect_backoff_ms=50, reconnect_backoff_max_ms=1000,
+                 client=None, on_error=None):
         if acks not in (0, 1, -1, 'all'):
             raise ValueError("Invalid ACKS parameter")
         if compression_type not in ('gzip', 'snappy', 'lz4', None):
@@ -162,29 +302,56 @@ class AIOKafkaProducer(object):
         self._value_serializer = value_serializer
         self._compression_type = compression_type
         self._partitioner = partitioner
+        self._sticky_partitioner = isinstance(partitioner, StickyPartitioner)
         self._max_request_size = max_request_size
         self._request_timeout_ms = request_timeout_ms
 
-        self.client = AIOKafkaClient(
-            loop=loop, bootstrap_servers=bootstrap_servers,
-            client_id=client_id, metadata_max_age_ms=metadata_max_age_ms,
-            request_timeout_ms=request_timeout_ms)
+        if client is None:
+            client = AIOKafkaClient(
+                loop=loop, bootstrap_servers=bootstrap_servers,
+                client_id=client_id, metadata_max_age_ms=metadata_max_age_ms,
+                request_timeout_ms=request_timeout_ms,
+                max_in_flight_requests_per_connection=(
+                    max_in_flight_requests_per_connection),
+                use_frame_protocol=use_frame_protocol,
+                connections_per_broker=connections_per_broker,
+                metadata_cache_dir=metadata_cache_dir,
+                retry_backoff_ms=retry_backoff_ms,
+                connections_max_idle_ms=connections_max_idle_ms,
+                reconnect_backoff_ms=reconnect_backoff_ms,
+                reconnect_backoff_max_ms=reconnect_backoff_max_ms)
+        self.client = client
         self._metadata = self.client.cluster
         self._message_accumulator = MessageAccumulator(
             self._metadata, max_batch_size, self._compression_type,
-            self._request_timeout_ms/1000, loop)
+            self._request_timeout_ms/1000, loop,
+            on_error=self._on_untracked_error, linger_time=linger_ms / 1000,
+            buffer_memory=buffer_memory,
+            compression_executor=compression_executor,
+            max_compressing_batches=max_compressing_batches,
+            on_batch_rollover=(partitioner.on_batch_rollover
+                               if self._sticky_partitioner else None))
+        self._on_error = on_error
+        # number of messages sent without future that were not delivered
+        self.send_errors = 0
         self._sender_task = None
-        self._in_flight = set()
+        # node_id -> number of produce requests in flight
+        self._in_flight = collections.Counter()
+        # nodes with `connections_per_broker` produce requests in flight
+        self._busy_nodes = set()
+        # node_id -> NodeSender
+        self._node_senders = {}
+        self._in_flight_partitions = set()
+        self._connections_per_broker = client.connections_per_broker
         self._closed = False
         self._loop = loop
         self._retry_backoff = retry_backoff_ms / 1000
-        self._linger_time = linger_ms / 1000
 
     @asyncio.coroutine
     def start(self):
         """Connect to Kafka cluster and check server version"""
         log.debug("Starting the Kafka producer")  # trace
-        yield from self.client.bootstrap()
+        yield from self.client.acquire(self)
 
         # Check Broker Version if not set explicitly
         if self._api_version == 'auto':
@@ -214,8 +381,11 @@ class AIOKafkaProducer(object):
         if self._sender_task:
             self._sender_task.cancel()
             yield from self._sender_task
+        for sender in self._node_senders.values():
+            yield from sender.close()
+        self._node_senders.clear()
 
-        yield from self.client.close()
+        yield from self.client.release(self)
         self._closed = True
         log.debug("The Kafka producer has closed.")
 
@@ -240,19 +410,21 @@ class AIOKafkaProducer(object):
             UnknownTopicOrPartitionError: if no topic or partitions found
                 in cluster metadata
         """
-        if topic in self.client.cluster.topics():
+        # add topic to metadata topic list if it is not there already, the
+        # client may be shared and other users may not need it
+        self.client.add_topic(topic, owner=self)
+        if self._metadata.topic_route(topic) is not None:
             return self._metadata.partitions_for_topic(topic)
 
-        # add topic to metadata topic list if it is not there already.
-        self.client.add_topic(topic)
-        yield from self.client.force_metadata_update()
+        yield from self.client.force_metadata_update([topic])
         if topic not in self.client.cluster.topics():
             raise UnknownTopicOrPartitionError()
 
         return self._metadata.partitions_for_topic(topic)
 
     @asyncio.coroutine
-    def send(self, topic, value=None, key=None, partition=None):
+    def send(self, topic, value=None, key=None, partition=None,
+             no_future=False):
         """Publish a message to a topic.
 
         Arguments:
@@ -273,10 +445,13 @@ class AIOKafkaProducer(object):
                 partition (but if key is None, partition is chosen randomly).
                 Must be type bytes, or be serializable to bytes via configured
                 key_serializer.
+            no_future (bool, optional): fire and forget, don't create a
+                future for the message. Delivery errors are reported to
+                `on_error` callback and counted in `send_errors`.
 
         Returns:
             asyncio.Future: future object that will be set when message is
-                            processed
+                            processed, or None if `no_future` is set
 
         Note: The returned future will wait based on `request_timeout_ms`
             setting. Cancelling this future will not stop event from being
@@ -298,45 +473,140 @@ class AIOKafkaProducer(object):
         log.debug("Sending (key=%s value=%s) to %s", key, value, tp)
 
         fut = yield from self._message_accumulator.add_message(
-            tp, key_bytes, value_bytes, self._request_timeout_ms / 1000)
+            tp, key_bytes, value_bytes, self._request_timeout_ms / 1000,
+            no_future=no_future)
         return fut
 
+    def _on_untracked_error(self, exception, tp, count):
+        self.send_errors += count
+        log.warning("Failed to deliver %d messages to %s: %s",
+                    count, tp, exception)
+        if self._on_error is not None:
+            try:
+                self._on_error(exception, tp, count)
+            except Exception:  # noqa
+                log.error("Error in on_error callback", exc_info=True)
+
+    @asyncio.coroutine
+    def send_batch(self, topic, records, partition=None):
+        """Publish many messages to a topic at once.
+
+        Messages are serialized, partitioned and added to batches in one
+        pass, without creating a future per message.
+
+        Arguments:
+            topic (str): topic where the messages will be published
+            records (iterable): (key, value) pairs of messages, see `send()`
+                for details on keys and values
+            partition (int, optional): optionally specify a partition for
+                all messages. If not set, the partition will be selected
+                using the configured 'partitioner' for each message.
+
+        Returns:
+            list of asyncio.Future: one future per batch the messages were
+                added to, that will be set to BatchMetadata (topic,
+                partition, topic_partition, base_offset, record_count) when
+                the batch is processed. Batch may contain messages sent by
+                other calls as well.
+        """
+        return (yield from self.send_batches({topic: records}, partition))
+
+    @asyncio.coroutine
+    def send_batches(self, records_by_topic, partition=None):
+        """Publish many messages to many topics at once.
+
+        Arguments:
+            records_by_topic (dict): topic -> iterable of (key, value) pairs
+                of messages
+            partition (int, optional): optionally specify a partition for
+                all messages.
+
+        Returns:
+            list of asyncio.Future: one future per batch, see `send_batch()`
+
+        Raises:
+            KafkaTimeoutError: if messages can't be added in
+                `request_timeout_ms`. Messages added before are sent anyway,
+                the exception has `futures` attribute with futures of their
+                batches and `accepted` attribute with the number of them.
+        """
+        timeout = self._request_timeout_ms / 1000
+        futures = []
+        accepted = 0
+        for topic, records in records_by_topic.items():
+            # first make sure the metadata for the topic is available
+            yield from self._wait_on_metadata(topic)
+
+            by_partition = collections.defaultdict(list)
+            for key, value in records:
+                assert value is not None or \
+                    self._api_version >= (0, 8, 1), (
+                        'Null messages require kafka >= 0.8.1')
+                assert not (value is None and key is None), \
+                    'Need at least one: key or value'
+                key_bytes, value_bytes = self._serialize(topic, key, value)
+                tp_partition = self._partition(
+                    topic, partition, key, value, key_bytes, value_bytes)
+                by_partition[tp_partition].append((key_bytes, value_bytes))
+
+            for tp_partition, messages in by_partition.items():
+                tp = TopicPartition(topic, tp_partition)
+                log.debug("Sending %d messages to %s", len(messages), tp)
+                try:
+                    futures.extend((
+                        yield from self._message_accumulator.add_batch(
+                            tp, messages, timeout)))
+                except (Errors.KafkaTimeoutError, ProducerClosed) as err:
+                    err.futures = futures + err.futures
+                    err.accepted += accepted
+                    raise
+                accepted += len(messages)
+        return futures
+
     @asyncio.coroutine
     def _sender_routine(self):
-        """backgroud task that sends message batches to Kafka brokers"""
-        tasks = set()
+        """backgroud task that drains message batches to node senders"""
         try:
             while True:
                 batches, unknown_leaders_exist = \
                     self._message_accumulator.drain_by_nodes(
-                        ignore_nodes=self._in_flight)
+                        ignore_nodes=self._busy_nodes,
+                        muted_partitions=self._in_flight_partitions)
 
-                # create produce task for every batch
+                # pass batches of every node to its sender
                 for node_id, batches in batches.items():
-                    task = ensure_future(
-                        self._send_produce_req(node_id, batches),
-                        loop=self._loop)
-                    tasks.add(task)
-
+                    self._in_flight[node_id] += 1
+                    if self._in_flight[node_id] >= \
+                            self._connections_per_broker:
+                        self._busy_nodes.add(node_id)
+                    self._in_flight_partitions.update(batches)
+                    sender = self._node_senders.get(node_id)
+                    if sender is None:
+                        sender = self._node_senders[node_id] = NodeSender(
+                            node_id, self._send_produce_req,
+                            self._connections_per_broker, loop=self._loop)
+                    sender.put(batches)
+
+                timeout = None
                 if unknown_leaders_exist:
                     # we have at least one unknown partition's leader,
                     # try to update cluster metadata and wait backoff time
-                    self.client.force_metadata_update()
-                    # Just to have at least 1 future in wait() call
-                    fut = asyncio.sleep(self._retry_backoff, loop=self._loop)
-                    waiters = tasks.union([fut])
-                else:
-                    fut = self._message_accumulator.data_waiter()
-                    waiters = tasks.union([fut])
+                    self.client.force_metadata_update(
+                        self._message_accumulator.unknown_leader_topics())
+                    timeout = self._retry_backoff
+                deadline = self._message_accumulator.next_linger_deadline()
+                if deadline is not None:
+                    linger_timeout = max(deadline - self._loop.time(), 0)
+                    if timeout is None or linger_timeout < timeout:
+                        timeout = linger_timeout
 
                 # wait when:
-                # * At least one of produce task is finished
-                # * Data for new partition arrived
-                done, _ = yield from asyncio.wait(
-                    waiters,
-                    return_when=asyncio.FIRST_COMPLETED,
-                    loop=self._loop)
-                tasks -= done
+                # * At least one of produce requests is finished
+                # * Data for new partition arrived or a batch is full
+                # * Linger time of the next batch is passed
+                yield from asyncio.wait(
+                    [self._message_accumulator.data_waiter()],
+                    timeout=timeout, loop=self._loop)
 
         except asyncio.CancelledError:
             pass
@@ -345,77 +615,142 @@ class AIOKafkaProducer(object):
 
     @asyncio.coroutine
     def _send_produce_req(self, node_id, batches):
-        """Create produce request to node
-        If producer configured with `retries`>0 and produce response contain
-        "failed" partitions produce request for this partition will try
-        resend to broker `retries` times with `retry_timeout_ms` timeouts.
+        """Create produce requests to node
+        Batches are packed into requests no larger than `max_request_size`,
+        which are sent at once (pipelined on connection).
+        If produce response contain "failed" partitions produce request for
+        this partition will try resend to broker until batch is expired with
+        `retry_backoff_ms` timeouts.
 
         Arguments:
             node_id (int): kafka broker identifier
             batches (dict): dictionary of {TopicPartition: MessageBatch}
         """
-        self._in_flight.add(node_id)
-        t0 = self._loop.time()
-        while True:
-            topics = collections.defaultdict(list)
-            for tp, batch in batches.items():
-                topics[tp.topic].append((tp.partition, batch.data()))
-
-            request = ProduceRequest(
-                required_acks=self._acks,
-                timeout=self._request_timeout_ms,
-                topics=list(topics.items()))
+        muted = list(batches)
+        try:
+            yield from self._message_accumulator.compress_batches(batches)
+            while batches:
+                requests = self._pack_batches(batches)
+                if log.isEnabledFor(logging.DEBUG):
+                    capacity = self._max_request_size - self._REQUEST_OVERHEAD
+                    log.debug(
+                        "Batches for node %s are packed into %d produce"
+                        " requests (%.1f%% of request capacity used)",
+                        node_id, len(requests), 100 * sum(map(
+                            self._batch_request_size, batches.items())) /
+                        (len(requests) * capacity))
+                if len(requests) == 1:
+                    results = [
+                        (yield from self._send_batches(node_id, batches))]
+                else:
+                    results = yield from asyncio.gather(
+                        *[self._send_batches(node_id, request_batches)
+                          for request_batches in requests], loop=self._loop)
+
+                batches = {}
+                for retry_batches in results:
+                    batches.update(retry_batches)
+                if batches:
+                    yield from asyncio.sleep(
+                        self._retry_backoff, loop=self._loop)
+        finally:
+            self._in_flight[node_id] -= 1
+            if self._in_flight[node_id] < self._connections_per_broker:
+                self._busy_nodes.discard(node_id)
+            self._in_flight_partitions.difference_update(muted)
+            # node and partitions can be drained again
+            self._message_accumulator.wakeup_sender()
+
+    @staticmethod
+    def _batch_request_size(item):
+        """Upper bound of bytes taken by batch in produce request"""
+        tp, batch = item
+        # partition, topic name and size of partitions array
+        return len(batch.data_bytes()) + 4 + 2 + len(tp.topic) + 4
+
+    def _pack_batches(self, batches):
+        """Split batches into groups fitting into `max_request_size`
+        (first fit decreasing bin packing)
 
-            try:
-                response = yield from self.client.send(node_id, request)
-            except KafkaError as err:
-                for batch in batches.values():
-                    if not err.retriable or batch.expired():
-                        batch.done(exception=err)
-                log.warning(
-                    "Got error produce response: %s", err)
-                if not err.retriable:
+        Returns:
+            list of dictionaries of {TopicPartition: MessageBatch}
+        """
+        if len(batches) == 1:
+            return [batches]
+        capacity = self._max_request_size - self._REQUEST_OVERHEAD
+        # [free bytes, batches] per request
+        bins = []
+        items = sorted(
+            batches.items(), key=self._batch_request_size, reverse=True)
+        for item in items:
+            size = self._batch_request_size(item)
+            for request in bins:
+                if request[0] >= size:
+                    request[0] -= size
+                    request[1][item[0]] = item[1]
                     break
             else:
-                if response is None:
-                    # noacks, just "done" batches
-                    for batch in batches.values():
-                        batch.done()
-                    break
+                # batches larger than capacity get a request of their own
+                bins.append([capacity - size, {item[0]: item[1]}])
+        return [request_batches for _, request_batches in bins]
 
-                for topic, partitions in response.topics:
-                    for partition, error_code, offset in partitions:
-                        tp = TopicPartition(topic, partition)
-                        error = Errors.for_code(error_code)
-                        batch = batches.pop(tp, None)
-                        if batch is None:
-                            continue
-
-                        if error is Errors.NoError:
-                            batch.done(offset)
-                        elif not getattr(error, 'retriable', False) or \
-                                batch.expired():
-                            batch.done(exception=error())
-                        else:
-                            # Ok, we can retry this batch
-                            batches[tp] = batch
-                            log.warning(
-                                "Got error produce response on topic-partition"
-                                " %s, retrying. Error: %s", tp, error)
-
-            if batches:
-                yield from asyncio.sleep(
-                    self._retry_backoff, loop=self._loop)
-            else:
-                break
+    @asyncio.coroutine
+    def _send_batches(self, node_id, batches):
+        """Send single produce request with `batches` to node
 
-        # if batches for node is processed in less than a linger seconds
-        # then waiting for the remaining time
-        sleep_time = self._linger_time - (self._loop.time() - t0)
-        if sleep_time > 0:
-            yield from asyncio.sleep(sleep_time, loop=self._loop)
+        Returns:
+            dict: batches that should be retried
+        """
+        topics = collections.defaultdict(list)
+        for tp, batch in batches.items():
+            topics[tp.topic].append((tp.partition, batch.data_bytes()))
+
+        request = EncodedProduceRequest(
+            required_acks=self._acks,
+            timeout=self._request_timeout_ms,
+            topics=list(topics.items()))
 
-        self._in_flight.remove(node_id)
+        try:
+            response = yield from self.client.send(node_id, request)
+        except KafkaError as err:
+            log.warning(
+                "Got error produce response: %s", err)
+            retry_batches = {}
+            for tp, batch in batches.items():
+                if not err.retriable or batch.expired():
+                    batch.done(exception=err)
+                else:
+                    retry_batches[tp] = batch
+            return retry_batches
+
+        if response is None:
+            # noacks, just "done" batches
+            for batch in batches.values():
+                batch.done()
+            return {}
+
+        # batches missing in response are retried
+        retry_batches = dict(batches)
+        for topic, partitions in response.topics:
+            for partition, error_code, offset in partitions:
+                tp = TopicPartition(topic, partition)
+                error = Errors.for_code(error_code)
+                batch = retry_batches.pop(tp, None)
+                if batch is None:
+                    continue
+
+                if error is Errors.NoError:
+                    batch.done(offset)
+                elif not getattr(error, 'retriable', False) or \
+                        batch.expired():
+                    batch.done(exception=error())
+                else:
+                    # Ok, we can retry this batch
+                    retry_batches[tp] = batch
+                    log.warning(
+                        "Got error produce response on topic-partition"
+                        " %s, retrying. Error: %s", tp, error)
+        return retry_batches
 
     def _serialize(self, topic, key, value):
         if self._key_serializer:
@@ -442,13 +777,16 @@ class AIOKafkaProducer(object):
 
     def _partition(self, topic, partition, key, value,
                    serialized_key, serialized_value):
+        route = self._metadata.topic_route(topic)
         if partition is not None:
             assert partition >= 0
-            assert partition in self._metadata.partitions_for_topic(topic), \
-                'Unrecognized partition'
+            assert partition in route.partitions_set, 'Unrecognized partition'
             return partition
 
-        all_partitions = list(self._metadata.partitions_for_topic(topic))
-        available = list(self._metadata.available_partitions_for_topic(topic))
+        if self._sticky_partitioner:
+            return self._partitioner.partition(
+                topic, serialized_key, route.partitions, route.available,
+                partitions_set=route.partitions_set,
+                available_set=route.available_set)
         return self._partitioner(
-            serialized_key, all_partitions, available)
+            serialized_key, route.partitions, route.available)
@@ -64,7 +64,7 @@ class KafkaIntegrationTestCase(unittest.TestCase):
     def wait_topic(self, client, topic):
         client.add_topic(topic)
         for i in range(5):
-            ok = yield from client.force_metadata_update()
+            ok = yield from client.force_metadata_update([topic])
             if ok:
                 ok = topic in client.cluster.topics()
             if not ok:
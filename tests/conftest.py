@@ -5,15 +5,23 @@ import docker as libdocker
 import pytest
 import socket
 import struct
+import threading
 import uuid
 import sys
 
+from aiokafka.fake_broker import FakeKafkaCluster
+
 
 def pytest_addoption(parser):
     parser.addoption('--docker-image',
                      action='store',
                      default='pygo/kafka:2.11_0.9.0.1',
                      help='Kafka docker image to use')
+    parser.addoption('--fake-kafka',
+                     action='store_true',
+                     default=False,
+                     help='Run tests against in-process fake Kafka broker'
+                          ' instead of docker')
 
 
 @pytest.fixture(scope='session')
@@ -57,10 +65,14 @@ def session_id():
 
 
 @pytest.yield_fixture(scope='session')
-def kafka_server(request, docker, docker_ip_address, unused_port, session_id):
+def kafka_server(request, unused_port, session_id):
+    if request.config.getoption('--fake-kafka'):
+        yield from fake_kafka_server(unused_port)
+        return
+    docker = request.getfixturevalue('docker')
+    kafka_host = request.getfixturevalue('docker_ip_address')
     image = request.config.getoption('--docker-image')
     docker.pull(image)
-    kafka_host = docker_ip_address
     kafka_port = unused_port()
     container = docker.create_container(
         image=image,
@@ -82,6 +94,22 @@ def kafka_server(request, docker, docker_ip_address, unused_port, session_id):
     docker.remove_container(container['Id'])
 
 
+def fake_kafka_server(unused_port):
+    """Run FakeKafkaCluster in a separate thread with it's own event loop"""
+    kafka_host, kafka_port = '127.0.0.1', unused_port()
+    loop = asyncio.new_event_loop()
+    cluster = FakeKafkaCluster(
+        loop=loop, host=kafka_host, ports=[kafka_port], num_partitions=2)
+    loop.run_until_complete(cluster.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield kafka_host, kafka_port
+    asyncio.run_coroutine_threadsafe(cluster.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
 @pytest.yield_fixture(scope='class')
 def loop(request):
     loop = asyncio.new_event_loop()
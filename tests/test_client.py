@@ -4,11 +4,17 @@ import unittest
 from unittest import mock
 
 from kafka.common import (KafkaError, ConnectionError,
-                          NodeNotReadyError, UnrecognizedBrokerVersion)
+                          NodeNotReadyError, UnrecognizedBrokerVersion,
+                          TopicPartition, TopicAuthorizationFailedError)
+from kafka.protocol.fetch import FetchRequest
+from kafka.protocol.message import Message
 from kafka.protocol.metadata import MetadataRequest, MetadataResponse
+from kafka.protocol.produce import ProduceRequest
 
-from aiokafka.client import AIOKafkaClient
+from aiokafka import ensure_future
+from aiokafka.client import AIOKafkaClient, ConnectionGroup
 from aiokafka.conn import AIOKafkaConnection
+from aiokafka.fake_broker import FakeKafkaCluster
 from ._testutil import KafkaIntegrationTestCase, run_until_complete
 
 
@@ -73,11 +79,12 @@ class TestAIOKafkaClient(unittest.TestCase):
         ]
 
         @asyncio.coroutine
-        def send(request_id):
+        def send(request_id, expect_response=True):
             return MetadataResponse(brokers, topics)
 
-        mocked_conns = {0: mock.MagicMock()}
-        mocked_conns[0].send.side_effect = send
+        conn_id = (0, ConnectionGroup.DEFAULT, 0)
+        mocked_conns = {conn_id: mock.MagicMock()}
+        mocked_conns[conn_id].send.side_effect = send
         client = AIOKafkaClient(loop=self.loop,
                                 bootstrap_servers=['broker_1:4567'])
         task = asyncio.async(client._md_synchronizer(), loop=self.loop)
@@ -100,7 +107,7 @@ class TestAIOKafkaClient(unittest.TestCase):
         self.assertEqual(
             md.available_partitions_for_topic('topic_2'), set([1]))
 
-        mocked_conns[0].connected.return_value = False
+        mocked_conns[conn_id].connected.return_value = False
         is_ready = self.loop.run_until_complete(client.ready(0))
         self.assertEqual(is_ready, False)
         is_ready = self.loop.run_until_complete(client.ready(1))
@@ -108,7 +115,278 @@ class TestAIOKafkaClient(unittest.TestCase):
         self.assertEqual(mocked_conns, {})
 
         with self.assertRaises(NodeNotReadyError):
-            self.loop.run_until_complete(client.send(0, None))
+            self.loop.run_until_complete(client.send(0, MetadataRequest([])))
+
+    @run_until_complete
+    def test_coalesced_metadata_update(self):
+        brokers = [(0, 'broker_1', 4567)]
+        requests = []
+        in_flight_updates = []
+
+        @asyncio.coroutine
+        def send(request, expect_response=True):
+            requests.append(sorted(request.topics))
+            while in_flight_updates:
+                in_flight_updates.pop()()
+            return MetadataResponse(brokers, [
+                (NO_ERROR, topic, [(NO_ERROR, 0, 0, [0], [0])])
+                for topic in request.topics])
+
+        conn_id = (0, ConnectionGroup.DEFAULT, 0)
+        mocked_conns = {conn_id: mock.MagicMock()}
+        mocked_conns[conn_id].send.side_effect = send
+        client = AIOKafkaClient(loop=self.loop,
+                                bootstrap_servers=['broker_1:4567'],
+                                retry_backoff_ms=200)
+        client._conns = mocked_conns
+        client.cluster.update_metadata(MetadataResponse(brokers, [
+            (NO_ERROR, 'topic_1', [(NO_ERROR, 0, 1, [1], [1])]),
+            (NO_ERROR, 'topic_2', [(NO_ERROR, 0, 1, [1], [1])])]))
+        client.set_topics(['topic_1', 'topic_2', 'topic_3'])
+        task = ensure_future(client._md_synchronizer(), loop=self.loop)
+        try:
+            yield from client.force_metadata_update()
+            self.assertEqual(requests, [['topic_1', 'topic_2', 'topic_3']])
+            client.cluster.update_metadata(MetadataResponse(brokers, [
+                (NO_ERROR, 'topic_1', [(NO_ERROR, 0, 0, [0], [0])]),
+                (NO_ERROR, 'topic_2', [(NO_ERROR, 0, 0, [0, 1], [0])]),
+                (NO_ERROR, 'topic_3', [(NO_ERROR, 0, 0, [0], [0])]),
+                (TopicAuthorizationFailedError.errno, 'topic_4', [])]))
+
+            # Burst of requests for stale topics share single request
+            # for these topics only
+            start = self.loop.time()
+            futs = [client.force_metadata_update(['topic_1']),
+                    client.force_metadata_update(['topic_1']),
+                    client.force_metadata_update(['topic_3'])]
+            self.assertEqual(len(set(futs)), 1)
+            yield from futs[0]
+            # Refreshes are rate limited
+            self.assertGreaterEqual(self.loop.time() - start, 0.15)
+            self.assertEqual(requests[1:], [['topic_1', 'topic_3']])
+            # Metadata of other topics is preserved
+            self.assertEqual(client.cluster.topics(),
+                             {'topic_1', 'topic_2', 'topic_3'})
+            self.assertEqual(client.cluster.leader_for_partition(
+                TopicPartition('topic_2', 0)), 0)
+            partition = client.cluster._partitions['topic_2'][0]
+            self.assertEqual(partition.replicas, [0, 1])
+            self.assertEqual(partition.isr, [0])
+            self.assertEqual(client.cluster.unauthorized_topics, {'topic_4'})
+
+            # Topics marked stale while request is in flight are not lost,
+            # they are refreshed by the next request
+            next_futs = []
+            in_flight_updates.append(lambda: next_futs.append(
+                client.force_metadata_update(['topic_2'])))
+            yield from client.force_metadata_update(['topic_1'])
+            self.assertEqual(len(next_futs), 1)
+            yield from next_futs[0]
+            self.assertEqual(requests[2:], [['topic_1'], ['topic_2']])
+        finally:
+            task.cancel()
+
+    def test_least_loaded_node(self):
+        client = AIOKafkaClient(loop=self.loop,
+                                bootstrap_servers=['broker_1:4567'])
+        self.assertIsNone(client.least_loaded_node())
+        client.cluster.update_metadata(MetadataResponse([
+            (0, 'broker_1', 4567),
+            (1, 'broker_2', 5678),
+            (2, 'broker_3', 6789)], []))
+        for node_id in range(3):
+            conn = mock.MagicMock()
+            conn.pending_requests = 0
+            client._conns[(node_id, ConnectionGroup.DEFAULT, 0)] = conn
+
+        client._node_stats[0].record_response(0.010)
+        client._node_stats[1].record_response(0.080)
+        client._node_stats[2].record_response(0.050)
+        self.assertEqual(client.least_loaded_node(), 0)
+
+        # Outstanding requests increase expected latency
+        client._conns[(0, ConnectionGroup.DEFAULT, 0)].pending_requests = 9
+        self.assertEqual(client.least_loaded_node(), 2)
+
+        # Recently failed node is avoided while in backoff
+        client._node_stats[2].record_failure(self.loop.time())
+        self.assertEqual(client.least_loaded_node(), 1)
+        client._node_stats[1].record_failure(self.loop.time())
+        client._node_stats[0].record_failure(self.loop.time() - 1)
+        self.assertEqual(client.least_loaded_node(), 0)
+
+        # Latency is smoothed
+        client._node_stats[1].record_response(0.200)
+        self.assertAlmostEqual(client._node_stats[1].latency, 0.116)
+
+        # Node without statistics is as fast as an average known node
+        client.cluster.update_metadata(MetadataResponse([
+            (0, 'broker_1', 4567),
+            (1, 'broker_2', 5678),
+            (2, 'broker_3', 6789),
+            (3, 'broker_4', 7890)], []))
+        client._node_stats.clear()
+        client._conns[(0, ConnectionGroup.DEFAULT, 0)].pending_requests = 0
+        client._node_stats[0].record_response(0.010)
+        client._node_stats[1].record_response(0.080)
+        client._node_stats[2].record_response(0.090)
+        self.assertEqual(client._nodes_by_load()[:2], [0, 3])
+
+    @run_until_complete
+    def test_latency_recorded_for_default_group_only(self):
+        client = AIOKafkaClient(loop=self.loop,
+                                bootstrap_servers=['broker_1:4567'])
+        client.cluster.update_metadata(MetadataResponse([
+            (0, 'broker_1', 4567),
+            (1, 'broker_2', 5678)], []))
+
+        @asyncio.coroutine
+        def send(request, expect_response=True):
+            yield from asyncio.sleep(0.1, loop=self.loop)
+            return 'response'
+
+        for node_id in range(2):
+            for group in (ConnectionGroup.DEFAULT, ConnectionGroup.FETCH):
+                conn = mock.MagicMock()
+                conn.pending_requests = 0
+                conn.send.side_effect = send
+                client._conns[(node_id, group, 0)] = conn
+        client._node_stats[0].record_response(0.010)
+        client._node_stats[1].record_response(0.020)
+
+        # Long-polling fetch doesn't make partition leader look slow
+        res = yield from client.send(0, FetchRequest(-1, 500, 1, []))
+        self.assertEqual(res, 'response')
+        self.assertAlmostEqual(client._node_stats[0].latency, 0.010)
+        self.assertEqual(client.least_loaded_node(), 0)
+
+        yield from client.send(0, MetadataRequest([]))
+        self.assertGreater(client._node_stats[0].latency, 0.020)
+        self.assertEqual(client.least_loaded_node(), 1)
+
+    @run_until_complete
+    def test_bootstrap_concurrently(self):
+        cluster = FakeKafkaCluster(loop=self.loop)
+        yield from cluster.start()
+        silent_conns = []
+
+        def accept_silently(reader, writer):
+            silent_conns.append(reader)
+
+        # Server accepts connections, but never answers requests
+        silent = yield from asyncio.start_server(
+            accept_silently, '127.0.0.1', 0, loop=self.loop)
+        silent_port = silent.sockets[0].getsockname()[1]
+
+        node = cluster.nodes[0]
+        client = AIOKafkaClient(loop=self.loop, bootstrap_stagger_ms=100)
+        t0 = self.loop.time()
+        with mock.patch.object(
+                AIOKafkaClient, 'hosts', new_callable=mock.PropertyMock,
+                return_value=[('127.0.0.1', silent_port),
+                              (node.host, node.port)]):
+            yield from client.bootstrap()
+        self.assertLess(self.loop.time() - t0, 1)
+        self.assertEqual(len(client.cluster.brokers()), 1)
+        # Losing connection is closed
+        self.assertEqual(len(silent_conns), 1)
+        yield from asyncio.wait_for(
+            silent_conns[0].read(), timeout=1, loop=self.loop)
+        self.assertTrue(silent_conns[0].at_eof())
+        yield from client.close()
+
+        # Next server is tried at once if connection is refused
+        client = AIOKafkaClient(loop=self.loop, bootstrap_stagger_ms=10000)
+        t0 = self.loop.time()
+        with mock.patch.object(
+                AIOKafkaClient, 'hosts', new_callable=mock.PropertyMock,
+                return_value=[('127.0.0.1', node.port + 1),
+                              (node.host, node.port)]):
+            yield from client.bootstrap()
+        self.assertLess(self.loop.time() - t0, 1)
+        self.assertEqual(len(client.cluster.brokers()), 1)
+        yield from client.close()
+
+        # Next server is tried at once if metadata request is timed out
+        client = AIOKafkaClient(loop=self.loop, bootstrap_stagger_ms=10000,
+                                request_timeout_ms=200)
+        t0 = self.loop.time()
+        with mock.patch.object(
+                AIOKafkaClient, 'hosts', new_callable=mock.PropertyMock,
+                return_value=[('127.0.0.1', silent_port),
+                              (node.host, node.port)]):
+            yield from client.bootstrap()
+        self.assertLess(self.loop.time() - t0, 1)
+        self.assertEqual(len(client.cluster.brokers()), 1)
+        # Timed out connection is closed
+        self.assertEqual(len(silent_conns), 2)
+        yield from asyncio.wait_for(
+            silent_conns[1].read(), timeout=1, loop=self.loop)
+        self.assertTrue(silent_conns[1].at_eof())
+        yield from client.close()
+
+        silent.close()
+        yield from cluster.stop()
+
+    @run_until_complete
+    def test_idle_connections_closed(self):
+        cluster = FakeKafkaCluster(loop=self.loop)
+        yield from cluster.start()
+        node = cluster.nodes[0]
+        client = AIOKafkaClient(
+            loop=self.loop, bootstrap_servers=[
+                '{}:{}'.format(node.host, node.port)],
+            connections_max_idle_ms=200)
+        yield from client.bootstrap()
+        node_id = client.get_random_node()
+        self.assertTrue((yield from client.ready(node_id)))
+        conn = client._conns[(node_id, ConnectionGroup.DEFAULT, 0)]
+
+        yield from asyncio.sleep(0.1, loop=self.loop)
+        yield from client.send(node_id, MetadataRequest([]))
+        yield from asyncio.sleep(0.15, loop=self.loop)
+        # Connection was used recently
+        self.assertTrue(conn.connected())
+
+        yield from asyncio.sleep(0.2, loop=self.loop)
+        self.assertFalse(conn.connected())
+        self.assertNotIn((node_id, ConnectionGroup.DEFAULT, 0), client._conns)
+        yield from client.close()
+        yield from cluster.stop()
+
+    @run_until_complete
+    def test_reconnect_backoff(self):
+        client = AIOKafkaClient(
+            loop=self.loop, bootstrap_servers=['broker_1:4567'],
+            reconnect_backoff_ms=100, reconnect_backoff_max_ms=300)
+        client.cluster.update_metadata(MetadataResponse(
+            [(0, '127.0.0.1', 1)], []))
+
+        with mock.patch('aiokafka.client.create_conn') as mocked:
+            mocked.side_effect = OSError('refused')
+            self.assertIsNone((yield from client._get_conn(0)))
+            self.assertEqual(mocked.call_count, 1)
+            # No connection attempts during backoff
+            self.assertIsNone((yield from client._get_conn(0)))
+            self.assertEqual(mocked.call_count, 1)
+
+            stats = client._node_stats[0]
+            backoff = stats.reconnect_at - self.loop.time()
+            self.assertTrue(0.07 < backoff <= 0.12, backoff)
+            yield from asyncio.sleep(backoff, loop=self.loop)
+            self.assertIsNone((yield from client._get_conn(0)))
+            self.assertEqual(mocked.call_count, 2)
+            # Backoff is doubled up to reconnect_backoff_max_ms
+            backoff = stats.reconnect_at - self.loop.time()
+            self.assertTrue(0.15 < backoff <= 0.24, backoff)
+            stats.reconnect_at = 0
+            yield from client._get_conn(0)
+            stats.reconnect_at = 0
+            yield from client._get_conn(0)
+            backoff = stats.reconnect_at - self.loop.time()
+            self.assertTrue(0.23 < backoff <= 0.36, backoff)
+
+        yield from client.close()
 
 
 class TestKafkaClientIntegration(KafkaIntegrationTestCase):
@@ -208,3 +486,98 @@ class TestKafkaClientIntegration(KafkaIntegrationTestCase):
 
             with self.assertRaises(KafkaError):
                 yield from client.fetch_all_metadata()
+
+    @run_until_complete
+    def test_metadata_update_timeout(self):
+        cluster = FakeKafkaCluster(loop=self.loop)
+        yield from cluster.start()
+        client = AIOKafkaClient(
+            loop=self.loop, bootstrap_servers=cluster.bootstrap_servers,
+            request_timeout_ms=200, retry_backoff_ms=10)
+        yield from client.bootstrap()
+        cluster.create_topic('md_timeout_topic')
+
+        handle_metadata = cluster._handle_MetadataRequest
+        hung = []
+
+        def hang(node, request, client_id):
+            fut = asyncio.Future(loop=self.loop)
+            hung.append((fut, handle_metadata(node, request, client_id)))
+            return fut
+
+        # Timed out request fails the update, but not the synchronizer
+        with mock.patch.object(cluster, '_handle_MetadataRequest', hang):
+            updated = yield from client.force_metadata_update(
+                ['md_timeout_topic'])
+        self.assertEqual(updated, False)
+        self.assertFalse(client._sync_task.done())
+        self.assertEqual(client._md_stale_topics, {'md_timeout_topic'})
+        for fut, resp in hung:
+            fut.set_result(resp)
+
+        # Stale topics are refreshed by the next request
+        updated = yield from client.force_metadata_update([])
+        self.assertEqual(updated, True)
+        self.assertEqual(client._md_stale_topics, set())
+        self.assertEqual(client.cluster.topics(), {'md_timeout_topic'})
+
+        yield from client.close()
+        yield from cluster.stop()
+
+    @run_until_complete
+    def test_connection_groups(self):
+        client = AIOKafkaClient(loop=self.loop, bootstrap_servers=self.hosts)
+        yield from client.bootstrap()
+        yield from self.wait_topic(client, 'groups_topic')
+        node_id = client.cluster.leader_for_partition(
+            TopicPartition('groups_topic', 0))
+
+        # Long polling fetch does not delay requests of other groups
+        fetch = ensure_future(client.send(node_id, FetchRequest(
+            -1, 2000, 1, [('groups_topic', [(0, 0, 1024)])])), loop=self.loop)
+        yield from asyncio.sleep(0.1, loop=self.loop)
+        t0 = self.loop.time()
+        resp = yield from client.send(node_id, MetadataRequest([]))
+        self.assertIsInstance(resp, MetadataResponse)
+        self.assertLess(self.loop.time() - t0, 1)
+        self.assertFalse(fetch.done())
+        self.assertIn((node_id, ConnectionGroup.FETCH, 0), client._conns)
+        self.assertIn((node_id, ConnectionGroup.DEFAULT, 0), client._conns)
+
+        yield from fetch
+        self.assertTrue((yield from client.ready(
+            node_id, group=ConnectionGroup.COORDINATION)))
+        self.assertIn(
+            (node_id, ConnectionGroup.COORDINATION, 0), client._conns)
+        yield from client.close()
+
+    @run_until_complete
+    def test_produce_connections_pool(self):
+        client = AIOKafkaClient(
+            loop=self.loop, bootstrap_servers=self.hosts,
+            connections_per_broker=2)
+        yield from client.bootstrap()
+        yield from self.wait_topic(client, 'pool_topic')
+        node_id = client.cluster.leader_for_partition(
+            TopicPartition('pool_topic', 0))
+        produce = ProduceRequest(
+            required_acks=1, timeout=1000,
+            topics=[('pool_topic', [(0, [(0, 0, Message(b'value'))])])])
+
+        # Busy connection is not used while pool is not full
+        fetch = ensure_future(client.send(node_id, FetchRequest(
+            -1, 2000, 1, [('pool_topic', [(0, 100, 1024)])]),
+            group=ConnectionGroup.PRODUCE), loop=self.loop)
+        yield from asyncio.sleep(0.1, loop=self.loop)
+        busy = client._conns[(node_id, ConnectionGroup.PRODUCE, 0)]
+        self.assertEqual(busy.pending_requests, 1)
+        t0 = self.loop.time()
+        yield from client.send(node_id, produce)
+        yield from client.send(node_id, produce)
+        self.assertLess(self.loop.time() - t0, 1)
+        self.assertFalse(fetch.done())
+        conns = [key for key in client._conns
+                 if key[1] == ConnectionGroup.PRODUCE]
+        self.assertEqual(len(conns), 2)
+        yield from fetch
+        yield from client.close()
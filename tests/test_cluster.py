@@ -0,0 +1,41 @@
+import unittest
+
+from kafka.protocol.metadata import MetadataResponse
+
+from aiokafka.cluster import ClusterMetadata
+
+
+class TestClusterMetadata(unittest.TestCase):
+
+    def test_routing_table(self):
+        cluster = ClusterMetadata()
+        self.assertEqual(cluster.generation, 0)
+        self.assertIsNone(cluster.topic_route('topic'))
+        self.assertIsNone(cluster.partitions_for_topic('topic'))
+
+        brokers = [(0, 'broker_1', 4567), (1, 'broker_2', 5678)]
+        cluster.update_metadata(MetadataResponse(brokers, [
+            (0, 'topic', [(0, 2, 1, [], []),
+                          (5, 1, -1, [], []),
+                          (0, 0, 0, [], [])])]))
+        route = cluster.topic_route('topic')
+        self.assertEqual(route.partitions, (0, 1, 2))
+        self.assertEqual(route.available, (0, 2))
+        self.assertEqual(cluster.partitions_for_topic('topic'), {0, 1, 2})
+        self.assertEqual(
+            cluster.available_partitions_for_topic('topic'), {0, 2})
+        generation = cluster.generation
+        self.assertEqual(generation, 1)
+        # Routing is not rebuilt until metadata changes
+        self.assertIs(cluster.topic_route('topic'), route)
+        self.assertEqual(cluster.generation, generation)
+
+        # Failed update does not change metadata
+        cluster.update_metadata(MetadataResponse(brokers, [
+            (3, 'topic', [])]))
+        self.assertEqual(cluster.generation, generation)
+
+        cluster.update_metadata(MetadataResponse(brokers, [
+            (0, 'topic', [(0, 0, 1, [], [])])]))
+        self.assertEqual(cluster.generation, generation + 1)
+        self.assertEqual(cluster.topic_route('topic').partitions, (0,))
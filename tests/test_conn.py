@@ -4,13 +4,14 @@ import pytest
 import struct
 from unittest import mock
 from kafka.common import ConnectionError, CorrelationIdError
+from kafka.protocol.api import RequestHeader
 from kafka.protocol.produce import ProduceRequest
 from kafka.protocol.message import Message
 from kafka.protocol.metadata import MetadataRequest, MetadataResponse
 from kafka.protocol.commit import (GroupCoordinatorRequest,
                                    GroupCoordinatorResponse)
 
-from aiokafka.conn import AIOKafkaConnection, create_conn
+from aiokafka.conn import AIOKafkaConnection, KafkaProtocol, create_conn
 from ._testutil import KafkaIntegrationTestCase, run_until_complete
 
 
@@ -84,7 +85,8 @@ class ConnIntegrationTest(KafkaIntegrationTestCase):
             yield from asyncio.sleep(0.1, loop=self.loop)
             raise OSError('mocked writer is closed')
         conn._writer = mock.MagicMock()
-        conn._writer.write.side_effect = OSError('mocked writer is closed')
+        conn._writer.writelines.side_effect = OSError(
+            'mocked writer is closed')
 
         with self.assertRaises(ConnectionError):
             yield from conn.send(request)
@@ -175,3 +177,189 @@ class ConnIntegrationTest(KafkaIntegrationTestCase):
         with self.assertRaises(ConnectionError):
             yield from conn.send(request)
         self.assertEqual(conn.connected(), False)
+
+    @run_until_complete
+    def test_max_in_flight_requests(self):
+        host, port = self.kafka_host, self.kafka_port
+        conn = yield from create_conn(
+            host, port, loop=self.loop,
+            max_in_flight_requests_per_connection=2)
+
+        request = MetadataRequest([])
+        futures = [conn.send(request) for _ in range(5)]
+        self.assertEqual(len(conn._requests), 2)
+        self.assertEqual(len(conn._queued), 3)
+        responses = yield from asyncio.gather(*futures, loop=self.loop)
+        for response in responses:
+            self.assertIsInstance(response, MetadataResponse)
+        self.assertEqual(len(conn._requests), 0)
+        self.assertEqual(len(conn._queued), 0)
+
+        futures = [conn.send(request) for _ in range(3)]
+        conn.close()
+        for fut in futures:
+            with self.assertRaises(asyncio.CancelledError):
+                yield from fut
+
+    @run_until_complete
+    def test_send_waits_for_drain(self):
+        host, port = self.kafka_host, self.kafka_port
+        conn = AIOKafkaConnection(host=host, port=port, loop=self.loop)
+        drained = asyncio.Future(loop=self.loop)
+
+        @asyncio.coroutine
+        def drain():
+            yield from drained
+
+        conn._reader = mock.MagicMock()
+        conn._read_task = mock.MagicMock()
+        conn._writer = mock.MagicMock()
+        conn._writer.drain.side_effect = drain
+        conn._writer.transport.get_write_buffer_size.return_value = 1024
+
+        request = MetadataRequest([])
+        conn.send(request)
+        conn.send(request, expect_response=False)
+        conn.send(request)
+        self.assertEqual(conn._writer.writelines.call_count, 1)
+        self.assertEqual(len(conn._queued), 2)
+
+        conn._writer.transport.get_write_buffer_size.return_value = 0
+        drained.set_result(None)
+        yield from asyncio.sleep(0, loop=self.loop)
+        yield from asyncio.sleep(0, loop=self.loop)
+        self.assertEqual(conn._writer.writelines.call_count, 3)
+        self.assertEqual(len(conn._requests), 2)
+        self.assertEqual(len(conn._queued), 0)
+        conn.close()
+
+    @run_until_complete
+    def test_frame_protocol(self):
+        host, port = self.kafka_host, self.kafka_port
+        conn = yield from create_conn(
+            host, port, loop=self.loop, use_frame_protocol=True)
+        self.assertIsInstance(conn._reader, KafkaProtocol)
+        self.assertEqual(conn.connected(), True)
+
+        request = MetadataRequest([])
+        futures = [conn.send(request) for _ in range(10)]
+        responses = yield from asyncio.gather(*futures, loop=self.loop)
+        for response in responses:
+            self.assertIsInstance(response, MetadataResponse)
+        conn.close()
+        self.assertEqual(conn.connected(), False)
+
+    @run_until_complete
+    def test_frame_protocol_split_frames(self):
+        host, port = self.kafka_host, self.kafka_port
+        conn = AIOKafkaConnection(host=host, port=port, loop=self.loop)
+        protocol = KafkaProtocol(conn, loop=self.loop)
+        conn._reader = protocol
+        conn._writer = mock.MagicMock()
+        conn._writer.transport.get_write_buffer_size.return_value = 0
+
+        request = MetadataRequest([])
+        futures = [conn.send(request) for _ in range(4)]
+        int32 = struct.Struct('>i')
+        data = b''
+        for correlation_id, _, _ in conn._requests:
+            resp = int32.pack(correlation_id) + MetadataResponse(
+                brokers=[(0, 'host', 9092)], topics=[]).encode()
+            data += int32.pack(len(resp)) + resp
+
+        # Two complete frames at once, the rest in small pieces
+        frame_size = len(data) // 4
+        protocol.data_received(data[:frame_size * 2 + 3])
+        self.assertEqual(len(conn._requests), 2)
+        for i in range(frame_size * 2 + 3, len(data), 5):
+            protocol.data_received(data[i:i + 5])
+        self.assertEqual(len(conn._requests), 0)
+        self.assertEqual(protocol._filled, 0)
+        for fut in futures:
+            response = yield from fut
+            self.assertEqual(response.brokers, [(0, 'host', 9092)])
+
+        # Buffer grown for an oversized frame is shrunk when it's consumed
+        protocol.MAX_RETAINED_BUFFER_SIZE = frame_size
+        futures = [conn.send(request) for _ in range(2)]
+        (correlation_id, _, _), _ = conn._requests
+        resp = int32.pack(correlation_id) + MetadataResponse(
+            brokers=[(0, 'host', 9092)] * 10, topics=[]).encode()
+        data = int32.pack(len(resp)) + resp
+        protocol.data_received(data[:10])
+        self.assertEqual(len(protocol._buffer), len(data))
+        protocol.data_received(data[10:])
+        self.assertEqual(len(protocol._buffer), 0)
+        response = yield from futures[0]
+        self.assertEqual(len(response.brokers), 10)
+        correlation_id, _, _ = conn._requests[0]
+        resp = int32.pack(correlation_id) + MetadataResponse(
+            brokers=[(0, 'host', 9092)], topics=[]).encode()
+        protocol.data_received(int32.pack(len(resp)) + resp)
+        response = yield from futures[1]
+        self.assertEqual(response.brokers, [(0, 'host', 9092)])
+
+        # Lost connection fails pending requests
+        fut = conn.send(request)
+        protocol.data_received(data[:6])
+        protocol.connection_lost(None)
+        with self.assertRaises(ConnectionError):
+            yield from fut
+        self.assertEqual(conn.connected(), False)
+
+    @run_until_complete
+    def test_request_timeout(self):
+        host, port = self.kafka_host, self.kafka_port
+        conn = AIOKafkaConnection(
+            host=host, port=port, loop=self.loop, request_timeout_ms=100)
+        conn._reader = mock.MagicMock()
+        conn._read_task = mock.MagicMock()
+        conn._writer = mock.MagicMock()
+        conn._writer.transport.get_write_buffer_size.return_value = 0
+
+        request = MetadataRequest([])
+        first = conn.send(request)
+        cancelled = conn.send(request)
+        cancelled.cancel()
+        yield from asyncio.sleep(0.05, loop=self.loop)
+        last = conn.send(request)
+        self.assertEqual(len(conn._timeouts), 3)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            yield from first
+        self.assertFalse(last.done())
+        self.assertEqual(len(conn._timeouts), 1)
+        with self.assertRaises(asyncio.TimeoutError):
+            yield from last
+        self.assertEqual(len(conn._timeouts), 0)
+        self.assertIsNone(conn._timeout_handle)
+
+        # Answered requests are removed from timeouts queue
+        conn = yield from create_conn(host, port, loop=self.loop)
+        yield from conn.send(request)
+        self.assertEqual(len(conn._timeouts), 0)
+        fut = conn.send(request)
+        conn.close()
+        self.assertEqual(len(conn._timeouts), 0)
+        self.assertIsNone(conn._timeout_handle)
+        with self.assertRaises(asyncio.CancelledError):
+            yield from fut
+
+    def test_request_encoding(self):
+        conn = AIOKafkaConnection(
+            host='localhost', port=1234, loop=self.loop, client_id='test')
+        conn._reader = mock.MagicMock()
+        conn._writer = mock.MagicMock()
+        conn._writer.transport.get_write_buffer_size.return_value = 0
+
+        msg = Message(b'value')
+        request = ProduceRequest(required_acks=1, timeout=1000,
+                                 topics=[('topic', [(0, [(0, 0, msg)])])])
+        conn.send(request)
+        (header, body), = conn._writer.writelines.call_args[0]
+        self.assertEqual(body, request.encode())
+        message = RequestHeader(
+            request, correlation_id=1, client_id='test').encode() + body
+        self.assertEqual(
+            header + body, struct.pack('>i', len(message)) + message)
+        conn.close()
@@ -1,5 +1,7 @@
 import asyncio
+from aiokafka.client import AIOKafkaClient
 from aiokafka.consumer import AIOKafkaConsumer
+from aiokafka.producer import AIOKafkaProducer
 from aiokafka.fetcher import RecordTooLargeError
 
 from kafka.common import TopicPartition, OffsetAndMetadata, IllegalStateError
@@ -299,3 +301,90 @@ class TestConsumerIntegration(KafkaIntegrationTestCase):
         self.assertEqual(set(msgs2), set(result))
         self.assertEqual(consumer.subscription(), set([self.topic]))
         yield from consumer.stop()
+
+    @run_until_complete
+    def test_shared_client(self):
+        client = AIOKafkaClient(loop=self.loop, bootstrap_servers=self.hosts)
+        producer = AIOKafkaProducer(loop=self.loop, client=client)
+        yield from producer.start()
+        yield from self.wait_topic(client, 'shared_client_topic')
+        fut = yield from producer.send(
+            'shared_client_topic', b'value', partition=0)
+        yield from fut
+
+        consumer = AIOKafkaConsumer(
+            'shared_client_topic', loop=self.loop, client=client,
+            auto_offset_reset='earliest')
+        yield from consumer.start()
+        self.assertEqual(client._users, {producer, consumer._subscription})
+        self.assertEqual(
+            client._topic_owners[producer], {'shared_client_topic'})
+        msg = yield from consumer.getone()
+        self.assertEqual(msg.value, b'value')
+
+        # Client is still used by consumer, and tracks topics it needs
+        yield from producer.stop()
+        self.assertIsNotNone(client._sync_task)
+        self.assertNotIn(producer, client._topic_owners)
+        self.assertEqual(client._topics, {'shared_client_topic'})
+        self.assertTrue(
+            (yield from client.ready(client.get_random_node())))
+
+        yield from consumer.stop()
+        self.assertIsNone(client._sync_task)
+
+    @run_until_complete
+    def test_shared_client_release_by_not_started(self):
+        client = AIOKafkaClient(loop=self.loop, bootstrap_servers=self.hosts)
+        producer = AIOKafkaProducer(loop=self.loop, client=client)
+        yield from producer.start()
+        # consumer is never started, but stopped (e.g. in `finally`)
+        consumer = AIOKafkaConsumer(
+            'shared_client_release_topic', loop=self.loop, client=client)
+        yield from consumer.stop()
+        self.assertEqual(client._users, {producer})
+        self.assertIsNotNone(client._sync_task)
+        self.assertNotIn(consumer._subscription, client._topic_owners)
+
+        # client is still usable by producer
+        yield from self.wait_topic(client, 'shared_client_release_topic')
+        fut = yield from producer.send(
+            'shared_client_release_topic', b'value')
+        yield from fut
+        yield from producer.stop()
+        self.assertIsNone(client._sync_task)
+
+    @run_until_complete
+    def test_shared_client_with_pattern_subscription(self):
+        client = AIOKafkaClient(loop=self.loop, bootstrap_servers=self.hosts)
+        consumer = AIOKafkaConsumer(
+            loop=self.loop, client=client, group_id='shared-pattern-group',
+            auto_offset_reset='earliest')
+        consumer.subscribe(pattern='shared-pattern-topic*')
+        yield from consumer.start()
+        producer = AIOKafkaProducer(loop=self.loop, client=client)
+        yield from producer.start()
+        yield from self.wait_topic(client, 'shared-pattern-topic1')
+        fut = yield from producer.send('shared-pattern-topic1', b'value1')
+        yield from fut
+        # topics of producer do not narrow metadata of pattern consumer
+        self.assertIsNone(client._topic_owners[consumer._subscription])
+        self.assertEqual(client._topics, set())
+
+        # new matching topic is discovered by consumer
+        yield from self.wait_topic(client, 'shared-pattern-topic2')
+        fut = yield from producer.send('shared-pattern-topic2', b'value2')
+        yield from fut
+        yield from client.force_metadata_update()
+        self.assertEqual(
+            consumer.subscription(),
+            {'shared-pattern-topic1', 'shared-pattern-topic2'})
+        self.assertEqual(client._topics, set())
+        values = set()
+        for i in range(2):
+            msg = yield from consumer.getone()
+            values.add(msg.value)
+        self.assertEqual(values, {b'value1', b'value2'})
+
+        yield from producer.stop()
+        yield from consumer.stop()
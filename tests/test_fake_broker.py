@@ -0,0 +1,130 @@
+import asyncio
+import unittest
+import pytest
+
+from kafka.common import TopicPartition
+from kafka.protocol.fetch import FetchRequest
+from kafka.protocol.metadata import MetadataRequest
+from kafka.protocol.produce import ProduceRequest
+from kafka.protocol.message import Message
+
+from aiokafka.conn import create_conn
+from aiokafka.consumer import AIOKafkaConsumer
+from aiokafka.fake_broker import FakeKafkaCluster
+from aiokafka.producer import AIOKafkaProducer
+from ._testutil import run_until_complete
+
+
+@pytest.mark.usefixtures('setup_test_class_serverless')
+class TestFakeKafkaCluster(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cluster = FakeKafkaCluster(
+            loop=self.loop, num_nodes=2, num_partitions=2)
+        self.loop.run_until_complete(self.cluster.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.cluster.stop())
+        super().tearDown()
+
+    @run_until_complete
+    def test_metadata_and_auto_create(self):
+        node = self.cluster.nodes[0]
+        conn = yield from create_conn(node.host, node.port, loop=self.loop)
+        resp = yield from conn.send(MetadataRequest(['topic']))
+        self.assertEqual(len(resp.brokers), 2)
+        self.assertEqual(resp.topics, [(5, 'topic', [])])
+
+        resp = yield from conn.send(MetadataRequest([]))
+        error_code, topic, partitions = resp.topics[0]
+        self.assertEqual((error_code, topic), (0, 'topic'))
+        leaders = sorted(leader for _, _, leader, _, _ in partitions)
+        self.assertEqual(leaders, [0, 1])
+
+        yield from self.cluster.nodes[1].stop()
+        resp = yield from conn.send(MetadataRequest([]))
+        self.assertEqual(len(resp.brokers), 1)
+        leaders = sorted(leader for _, _, leader, _, _ in resp.topics[0][2])
+        self.assertEqual(leaders, [-1, 0])
+        conn.close()
+
+    @run_until_complete
+    def test_produce_fetch(self):
+        self.cluster.create_topic('topic')
+        p_log = self.cluster.partition_log('topic', 0)
+        node = self.cluster.nodes[p_log.leader]
+        other = self.cluster.nodes[1 - p_log.leader]
+        conn = yield from create_conn(node.host, node.port, loop=self.loop)
+
+        msgs = [(0, 0, Message(b'value-%d' % i)) for i in range(3)]
+        request = ProduceRequest(
+            required_acks=1, timeout=1000,
+            topics=[('topic', [(0, msgs)])])
+        resp = yield from conn.send(request)
+        self.assertEqual(resp.topics, [('topic', [(0, 0, 0)])])
+        resp = yield from conn.send(request)
+        self.assertEqual(resp.topics, [('topic', [(0, 0, 3)])])
+        self.assertEqual(p_log.highwater, 6)
+
+        resp = yield from conn.send(
+            FetchRequest(-1, 100, 1, [('topic', [(0, 4, 1024)])]))
+        _, partitions = resp.topics[0]
+        partition, error_code, highwater, messages = partitions[0]
+        self.assertEqual((partition, error_code, highwater), (0, 0, 6))
+        self.assertEqual([offset for offset, _, _ in messages], [4, 5])
+        self.assertEqual(messages[0][2].value, b'value-1')
+
+        # Out of range offset and request to the wrong leader
+        resp = yield from conn.send(
+            FetchRequest(-1, 100, 1, [('topic', [(0, 7, 1024)])]))
+        self.assertEqual(resp.topics[0][1][0][1], 1)
+        other_conn = yield from create_conn(
+            other.host, other.port, loop=self.loop)
+        resp = yield from other_conn.send(request)
+        self.assertEqual(resp.topics, [('topic', [(0, 6, -1)])])
+
+        # Long poll returns as soon as data arrives
+        fetch = conn.send(
+            FetchRequest(-1, 10000, 1, [('topic', [(0, 6, 1024)])]))
+        yield from asyncio.sleep(0.1, loop=self.loop)
+        t0 = self.loop.time()
+        p_log.append(msgs[:1])
+        self.cluster._notify_data()
+        resp = yield from fetch
+        self.assertLess(self.loop.time() - t0, 1)
+        self.assertEqual(len(resp.topics[0][1][0][3]), 1)
+        conn.close()
+        other_conn.close()
+
+    @run_until_complete
+    def test_producer_consumer_group(self):
+        producer = AIOKafkaProducer(
+            loop=self.loop, compression_type='gzip',
+            bootstrap_servers=self.cluster.bootstrap_servers)
+        yield from producer.start()
+        self.cluster.create_topic('topic')
+        futures = []
+        for i in range(10):
+            fut = yield from producer.send(
+                'topic', b'value-%d' % i, partition=i % 2)
+            futures.append(fut)
+        yield from asyncio.wait(futures, loop=self.loop)
+        offsets = sorted(fut.result().offset for fut in futures)
+        self.assertEqual(offsets, [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+        yield from producer.stop()
+
+        consumer = AIOKafkaConsumer(
+            'topic', loop=self.loop, group_id='test-group',
+            auto_offset_reset='earliest',
+            bootstrap_servers=self.cluster.bootstrap_servers)
+        yield from consumer.start()
+        values = set()
+        while len(values) < 10:
+            msg = yield from consumer.getone()
+            values.add(msg.value)
+        self.assertEqual(values, set(b'value-%d' % i for i in range(10)))
+        yield from consumer.commit()
+        committed = yield from consumer.committed(TopicPartition('topic', 0))
+        self.assertEqual(committed, 5)
+        yield from consumer.stop()
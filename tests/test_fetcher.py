@@ -40,7 +40,7 @@ class TestFetcher(unittest.TestCase):
         client.ready.side_effect = asyncio.coroutine(lambda a: True)
         client.force_metadata_update = mock.MagicMock()
         client.force_metadata_update.side_effect = asyncio.coroutine(
-            lambda: False)
+            lambda topics=None: False)
         client.send = mock.MagicMock()
         client.send.side_effect = asyncio.coroutine(
             lambda n, r: OffsetResponse([('test', [(0, 0, [4])])]))
@@ -83,7 +83,7 @@ class TestFetcher(unittest.TestCase):
         client.ready.side_effect = asyncio.coroutine(lambda a: True)
         client.force_metadata_update = mock.MagicMock()
         client.force_metadata_update.side_effect = asyncio.coroutine(
-            lambda: False)
+            lambda topics=None: False)
         client.send = mock.MagicMock()
         msg = Message(b"test msg")
         msg._encode_self()
@@ -3,13 +3,19 @@ import asyncio
 import pytest
 import unittest
 from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
 from kafka.cluster import ClusterMetadata
+from kafka.protocol.message import MessageSet
+from kafka.protocol.metadata import MetadataResponse
 from kafka.common import (TopicPartition, KafkaTimeoutError,
                           NotLeaderForPartitionError,
                           LeaderNotAvailableError)
 from ._testutil import run_until_complete
-from aiokafka.message_accumulator import MessageAccumulator, MessageBatch
+from aiokafka import ensure_future
+from aiokafka.cluster import ClusterMetadata as AIOKafkaClusterMetadata
+from aiokafka.message_accumulator import (
+    MessageAccumulator, MessageBatch, BufferPool)
 
 
 @pytest.mark.usefixtures('setup_test_class_serverless')
@@ -175,3 +181,310 @@ class TestMessageAccumulator(unittest.TestCase):
         batches[0][tp0].done(base_offset=None)
         res = yield from fut01
         self.assertEqual(res, None)
+
+        # batches for partitions with a batch in flight are not drained
+        yield from ma.add_message(tp0, b'key0', b'value#0', timeout=2)
+        yield from ma.add_message(tp1, b'key1', b'value#1', timeout=2)
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[], muted_partitions={tp0})
+        self.assertEqual(list(batches), [1])
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(list(batches), [0])
+
+    @run_until_complete
+    def test_add_batch(self):
+        cluster = ClusterMetadata(metadata_max_age_ms=10000)
+        cluster.leader_for_partition = mock.MagicMock()
+        cluster.leader_for_partition.return_value = 0
+        ma = MessageAccumulator(cluster, 1000, None, 30, self.loop)
+        tp = TopicPartition("test-topic", 0)
+        fut = yield from ma.add_message(tp, None, b'single', timeout=2)
+        messages = [(None, b'value-%03d' % i) for i in range(30)]
+        add_task = ensure_future(
+            ma.add_batch(tp, messages, timeout=2), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        # first batch is full, waiting for drain
+        self.assertFalse(add_task.done())
+
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        first = batches[0][tp]
+        futures = yield from add_task
+        self.assertEqual(len(futures), 2)
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        second = batches[0][tp]
+        self.assertEqual(first._relative_offset +
+                         second._relative_offset, 31)
+        # message futures are created for `add_message` only
+        self.assertEqual(len(first._msg_futures), 1)
+        self.assertEqual(len(second._msg_futures), 0)
+
+        first.done(base_offset=10)
+        second.done(base_offset=10 + first._relative_offset)
+        res = yield from futures[0]
+        self.assertEqual(res.topic_partition, tp)
+        self.assertEqual(res.base_offset, 10)
+        self.assertEqual(res.record_count, first._relative_offset)
+        res = yield from futures[1]
+        self.assertEqual(res.base_offset, 10 + first._relative_offset)
+        self.assertEqual(res.record_count, second._relative_offset)
+        self.assertEqual((yield from fut).offset, 10)
+
+    @run_until_complete
+    def test_add_batch_timeout(self):
+        cluster = ClusterMetadata(metadata_max_age_ms=10000)
+        cluster.leader_for_partition = mock.MagicMock()
+        cluster.leader_for_partition.return_value = 0
+        ma = MessageAccumulator(cluster, 1000, None, 30, self.loop)
+        tp = TopicPartition("test-topic", 0)
+        messages = [(None, b'value-%03d' % i) for i in range(60)]
+        # first batch is full and is not drained in time
+        with self.assertRaises(KafkaTimeoutError) as cm:
+            yield from ma.add_batch(tp, messages, timeout=0.1)
+        self.assertEqual(len(cm.exception.futures), 1)
+        accepted = cm.exception.accepted
+        self.assertGreater(accepted, 0)
+        self.assertLess(accepted, len(messages))
+
+        # accepted messages are sent anyway
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        batch = batches[0][tp]
+        self.assertEqual(batch._relative_offset, accepted)
+        batch.done(base_offset=0)
+        res = yield from cm.exception.futures[0]
+        self.assertEqual(res.record_count, accepted)
+
+    @run_until_complete
+    def test_add_message_no_future(self):
+        cluster = ClusterMetadata(metadata_max_age_ms=10000)
+        cluster.leader_for_partition = mock.MagicMock()
+        cluster.leader_for_partition.return_value = 0
+        errors = []
+        ma = MessageAccumulator(
+            cluster, 1000, None, 30, self.loop,
+            on_error=lambda *args: errors.append(args))
+        tp = TopicPartition("test-topic", 0)
+        fut = yield from ma.add_message(tp, None, b'value', timeout=2)
+        for i in range(3):
+            res = yield from ma.add_message(
+                tp, None, b'value', timeout=2, no_future=True)
+            self.assertIsNone(res)
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        batch = batches[0][tp]
+        self.assertEqual(len(batch._msg_futures), 1)
+
+        err = LeaderNotAvailableError()
+        batch.done(exception=err)
+        self.assertEqual(errors, [(err, tp, 3)])
+        with self.assertRaises(LeaderNotAvailableError):
+            yield from fut
+
+        # close waits for batches without futures too
+        yield from ma.add_message(
+            tp, None, b'value', timeout=2, no_future=True)
+        close_task = ensure_future(ma.close(), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertFalse(close_task.done())
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        batches[0][tp].done(base_offset=0)
+        yield from close_task
+        self.assertEqual(len(errors), 1)
+
+    @run_until_complete
+    def test_linger(self):
+        cluster = ClusterMetadata(metadata_max_age_ms=10000)
+        cluster.leader_for_partition = mock.MagicMock()
+        cluster.leader_for_partition.return_value = 0
+        ma = MessageAccumulator(
+            cluster, 1000, None, 30, self.loop, linger_time=0.1)
+        self.assertIsNone(ma.next_linger_deadline())
+        tp0 = TopicPartition("test-topic", 0)
+        tp1 = TopicPartition("test-topic", 1)
+        data_waiter = ma.data_waiter()
+        yield from ma.add_message(tp0, None, b'value', timeout=2)
+        # sender is woken up to schedule linger timer
+        self.assertTrue(data_waiter.done())
+        deadline = ma.next_linger_deadline()
+        self.assertGreater(deadline, self.loop.time())
+
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(batches, {})
+        # batch with a later deadline does not wake up sender
+        data_waiter = ma.data_waiter()
+        yield from ma.add_message(tp1, None, b'value', timeout=2)
+        self.assertFalse(data_waiter.done())
+        self.assertEqual(ma.next_linger_deadline(), deadline)
+
+        # full batch is drained without waiting for linger time
+        add_task = ensure_future(
+            ma.add_message(tp1, None, b'0123456789'*100, timeout=2),
+            loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertTrue(data_waiter.done())
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(list(batches[0]), [tp1])
+        yield from add_task
+        # the new tp1 batch lingers after tp0 one
+        self.assertEqual(ma.next_linger_deadline(), deadline)
+
+        yield from asyncio.sleep(
+            deadline - self.loop.time(), loop=self.loop)
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(list(batches[0]), [tp0])
+        self.assertGreater(ma.next_linger_deadline(), deadline)
+
+        # closed accumulator drains lingering batches at once
+        close_task = ensure_future(ma.close(), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertIsNone(ma.next_linger_deadline())
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(list(batches[0]), [tp1])
+        batches[0][tp1].done(base_offset=0)
+        yield from close_task
+
+    @run_until_complete
+    def test_buffer_memory(self):
+        cluster = ClusterMetadata(metadata_max_age_ms=10000)
+        cluster.leader_for_partition = mock.MagicMock()
+        cluster.leader_for_partition.return_value = 0
+        ma = MessageAccumulator(
+            cluster, 1000, None, 30, self.loop, buffer_memory=2000)
+        tp0 = TopicPartition("test-topic", 0)
+        tp1 = TopicPartition("test-topic", 1)
+        tp2 = TopicPartition("test-topic", 2)
+        yield from ma.add_message(tp0, None, b'0123456789'*80, timeout=2)
+        yield from ma.add_message(tp1, None, b'value', timeout=2)
+        self.assertEqual(ma._pool.available_memory, 0)
+        with self.assertRaises(KafkaTimeoutError):
+            yield from ma.add_message(tp2, None, b'value', timeout=0.1)
+
+        add_task = ensure_future(
+            ma.add_message(tp2, None, b'value', timeout=2), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertFalse(add_task.done())
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        # drained batches are sent from their buffers until they are done
+        self.assertFalse(add_task.done())
+        self.assertEqual(ma._pool.available_memory, 0)
+        messages = MessageSet.decode(batches[0][tp0].data())
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0][2].value, b'0123456789'*80)
+        batches[0][tp0].done(base_offset=0)
+        batches[0][tp1].done(base_offset=0)
+        yield from add_task
+        # one buffer is reused by tp2 batch, another one is free
+        self.assertEqual(ma._pool.available_memory, 1000)
+
+        # reused buffer does not contain data of the previous batch
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        messages = MessageSet.decode(batches[0][tp2].data())
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0][2].value, b'value')
+        self.assertEqual(ma._pool.available_memory, 1000)
+        batches[0][tp2].done(base_offset=0)
+        self.assertEqual(ma._pool.available_memory, 2000)
+
+    @run_until_complete
+    def test_compression_executor(self):
+        cluster = ClusterMetadata(metadata_max_age_ms=10000)
+        cluster.leader_for_partition = mock.MagicMock()
+        cluster.leader_for_partition.return_value = 0
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        ma = MessageAccumulator(
+            cluster, 1000, 'gzip', 30, self.loop, buffer_memory=2000,
+            compression_executor=executor, max_compressing_batches=1)
+        tp0 = TopicPartition("test-topic", 0)
+        tp1 = TopicPartition("test-topic", 1)
+        yield from ma.add_message(tp0, b'key', b'value', timeout=2)
+        yield from ma.add_message(tp0, None, b'other value', timeout=2)
+        yield from ma.add_message(tp1, None, b'value', timeout=2)
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        batches = batches[0]
+        # batches are not compressed on drain
+        self.assertTrue(batches[tp0].needs_compression)
+        messages = MessageSet.decode(batches[tp0].data())
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(ma._pool.available_memory, 0)
+
+        yield from ma.compress_batches(batches)
+        self.assertEqual(len(batches), 2)
+        # buffers are released once batches are compressed, before delivery
+        self.assertEqual(ma._pool.available_memory, 2000)
+        for tp, values in [(tp0, [b'value', b'other value']),
+                           (tp1, [b'value'])]:
+            self.assertFalse(batches[tp].needs_compression)
+            messages = MessageSet.decode(batches[tp].data())
+            self.assertEqual(len(messages), 1)
+            wrapper = messages[0][2]
+            self.assertTrue(wrapper.is_compressed())
+            self.assertEqual(
+                [msg.value for _, _, msg in wrapper.decompress()], values)
+
+    @run_until_complete
+    def test_ready_batches_by_leader(self):
+        cluster = AIOKafkaClusterMetadata(metadata_max_age_ms=10000)
+        brokers = [(0, 'broker_1', 4567), (1, 'broker_2', 5678)]
+        cluster.update_metadata(MetadataResponse(brokers, [
+            (0, 'test-topic', [(0, 0, 0, [], []), (0, 1, -1, [], [])])]))
+        ma = MessageAccumulator(cluster, 1000, None, 0.1, self.loop)
+        tp0 = TopicPartition("test-topic", 0)
+        tp1 = TopicPartition("test-topic", 1)
+        fut0 = yield from ma.add_message(tp0, None, b'value', timeout=2)
+        fut1 = yield from ma.add_message(tp1, None, b'value', timeout=2)
+        batches, unknown_leaders_exist = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(list(batches), [0])
+        self.assertTrue(unknown_leaders_exist)
+        self.assertEqual(ma.unknown_leader_topics(), {'test-topic'})
+        batches[0][tp0].done(base_offset=0)
+        self.assertEqual((yield from fut0).offset, 0)
+        with mock.patch.object(
+                cluster, 'leader_for_partition',
+                wraps=cluster.leader_for_partition) as leader_for_partition:
+            # leaders of pending batches are not looked up again while
+            # metadata is the same
+            for i in range(3):
+                ma.drain_by_nodes(ignore_nodes=[])
+            self.assertFalse(leader_for_partition.called)
+
+        yield from asyncio.sleep(0.15, loop=self.loop)
+        batches, unknown_leaders_exist = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(batches, {})
+        self.assertFalse(unknown_leaders_exist)
+        with self.assertRaises(LeaderNotAvailableError):
+            yield from fut1
+
+        # batch is moved to the new leader on metadata update
+        yield from ma.add_message(tp1, None, b'value', timeout=2)
+        batches, _ = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(batches, {})
+        cluster.update_metadata(MetadataResponse(brokers, [
+            (0, 'test-topic', [(0, 0, 0, [], []), (0, 1, 1, [], [])])]))
+        batches, unknown_leaders_exist = ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(list(batches[1]), [tp1])
+        self.assertFalse(unknown_leaders_exist)
+
+    @run_until_complete
+    def test_buffer_pool_cancelled_allocate(self):
+        pool = BufferPool(100, 100, self.loop)
+        buf = yield from pool.allocate(timeout=1)
+        self.assertEqual(pool.available_memory, 0)
+
+        # cancelled while waiting for a buffer
+        task = ensure_future(pool.allocate(timeout=1), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        task.cancel()
+        yield from asyncio.wait([task], loop=self.loop)
+        pool.deallocate(buf)
+        self.assertEqual(pool.available_memory, 100)
+
+        # cancelled after buffer is given to it
+        buf = yield from pool.allocate(timeout=1)
+        task = ensure_future(pool.allocate(timeout=1), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        pool.deallocate(buf)
+        task.cancel()
+        yield from asyncio.wait([task], loop=self.loop)
+        self.assertTrue(task.cancelled())
+        self.assertEqual(pool.available_memory, 100)
+        buf = yield from pool.allocate(timeout=0.1)
+        self.assertEqual(len(buf), 100)
@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+import pytest
+
+from kafka.cluster import ClusterMetadata
+from kafka.common import TopicPartition
+from kafka.protocol.metadata import MetadataResponse
+
+from aiokafka.client import AIOKafkaClient
+from aiokafka.fake_broker import FakeKafkaCluster
+from aiokafka.metadata_cache import MetadataCache
+from ._testutil import run_until_complete
+
+
+@pytest.mark.usefixtures('setup_test_class_serverless')
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def test_save_load(self):
+        cache = MetadataCache(self.cache_dir, [('h1', 9092), ('h2', 9093)])
+        self.assertIsNone(cache.load())
+
+        cluster = ClusterMetadata()
+        cluster.update_metadata(MetadataResponse(
+            [(0, 'h1', 9092), (1, 'h2', 9093)],
+            [(0, 'topic', [(0, 0, 1, [1, 0], [1]), (0, 1, 0, [0], [0])])]))
+        cache.save(cluster, '0.9')
+
+        # Key does not depend on order of servers
+        cache = MetadataCache(self.cache_dir, [('h2', 9093), ('h1', 9092)])
+        metadata, api_version = cache.load()
+        self.assertEqual(api_version, '0.9')
+        restored = ClusterMetadata()
+        restored.update_metadata(metadata)
+        self.assertEqual(restored.brokers(), cluster.brokers())
+        self.assertEqual(
+            restored.leader_for_partition(TopicPartition('topic', 0)), 1)
+        self.assertEqual(
+            restored.leader_for_partition(TopicPartition('topic', 1)), 0)
+
+        self.assertIsNone(
+            MetadataCache(self.cache_dir, [('h1', 9092)]).load())
+        with open(cache.path, 'w') as f:
+            f.write('{"version": 1, "bro')
+        self.assertIsNone(cache.load())
+        self.assertEqual(os.listdir(self.cache_dir),
+                         [os.path.basename(cache.path)])
+
+    @run_until_complete
+    def test_client_warm_start(self):
+        cluster = FakeKafkaCluster(loop=self.loop)
+        yield from cluster.start()
+        cluster.create_topic('topic')
+
+        client = AIOKafkaClient(
+            loop=self.loop, bootstrap_servers=cluster.bootstrap_servers,
+            metadata_cache_dir=self.cache_dir)
+        yield from client.bootstrap()
+        self.assertIsNone(client._revalidate_task)
+        version = yield from client.check_version()
+        yield from client.close()
+
+        client = AIOKafkaClient(
+            loop=self.loop, bootstrap_servers=cluster.bootstrap_servers,
+            metadata_cache_dir=self.cache_dir)
+        yield from client.bootstrap()
+        # Cached metadata is used, bootstrap goes in the background
+        self.assertIsNotNone(client._revalidate_task)
+        self.assertEqual(client.cluster.partitions_for_topic('topic'), {0})
+        self.assertEqual((yield from client.check_version()), version)
+
+        cluster.create_topic('new_topic')
+        yield from client._revalidate_task
+        self.assertIn('new_topic', client.cluster.topics())
+        metadata, cached_version = client._metadata_cache.load()
+        self.assertEqual(cached_version, version)
+        self.assertEqual(len(metadata.topics), 2)
+        yield from client.close()
+        yield from cluster.stop()
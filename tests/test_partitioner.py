@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+import unittest
+from unittest import mock
+
+from kafka.cluster import ClusterMetadata
+from kafka.common import TopicPartition
+
+from ._testutil import run_until_complete
+from aiokafka import ensure_future
+from aiokafka.message_accumulator import MessageAccumulator
+from aiokafka.partitioner import StickyPartitioner
+
+
+@pytest.mark.usefixtures('setup_test_class_serverless')
+class TestStickyPartitioner(unittest.TestCase):
+
+    def test_partition(self):
+        keyed = mock.Mock(return_value=7)
+        partitioner = StickyPartitioner(keyed)
+        all_partitions = (0, 1, 2, 3)
+        available = (1, 2, 3)
+        self.assertEqual(
+            partitioner.partition('topic', b'key', all_partitions, available),
+            7)
+        keyed.assert_called_with(b'key', all_partitions, available)
+
+        partition = partitioner.partition(
+            'topic', None, all_partitions, available)
+        self.assertIn(partition, available)
+        for _ in range(10):
+            self.assertEqual(partitioner.partition(
+                'topic', None, all_partitions, available), partition)
+
+        # rollover of other partitions does not change sticky partition
+        other = 1 if partition != 1 else 2
+        partitioner.on_batch_rollover(TopicPartition('topic', other))
+        partitioner.on_batch_rollover(TopicPartition('other', partition))
+        self.assertEqual(partitioner.partition(
+            'topic', None, all_partitions, available), partition)
+
+        with mock.patch('random.choice', return_value=other):
+            partitioner.on_batch_rollover(TopicPartition('topic', partition))
+            self.assertEqual(partitioner.partition(
+                'topic', None, all_partitions, available), other)
+        # sticky partition is changed if its leader is not available
+        self.assertEqual(partitioner.partition(
+            'topic', None, all_partitions, (partition,)), partition)
+
+        # sticky partition is checked against precomputed sets if given
+        sets = dict(partitions_set=frozenset(all_partitions),
+                    available_set=frozenset(available))
+        self.assertEqual(partitioner.partition(
+            'topic', None, all_partitions, available, **sets), partition)
+        partitioner.on_batch_rollover(TopicPartition('topic', partition))
+        with mock.patch('random.choice', return_value=3) as choice:
+            self.assertEqual(partitioner.partition(
+                'topic', None, all_partitions, (3,),
+                partitions_set=frozenset(all_partitions),
+                available_set=frozenset([3])), 3)
+            choice.assert_called_once_with((3,))
+        # all partitions are used if none is available
+        self.assertEqual(partitioner.partition(
+            'topic', None, all_partitions, (), **sets), 3)
+
+    @run_until_complete
+    def test_accumulator_rollover(self):
+        cluster = ClusterMetadata(metadata_max_age_ms=10000)
+        cluster.leader_for_partition = mock.MagicMock()
+        cluster.leader_for_partition.return_value = 0
+        rollover = mock.Mock()
+        ma = MessageAccumulator(
+            cluster, 1000, None, 30, self.loop, on_batch_rollover=rollover)
+        tp = TopicPartition("test-topic", 0)
+        yield from ma.add_message(tp, None, b'0123456789'*80, timeout=2)
+        self.assertFalse(rollover.called)
+
+        # batch is full
+        add_task = ensure_future(
+            ma.add_message(tp, None, b'0123456789'*80, timeout=2),
+            loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        rollover.assert_called_once_with(tp)
+
+        # batch is drained
+        ma.drain_by_nodes(ignore_nodes=[])
+        yield from add_task
+        self.assertEqual(rollover.call_count, 2)
+        ma.drain_by_nodes(ignore_nodes=[])
+        self.assertEqual(rollover.call_count, 3)
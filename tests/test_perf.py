@@ -0,0 +1,48 @@
+import unittest
+import pytest
+
+from aiokafka.fake_broker import FakeKafkaCluster
+from aiokafka.perf import PerfStats, _parse_args, producer_perf, consumer_perf
+from ._testutil import run_until_complete
+
+
+@pytest.mark.usefixtures('setup_test_class_serverless')
+class TestPerf(unittest.TestCase):
+
+    def test_stats(self):
+        stats = PerfStats(num_records=1000, max_samples=100)
+        for i in range(1000):
+            stats.record(10, latency=i / 1000)
+        self.assertEqual(stats.records, 1000)
+        self.assertEqual(stats.bytes, 10000)
+        self.assertEqual(len(stats._latencies), 100)
+        self.assertEqual(stats.percentile(0.5), 500)
+        self.assertEqual(stats.percentile(0.999), 990)
+        self.assertIn('1000 records sent', stats.summary('sent'))
+        self.assertIn('99.9th', stats.summary('sent'))
+
+        stats = PerfStats(num_records=10)
+        stats.record(10)
+        self.assertIsNone(stats.percentile(0.5))
+        self.assertNotIn('latency', stats.summary('consumed'))
+
+    @run_until_complete
+    def test_producer_consumer_perf(self):
+        cluster = FakeKafkaCluster(loop=self.loop, num_partitions=2)
+        yield from cluster.start()
+        args = _parse_args([
+            'producer', '--num-records', '200', '--record-size', '20',
+            '--linger-ms', '5', '--acks', 'all',
+            '--bootstrap-servers', ','.join(cluster.bootstrap_servers)])
+        self.assertEqual(args.acks, 'all')
+        cluster.create_topic(args.topic)
+        stats = yield from producer_perf(args, loop=self.loop)
+        self.assertEqual(stats.records, 200)
+        self.assertEqual(stats.bytes, 4000)
+        self.assertIsNotNone(stats.percentile(0.99))
+
+        args.mode = 'consumer'
+        stats = yield from consumer_perf(args, loop=self.loop)
+        self.assertEqual(stats.records, 200)
+        self.assertIsNotNone(stats.percentile(0.99))
+        yield from cluster.stop()
@@ -1,20 +1,26 @@
+import io
 import json
+import collections
 import asyncio
 from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
 from kafka.cluster import ClusterMetadata
-from kafka.common import (KafkaTimeoutError,
+from kafka.common import (TopicPartition,
+                          KafkaTimeoutError,
                           UnknownTopicOrPartitionError,
                           MessageSizeTooLargeError,
                           NotLeaderForPartitionError,
                           LeaderNotAvailableError,
                           RequestTimedOutError)
-from kafka.protocol.produce import ProduceResponse
+from kafka.protocol.message import Message, MessageSet
+from kafka.protocol.produce import ProduceRequest, ProduceResponse
 
 from ._testutil import KafkaIntegrationTestCase, run_until_complete
 
-from aiokafka.producer import AIOKafkaProducer
+from aiokafka.producer import AIOKafkaProducer, EncodedProduceRequest
 from aiokafka.message_accumulator import ProducerClosed
+from aiokafka.partitioner import StickyPartitioner
 
 
 class TestKafkaProducerIntegration(KafkaIntegrationTestCase):
@@ -55,9 +61,14 @@ class TestKafkaProducerIntegration(KafkaIntegrationTestCase):
         self.assertTrue(resp.partition in (0, 1))
         self.assertEqual(resp.offset, 0)
 
-        fut = yield from producer.send(self.topic, b'second msg', partition=1)
-        resp = yield from fut
+        # packing efficiency is logged for single request as well
+        with self.assertLogs('aiokafka', 'DEBUG') as cm:
+            fut = yield from producer.send(
+                self.topic, b'second msg', partition=1)
+            resp = yield from fut
         self.assertEqual(resp.partition, 1)
+        self.assertTrue(any(
+            'packed into 1 produce requests' in line for line in cm.output))
 
         future = yield from producer.send(self.topic, b'value', key=b'KEY')
         resp = yield from future
@@ -138,6 +149,19 @@ class TestKafkaProducerIntegration(KafkaIntegrationTestCase):
         self.assertTrue(resp.partition in (0, 1))
         yield from producer.stop()
 
+        # compression in thread pool
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        producer = AIOKafkaProducer(
+            loop=self.loop, bootstrap_servers=self.hosts,
+            compression_type='gzip', compression_executor=executor)
+        yield from producer.start()
+        future = yield from producer.send(
+            self.topic, b'this msg is compressed in executor')
+        resp = yield from future
+        self.assertEqual(resp.topic, self.topic)
+        yield from producer.stop()
+
     @run_until_complete
     def test_producer_send_leader_notfound(self):
         producer = AIOKafkaProducer(
@@ -162,6 +186,40 @@ class TestKafkaProducerIntegration(KafkaIntegrationTestCase):
 
         yield from producer.stop()
 
+    @run_until_complete
+    def test_producer_send_no_future(self):
+        errors = []
+        producer = AIOKafkaProducer(
+            loop=self.loop, bootstrap_servers=self.hosts,
+            request_timeout_ms=200,
+            on_error=lambda *args: errors.append(args))
+        yield from producer.start()
+        yield from self.wait_topic(producer.client, self.topic)
+
+        res = yield from producer.send(
+            self.topic, b'text', partition=0, no_future=True)
+        self.assertIsNone(res)
+        fut = yield from producer.send(self.topic, b'text', partition=0)
+        yield from fut
+        self.assertEqual(producer.send_errors, 0)
+
+        with mock.patch.object(
+                ClusterMetadata, 'leader_for_partition') as mocked:
+            mocked.return_value = -1
+            for i in range(3):
+                yield from producer.send(
+                    self.topic, b'text', partition=0, no_future=True)
+            fut = yield from producer.send(self.topic, b'text', partition=0)
+            with self.assertRaises(LeaderNotAvailableError):
+                yield from fut
+        self.assertEqual(producer.send_errors, 3)
+        self.assertEqual(len(errors), 1)
+        err, tp, count = errors[0]
+        self.assertIsInstance(err, LeaderNotAvailableError)
+        self.assertEqual(tp, TopicPartition(self.topic, 0))
+        self.assertEqual(count, 3)
+        yield from producer.stop()
+
     @run_until_complete
     def test_producer_send_timeout(self):
         producer = AIOKafkaProducer(
@@ -216,3 +274,171 @@ class TestKafkaProducerIntegration(KafkaIntegrationTestCase):
                 future = yield from producer.send(
                     self.topic, b'text1', partition=0)
                 yield from future
+
+    def test_producer_pack_batches(self):
+        producer = AIOKafkaProducer(
+            loop=self.loop, bootstrap_servers=self.hosts,
+            max_request_size=2000)
+        sizes = [900, 800, 700, 500, 300, 200, 100, 2500]
+        batches = {}
+        for partition, size in enumerate(sizes):
+            batch = mock.Mock()
+            batch.data_bytes.return_value = b'x' * size
+            batches[TopicPartition('topic', partition)] = batch
+
+        requests = producer._pack_batches(batches)
+        packed = {}
+        for request_batches in requests:
+            packed.update(request_batches)
+            if len(request_batches) > 1:
+                self.assertLessEqual(
+                    sum(map(producer._batch_request_size,
+                            request_batches.items())),
+                    2000 - producer._REQUEST_OVERHEAD)
+        self.assertEqual(packed, batches)
+        # oversized batch is sent alone, others take the minimal number of
+        # requests
+        self.assertEqual(len(requests), 4)
+        self.assertEqual(requests[0], {TopicPartition('topic', 7): mock.ANY})
+
+        one = {TopicPartition('topic', 0): batches[TopicPartition('topic', 0)]}
+        self.assertEqual(producer._pack_batches(one), [one])
+
+    def test_encoded_produce_request(self):
+        message_sets = [
+            MessageSet.encode([(0, 0, Message(b'value-%d' % i, key=b'key'))])
+            for i in range(3)]
+        topics = [('topic1', [(0, message_sets[0]), (3, message_sets[1])]),
+                  ('topic2', [(1, message_sets[2])])]
+        request = EncodedProduceRequest(
+            required_acks=1, timeout=1000, topics=topics)
+        buffers = request.encode()
+        # message sets are referenced, not copied
+        for message_set in message_sets:
+            self.assertTrue(any(buf is message_set for buf in buffers))
+        expected = ProduceRequest(
+            required_acks=1, timeout=1000, topics=[
+                (topic, [(partition, io.BytesIO(data))
+                         for partition, data in partitions])
+                for topic, partitions in topics]).encode()
+        self.assertEqual(b''.join(buffers), expected)
+        self.assertIn("'topic1', [0, 3]", repr(request))
+
+    @run_until_complete
+    def test_producer_connections_per_broker(self):
+        producer = AIOKafkaProducer(
+            loop=self.loop, bootstrap_servers=self.hosts,
+            max_batch_size=100, connections_per_broker=3)
+        yield from producer.start()
+        topic = 'test_producer_connections_topic'
+        yield from self.wait_topic(producer.client, topic)
+        futures = []
+        for i in range(100):
+            fut = yield from producer.send(
+                topic, b'value-%d' % i, partition=i % 2)
+            futures.append(fut)
+        yield from asyncio.wait(futures, loop=self.loop)
+        # Message order is preserved within partition
+        for partition in (0, 1):
+            offsets = [fut.result().offset for fut in futures[partition::2]]
+            self.assertEqual(offsets, sorted(offsets))
+        self.assertFalse(any(producer._in_flight.values()))
+        self.assertEqual(producer._in_flight_partitions, set())
+        yield from producer.stop()
+
+    @run_until_complete
+    def test_producer_node_senders(self):
+        producer = AIOKafkaProducer(
+            loop=self.loop, bootstrap_servers=self.hosts,
+            max_batch_size=100, connections_per_broker=2)
+        yield from producer.start()
+        topic = 'test_producer_node_senders_topic'
+        yield from self.wait_topic(producer.client, topic)
+
+        in_flight = collections.Counter()
+        max_in_flight = collections.Counter()
+
+        @asyncio.coroutine
+        def mocked_send(node_id, request):
+            in_flight[node_id] += 1
+            max_in_flight[node_id] = max(
+                max_in_flight[node_id], in_flight[node_id])
+            yield from asyncio.sleep(0.01, loop=self.loop)
+            in_flight[node_id] -= 1
+            return ProduceResponse([
+                (topic, [(partition, 0, 0) for partition, _ in partitions])
+                for topic, partitions in request.topics])
+
+        with mock.patch.object(producer.client, 'send') as mocked:
+            mocked.side_effect = mocked_send
+            futures = []
+            for i in range(40):
+                fut = yield from producer.send(
+                    topic, b'value-%d' % i, partition=i % 2)
+                futures.append(fut)
+            yield from asyncio.gather(*futures, loop=self.loop)
+
+        # one sender per node, with in flight requests limited by
+        # connections_per_broker
+        self.assertEqual(set(producer._node_senders), set(max_in_flight))
+        for node_id, count in max_in_flight.items():
+            self.assertLessEqual(count, 2)
+            self.assertEqual(
+                len(producer._node_senders[node_id]._workers), 2)
+        self.assertEqual(producer._busy_nodes, set())
+        yield from producer.stop()
+        self.assertEqual(producer._node_senders, {})
+
+    @run_until_complete
+    def test_producer_send_batch(self):
+        producer = AIOKafkaProducer(
+            loop=self.loop, bootstrap_servers=self.hosts,
+            max_batch_size=1000)
+        yield from producer.start()
+        topic1 = 'test_producer_send_batch_topic1'
+        topic2 = 'test_producer_send_batch_topic2'
+        yield from self.wait_topic(producer.client, topic1)
+        yield from self.wait_topic(producer.client, topic2)
+
+        futures = yield from producer.send_batch(
+            topic1, [(None, b'value-%d' % i) for i in range(100)],
+            partition=0)
+        # messages do not fit into one batch
+        self.assertGreater(len(futures), 1)
+        results = yield from asyncio.gather(*futures, loop=self.loop)
+        self.assertEqual(sum(res.record_count for res in results), 100)
+        self.assertEqual(results[0].base_offset, 0)
+        for prev, res in zip(results, results[1:]):
+            self.assertEqual(res.base_offset,
+                             prev.base_offset + prev.record_count)
+
+        futures = yield from producer.send_batches({
+            topic1: [(b'key-%d' % i, b'value') for i in range(10)],
+            topic2: [(None, b'value')]})
+        results = yield from asyncio.gather(*futures, loop=self.loop)
+        self.assertEqual(
+            sum(res.record_count for res in results
+                if res.topic == topic1), 10)
+        self.assertEqual(
+            [res.record_count for res in results if res.topic == topic2],
+            [1])
+        yield from producer.stop()
+
+    @run_until_complete
+    def test_producer_sticky_partitioner(self):
+        producer = AIOKafkaProducer(
+            loop=self.loop, bootstrap_servers=self.hosts,
+            linger_ms=1000, partitioner=StickyPartitioner())
+        yield from producer.start()
+        topic = 'test_producer_sticky_partitioner'
+        yield from self.wait_topic(producer.client, topic)
+
+        futures = []
+        for i in range(10):
+            futures.append((yield from producer.send(topic, b'value')))
+        # all messages without key are in the same lingering batch
+        self.assertEqual(len(producer._message_accumulator._batches), 1)
+        yield from producer.stop()
+        results = yield from asyncio.gather(*futures, loop=self.loop)
+        self.assertEqual(len({res.partition for res in results}), 1)
+        self.assertEqual([res.offset for res in results], list(range(10)))